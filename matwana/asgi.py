@@ -3,6 +3,10 @@ ASGI config for matwana project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run the site through this module (e.g. ``uvicorn matwana.asgi:application``)
+to serve the live dashboard event stream at ``/api/events/``. Open streams are
+held by the event loop instead of a worker thread each; see matwanaapp/events.py.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -31,6 +31,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Off unless MATWANA_PROFILE_SAMPLE_RATE is set (see below)
+    'matwanaapp.profiling.ProfileMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -44,7 +46,8 @@ ROOT_URLCONF = 'matwana.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for the request profiles (matwanaapp/profiling.py)
+        'BACKEND': 'matwanaapp.profiling.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -68,6 +71,10 @@ if not database_url:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # Transactions take the write lock up front and wait for it, so
+            # concurrent writers (job workers, payment callbacks) queue up
+            # instead of failing with "database is locked"
+            'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
         }
     }
 else:
@@ -83,6 +90,8 @@ else:
     DATABASES['default']['ENGINE'] = 'django.db.backends.postgresql'
     DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True  # Required for Port 6543
     DATABASES['default']['OPTIONS'] = {'sslmode': 'require'}
+    # Trigram lookups for the route search (matwanaapp/search.py)
+    INSTALLED_APPS.append('django.contrib.postgres')
 
 # 5. AUTHENTICATION & USER
 # Note: Uncomment the line below once you fix your User model to inherit from AbstractUser
@@ -95,6 +104,69 @@ AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator'},
 ]
 
+# Sessions are read on every request; serve them from the cache and fall back to the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Each logged-in user holds a session and a principal entry, so the cache must fit
+# two per driver on the road (the default keeps 300 entries in all)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    }
+}
+
+# Seconds a logged-in user's role and name are cached (matwanaapp/principal.py)
+MATWANA_PRINCIPAL_TTL = 60
+
+# Seconds before the in-memory route search index is rebuilt (SQLite only)
+MATWANA_SEARCH_INDEX_TTL = 300
+
+# Background jobs (matwanaapp/jobs.py): worker threads per queue in manage.py run_jobs
+MATWANA_JOB_QUEUES = {'payments': 2, 'notifications': 1, 'default': 1}
+# Seconds before a job whose worker stopped is run again
+MATWANA_JOB_TIMEOUT = 600
+# Run jobs in the web process right after commit instead of in run_jobs (development only)
+MATWANA_JOBS_EAGER = os.getenv('MATWANA_JOBS_EAGER', '') == '1'
+
+# GPS ingest (matwanaapp/tracking.py): seconds between writes of the latest
+# position onto each trip, and days of location history kept
+MATWANA_LOCATION_FLUSH_INTERVAL = 5
+MATWANA_LOCATION_RETENTION_DAYS = 30
+
+# Seconds before the in-memory grid of active trips (matwanaapp/nearby.py) is rebuilt
+MATWANA_NEARBY_INDEX_TTL = 30
+
+# Seconds between incremental refreshes of the learned travel times (matwanaapp/eta.py)
+MATWANA_ETA_REFRESH = 300
+
+# Seconds before a route's cached stop-to-stop fare matrix (matwanaapp/fares.py) is rebuilt
+MATWANA_FARE_TABLE_TTL = 300
+
+# Seconds before the journey planner's graph of stops and trips (matwanaapp/planner.py) is rebuilt
+MATWANA_JOURNEY_GRAPH_TTL = 300
+
+# M-Pesa STK push for wallet top-ups (matwanaapp/payments.py). With no BASE_URL
+# top-ups are confirmed straight away; point it at https://sandbox.safaricom.co.ke,
+# or at manage.py mpesa_simulator to try the whole flow offline. Results are
+# posted to CALLBACK_URL, which must end in /api/payments/mpesa/callback/<CALLBACK_TOKEN>/
+MATWANA_MPESA = {
+    'BASE_URL': os.getenv('MPESA_BASE_URL', ''),
+    'CONSUMER_KEY': os.getenv('MPESA_CONSUMER_KEY', ''),
+    'CONSUMER_SECRET': os.getenv('MPESA_CONSUMER_SECRET', ''),
+    'SHORTCODE': os.getenv('MPESA_SHORTCODE', '174379'),
+    'PASSKEY': os.getenv('MPESA_PASSKEY', ''),
+    'CALLBACK_URL': os.getenv('MPESA_CALLBACK_URL', ''),
+    'CALLBACK_TOKEN': os.getenv('MPESA_CALLBACK_TOKEN', ''),
+}
+
+# Request profiling (matwanaapp/profiling.py): the share of requests whose
+# queries, database time, repeated statements, template time and response size
+# are logged and kept for superadmin/api/profiles/ (0 = off, 0.01 = 1 in 100),
+# and how many of the latest profiles each process keeps
+MATWANA_PROFILE_SAMPLE_RATE = float(os.getenv('MATWANA_PROFILE_SAMPLE_RATE', '0'))
+MATWANA_PROFILE_BUFFER_SIZE = 500
+
 # 6. INTERNATIONALIZATION
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'Africa/Nairobi' # Updated for your context
@@ -1,11 +1,48 @@
-from django.contrib import admin
-from .models import User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment, Notification
+import uuid
+
+from django import forms
+from django.contrib import admin, messages
+from . import wallet
+from .models import User, Sacco, Matatu, Route, RouteStop, Headway, Trip, PassengerTrip, Payment, Notification, UserNotification, Job
+from .models import CreditEntry, ProviderCallback
+from .models import PaymentDailyRollup, RegistrationDailyRollup, TripDailyRollup
+
+class UserAdminForm(forms.ModelForm):
+    credit_adjustment = forms.DecimalField(
+        required=False, max_digits=10, decimal_places=2,
+        help_text='Added to the wallet as an adjustment entry in the ledger (negative to deduct)'
+    )
+    # Generated when the form is shown, so submitting it twice posts the adjustment once
+    adjustment_key = forms.CharField(widget=forms.HiddenInput, initial=lambda: uuid.uuid4().hex, required=False)
+
+    class Meta:
+        model = User
+        fields = '__all__'
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
+    """Balances and unread counts only change through wallet.post and the notification inbox"""
+    form = UserAdminForm
     list_display = ('phone_number', 'first_name', 'last_name', 'user_type', 'is_verified')
     list_filter = ('user_type', 'is_active', 'is_verified')
     search_fields = ('phone_number', 'id_number', 'email')
+    readonly_fields = ('credits', 'unread_notifications')
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            # A full-row save would write back the balance and unread count read with the form
+            editable = {field.name for field in obj._meta.concrete_fields} & set(form.fields)
+            obj.save(update_fields=editable)
+        else:
+            obj.save()
+
+        amount = form.cleaned_data.get('credit_adjustment')
+        if amount:
+            try:
+                wallet.post(obj.id, amount, 'adjustment', key=f"admin:{form.cleaned_data['adjustment_key'] or uuid.uuid4().hex}")
+            except wallet.WalletError as e:
+                self.message_user(request, f'Balance not adjusted: {e}', messages.ERROR)
+            obj.refresh_from_db(fields=['credits'])
 
 @admin.register(Matatu)
 class MatatuAdmin(admin.ModelAdmin):
@@ -18,13 +55,64 @@ class SaccoAdmin(admin.ModelAdmin):
     list_display = ('name', 'registration_number', 'contact_phone')
     search_fields = ('name', 'registration_number')
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'queue', 'status', 'attempts', 'run_at', 'finished_at')
+    list_filter = ('status', 'queue')
+    search_fields = ('task', 'idempotency_key')
+
+class RouteStopInline(admin.TabularInline):
+    model = RouteStop
+    extra = 0
+
+class HeadwayInline(admin.TabularInline):
+    model = Headway
+    extra = 0
+
+@admin.register(Route)
+class RouteAdmin(admin.ModelAdmin):
+    list_display = ('name', 'sacco', 'start_point', 'end_point', 'standard_fare', 'is_active')
+    list_filter = ('sacco', 'is_active')
+    inlines = [RouteStopInline, HeadwayInline]
+
 @admin.register(Trip)
 class TripAdmin(admin.ModelAdmin):
-    list_display = ('matatu', 'route', 'status', 'scheduled_departure')
-    list_filter = ('status', 'route')
+    list_display = ('matatu', 'route', 'status', 'scheduled_departure', 'generated')
+    list_filter = ('status', 'generated', 'route')
+
+@admin.register(CreditEntry)
+class CreditEntryAdmin(admin.ModelAdmin):
+    """The ledger is append-only: entries are made by wallet.post, never here"""
+    list_display = ('user', 'kind', 'amount', 'balance_after', 'created_at')
+    list_filter = ('kind',)
+    search_fields = ('user__phone_number', 'idempotency_key')
+    raw_id_fields = ('user', 'payment')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(ProviderCallback)
+class ProviderCallbackAdmin(admin.ModelAdmin):
+    """Provider results that arrived before (or without) their payment's reference"""
+    list_display = ('reference', 'success', 'amount', 'phone', 'payment', 'received_at')
+    list_filter = ('success',)
+    search_fields = ('reference', 'phone', 'receipt_number')
+    raw_id_fields = ('payment',)
+
+    def has_add_permission(self, request):
+        return False
 
 # Register remaining models with defaults
-admin.site.register(Route)
 admin.site.register(PassengerTrip)
 admin.site.register(Payment)
-admin.site.register(Notification)
\ No newline at end of file
+admin.site.register(Notification)
+admin.site.register(UserNotification)
+admin.site.register(PaymentDailyRollup)
+admin.site.register(RegistrationDailyRollup)
+admin.site.register(TripDailyRollup)
@@ -0,0 +1,184 @@
+# booking.py
+from django.db import transaction, IntegrityError
+from django.db.models import F, Max
+from django.utils import timezone
+
+from . import wallet
+from .fares import FareError, get_table
+from .ids import transaction_id
+from .models import PassengerTrip, Trip, TripSegment, Payment
+
+
+class BookingError(Exception):
+    """Raised when a booking cannot be made. The message is safe to show to the passenger."""
+
+
+def _lock_trip(trip):
+    """Queue up behind other bookings on the trip; returns its current seat count."""
+    return Trip.objects.select_for_update().filter(id=trip.id).values_list('seats_booked', flat=True)[0]
+
+
+def _update_peak(trip):
+    peak = TripSegment.objects.filter(trip_id=trip.id).aggregate(peak=Max('seats_booked'))['peak'] or 0
+    Trip.objects.filter(id=trip.id).update(seats_booked=peak)
+
+
+def _take_segments(trip, capacity, first, last, segments):
+    """Take a seat on every segment from stop ``first`` to stop ``last``."""
+    seats = _lock_trip(trip)
+    # The first booking since the route got stops; earlier bookings are for the whole route
+    TripSegment.objects.bulk_create(
+        [TripSegment(trip_id=trip.id, index=i, seats_booked=seats) for i in range(segments)],
+        ignore_conflicts=True
+    )
+    taken = TripSegment.objects.filter(
+        trip_id=trip.id,
+        index__gte=first,
+        index__lt=last,
+        seats_booked__lt=capacity,
+    ).update(seats_booked=F('seats_booked') + 1)
+    if taken != last - first:
+        raise BookingError('No seat is free for the whole of this journey')
+    _update_peak(trip)
+
+
+def _release_segments(trip, booking):
+    _lock_trip(trip)
+    segments = TripSegment.objects.filter(trip_id=trip.id, seats_booked__gt=0)
+    if booking.boarding_index is not None:
+        segments = segments.filter(index__gte=booking.boarding_index, index__lt=booking.alighting_index)
+    segments.update(seats_booked=F('seats_booked') - 1)
+    _update_peak(trip)
+
+
+def book_trip(passenger, trip_id, route_id=None, boarding=None, alighting=None):
+    """
+    Book a seat on a trip and pay for it from the passenger's wallet.
+
+    The seat, the wallet debit, the booking and the payment record are written in
+    one transaction. Seats and credits are taken with conditional UPDATEs
+    (``seats_booked < capacity``, and ``credits >= fare`` in wallet.post) so
+    concurrent requests can never oversell a trip or spend the same shilling
+    twice. Only ``passenger.id`` is used, so the session principal can be
+    passed as is.
+
+    On routes with stops, ``boarding`` and ``alighting`` (stop ids or names,
+    defaulting to the route's ends) set the fare, and the seat is only taken
+    on the segments in between, each with its own conditional UPDATE. Those
+    bookings take a row lock on the trip first so the trip's seat count can
+    be kept at its busiest segment.
+    """
+    trips = Trip.objects.select_related('route', 'matatu')
+    if route_id is not None:
+        trips = trips.filter(route_id=route_id)
+    try:
+        trip = trips.get(id=trip_id)
+    except Trip.DoesNotExist:
+        raise BookingError('Trip not found')
+
+    if trip.status not in ('scheduled', 'active'):
+        raise BookingError('This trip is no longer accepting bookings')
+
+    # Friendly early exit only; the unique constraint is what actually enforces it
+    if PassengerTrip.objects.filter(passenger_id=passenger.id, trip=trip).exists():
+        raise BookingError('You have already booked this trip')
+
+    table = get_table(trip.route)
+    try:
+        first, last, fare = table.journey(boarding, alighting)
+    except FareError as e:
+        raise BookingError(str(e))
+    capacity = trip.matatu.capacity
+
+    try:
+        with transaction.atomic():
+            # Take a seat
+            if table.has_stops:
+                _take_segments(trip, capacity, first, last, table.segments)
+            else:
+                seat_taken = Trip.objects.filter(
+                    id=trip.id,
+                    seats_booked__lt=capacity,
+                ).update(seats_booked=F('seats_booked') + 1)
+                if not seat_taken:
+                    raise BookingError('This trip is fully booked')
+
+            # unique_together (passenger, trip) rejects a second booking
+            booking = PassengerTrip.objects.create(
+                passenger_id=passenger.id,
+                trip=trip,
+                boarding_stop=table.stops[first]['name'],
+                alighting_stop=table.stops[last]['name'],
+                boarding_index=first if table.has_stops else None,
+                alighting_index=last if table.has_stops else None,
+                fare_paid=fare,
+                payment_method='credits',
+                is_paid=True
+            )
+
+            payment = Payment.objects.create(
+                passenger_id=passenger.id,
+                sacco_id=trip.route.sacco_id,
+                payment_type='trip',
+                amount=fare,
+                transaction_id=transaction_id('TRIP'),
+                payment_method='credits',
+                status='completed',
+                description=f'Trip booking for {trip.route.name}',
+                completed_at=timezone.now()
+            )
+
+            # Debit the wallet; rolls the booking back if the balance is short
+            wallet.post(passenger.id, -fare, 'trip', key=f'trip:{booking.id}', payment=payment)
+    except wallet.WalletError as e:
+        raise BookingError(str(e))
+    except IntegrityError:
+        raise BookingError('You have already booked this trip')
+
+    return booking
+
+
+def cancel_booking(booking):
+    """
+    Cancel a booking, give the seat back and refund the fare to the wallet.
+
+    Only bookings on trips that have not left yet can be cancelled.
+    """
+    trip = booking.trip
+    if trip.status != 'scheduled':
+        raise BookingError('Only bookings on scheduled trips can be cancelled')
+
+    with transaction.atomic():
+        # Whoever deletes the row owns the refund, so a double cancel is a no-op
+        deleted = PassengerTrip.objects.filter(id=booking.id).delete()[0]
+        if not deleted:
+            raise BookingError('Booking has already been cancelled')
+
+        if TripSegment.objects.filter(trip_id=trip.id).exists():
+            _release_segments(trip, booking)
+        else:
+            Trip.objects.filter(
+                id=trip.id,
+                seats_booked__gt=0,
+            ).update(seats_booked=F('seats_booked') - 1)
+
+        if booking.is_paid and booking.payment_method == 'credits':
+            refund = Payment.objects.create(
+                passenger_id=booking.passenger_id,
+                sacco_id=trip.route.sacco_id,
+                payment_type='refund',
+                amount=booking.fare_paid,
+                transaction_id=transaction_id('REFUND'),
+                payment_method='credits',
+                status='completed',
+                description=f'Refund for cancelled trip on {trip.route.name}',
+                completed_at=timezone.now()
+            )
+            wallet.post(booking.passenger_id, booking.fare_paid, 'refund', key=f'refund:{booking.id}', payment=refund)
+
+
+def seats_by_segment(trip, table):
+    """Free seats on each segment of a trip (``matatu`` loaded), in stop order."""
+    capacity = trip.matatu.capacity
+    booked = dict(TripSegment.objects.filter(trip_id=trip.id).values_list('index', 'seats_booked'))
+    return [max(capacity - booked.get(i, trip.seats_booked), 0) for i in range(table.segments)]
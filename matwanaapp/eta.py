@@ -0,0 +1,241 @@
+# eta.py
+"""
+Travel time estimates learned from completed trips.
+
+Every completed trip with an actual departure and arrival is one observation
+of its route's travel time at the hour of day it left. Observations are kept
+in NumPy arrays and summarised per (route, hour) bucket in one vectorised
+pass: the sample count, the median and the 90th percentile. Buckets with too
+few samples fall back to the route over all hours, and routes without history
+to ``Route.estimated_duration_minutes``.
+
+The model is built on first use and refreshed every ``MATWANA_ETA_REFRESH``
+seconds. A refresh only reads trips that arrived since the last one, appends
+them and drops observations older than ``HISTORY_DAYS`` before summarising
+again, so it stays cheap as history grows. The model is rebuilt from scratch
+once a day.
+
+NumPy is optional. Without it there is no model and every estimate is the
+route's static one, as for a route with no history.
+"""
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models.functions import ExtractHour
+from django.utils import timezone
+
+from .models import Trip
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HOURS = 24
+HISTORY_DAYS = 90
+# A (route, hour) bucket needs this many trips before it is trusted
+MIN_SAMPLES = 5
+# Trips shorter or longer than this are treated as bad data
+MIN_MINUTES = 1
+MAX_MINUTES = 6 * 60
+DEFAULT_REFRESH = 300
+# Start from scratch daily to pick up trips completed with a back-dated arrival
+REBUILD_SECONDS = 24 * 60 * 60
+
+
+def _quantiles(keys, values, n_keys, qs):
+    """Count and quantiles of ``values`` grouped by integer ``keys`` (nearest rank)."""
+    # One sort on a combined key is much cheaper than lexsort; values stay below MAX_MINUTES
+    order = np.argsort(keys * (MAX_MINUTES + 1.0) + values)
+    keys, values = keys[order], values[order]
+    counts = np.bincount(keys, minlength=n_keys)
+    starts = np.cumsum(counts) - counts
+    result = []
+    for q in qs:
+        out = np.full(n_keys, np.nan)
+        present = counts > 0
+        idx = starts[present] + np.floor(q * (counts[present] - 1)).astype(np.int64)
+        out[present] = values[idx]
+        result.append(out)
+    return counts, result
+
+
+def local_hours(moments):
+    """Local hour of day of each datetime, converting each distinct quarter hour once."""
+    quarters = np.fromiter((m.timestamp() // 900 for m in moments), np.int64, len(moments))
+    unique, inverse = np.unique(quarters, return_inverse=True)
+    hours = np.fromiter(
+        (timezone.localtime(datetime.fromtimestamp(q * 900, dt_timezone.utc)).hour for q in unique.tolist()),
+        np.int64, len(unique)
+    )
+    return hours[inverse]
+
+
+class EtaModel:
+
+    def __init__(self):
+        self.route_index = {}
+        self.routes = np.empty(0, dtype=np.int64)
+        self.hours = np.empty(0, dtype=np.int64)
+        self.departed = np.empty(0, dtype=np.float64)  # epoch seconds
+        self.minutes = np.empty(0, dtype=np.float64)
+        self.watermark = None
+        self.built_at = self.refreshed_at = time.monotonic()
+        self._summarise()
+
+    def _route_slot(self, route_id):
+        slot = self.route_index.get(route_id)
+        if slot is None:
+            slot = self.route_index[route_id] = len(self.route_index)
+        return slot
+
+    def refresh(self):
+        """Add trips that arrived since the last refresh and recompute the buckets."""
+        now = timezone.now()
+        trips = Trip.objects.filter(
+            status='completed',
+            actual_departure__isnull=False,
+            actual_arrival__isnull=False,
+            actual_arrival__lte=now,
+        )
+        if self.watermark is None:
+            trips = trips.filter(actual_arrival__gte=now - timedelta(days=HISTORY_DAYS))
+        else:
+            trips = trips.filter(actual_arrival__gt=self.watermark)
+        rows = list(trips.annotate(hour=ExtractHour('actual_departure')).values_list(
+            'route_id', 'hour', 'actual_departure', 'actual_arrival'
+        ))
+
+        if rows:
+            routes = np.fromiter((self._route_slot(row[0]) for row in rows), np.int64, len(rows))
+            hours = np.fromiter((row[1] for row in rows), np.int64, len(rows))
+            departed = np.fromiter((row[2].timestamp() for row in rows), np.float64, len(rows))
+            arrived = np.fromiter((row[3].timestamp() for row in rows), np.float64, len(rows))
+            minutes = (arrived - departed) / 60
+            self.routes = np.concatenate((self.routes, routes))
+            self.hours = np.concatenate((self.hours, hours))
+            self.departed = np.concatenate((self.departed, departed))
+            self.minutes = np.concatenate((self.minutes, minutes))
+            self.watermark = max(row[3] for row in rows)
+
+        keep = (
+            (self.departed >= (now - timedelta(days=HISTORY_DAYS)).timestamp()) &
+            (self.minutes >= MIN_MINUTES) & (self.minutes <= MAX_MINUTES)
+        )
+        if not keep.all():
+            self.routes, self.hours = self.routes[keep], self.hours[keep]
+            self.departed, self.minutes = self.departed[keep], self.minutes[keep]
+        self._summarise()
+        self.refreshed_at = time.monotonic()
+        return len(rows)
+
+    def _summarise(self):
+        n_routes = len(self.route_index)
+        buckets = self.routes * HOURS + self.hours
+        counts, (p50, p90) = _quantiles(buckets, self.minutes, n_routes * HOURS, (0.5, 0.9))
+        self.counts = counts.reshape(n_routes, HOURS)
+        self.p50 = p50.reshape(n_routes, HOURS)
+        self.p90 = p90.reshape(n_routes, HOURS)
+
+        route_counts, (route_p50, route_p90) = _quantiles(self.routes, self.minutes, n_routes, (0.5, 0.9))
+        # Thin buckets use the route's figures over all hours
+        thin = self.counts < MIN_SAMPLES
+        self.p50[thin] = np.broadcast_to(route_p50[:, None], thin.shape)[thin]
+        self.p90[thin] = np.broadcast_to(route_p90[:, None], thin.shape)[thin]
+        route_thin = route_counts < MIN_SAMPLES
+        self.p50[route_thin] = np.nan
+        self.p90[route_thin] = np.nan
+
+    def estimate_many(self, route_ids, departures):
+        """
+        Median and 90th percentile travel minutes for trips leaving on
+        ``route_ids`` at ``departures``, as two arrays. NaN where there is no
+        history; see ``estimates`` for the static fallback.
+        """
+        n = len(route_ids)
+        slots = np.fromiter((self.route_index.get(r, -1) for r in route_ids), np.int64, n)
+        hours = local_hours(departures)
+        p50 = np.full(n, np.nan)
+        p90 = np.full(n, np.nan)
+        known = slots >= 0
+        p50[known] = self.p50[slots[known], hours[known]]
+        p90[known] = self.p90[slots[known], hours[known]]
+        return p50, p90
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    global _model
+    ttl = getattr(settings, 'MATWANA_ETA_REFRESH', DEFAULT_REFRESH)
+    with _model_lock:
+        if _model is None or time.monotonic() - _model.built_at > REBUILD_SECONDS:
+            _model = EtaModel()
+            _model.refresh()
+        elif time.monotonic() - _model.refreshed_at > ttl:
+            _model.refresh()
+        return _model
+
+
+def invalidate():
+    global _model
+    _model = None
+
+
+def _estimate(route_ids, departures, static_minutes):
+    if np is None:
+        return [
+            {'minutes': minutes, 'p90_minutes': minutes, 'arrival': departure + timedelta(minutes=minutes),
+             'source': 'route'}
+            for departure, minutes in zip(departures, static_minutes)
+        ]
+    p50, p90 = get_model().estimate_many(route_ids, departures)
+    missing = np.isnan(p50)
+    static = np.array(static_minutes, dtype=np.float64)
+    p50 = np.where(missing, static, p50)
+    p90 = np.where(missing, static, p90)
+    return [
+        {
+            'minutes': round(median),
+            'p90_minutes': round(slow),
+            'arrival': departure + timedelta(minutes=median),
+            'source': 'route' if fallback else 'history',
+        }
+        for departure, median, slow, fallback in zip(departures, p50.tolist(), p90.tolist(), missing.tolist())
+    ]
+
+
+def estimates(trips):
+    """
+    Travel estimates for trips (with ``route`` loaded): a dict per trip with
+    ``minutes``, ``p90_minutes``, ``arrival`` and ``source`` ('history', or
+    'route' for the route's static estimate).
+    """
+    trips = list(trips)
+    if not trips:
+        return []
+    return _estimate(
+        [trip.route_id for trip in trips],
+        [trip.actual_departure or trip.scheduled_departure for trip in trips],
+        [trip.route.estimated_duration_minutes for trip in trips],
+    )
+
+
+def estimate(route, departure):
+    """The same estimate for a single departure on ``route``."""
+    return _estimate([route.id], [departure], [route.estimated_duration_minutes])[0]
+
+
+def route_profile(route):
+    """Median minutes by hour of day for a route, or None where there is no history."""
+    if np is None:
+        return [None] * HOURS
+    model = get_model()
+    slot = model.route_index.get(route.id)
+    if slot is None:
+        return [None] * HOURS
+    return [None if np.isnan(v) else round(float(v)) for v in model.p50[slot]]
@@ -0,0 +1,175 @@
+# events.py
+"""
+Live update events for the dashboards.
+
+Changes are published once to a named channel (``user:<id>``, ``trip:<id>``,
+``admin``, ``broadcast``) and fanned out to every open event stream subscribed
+to it. The default broker keeps subscribers in process memory, which is enough
+for a single node. Set ``MATWANA_EVENT_BROKER`` to
+``'matwanaapp.events.PostgresBroker'`` to fan out across nodes with
+LISTEN/NOTIFY on the existing database.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER = 'matwanaapp.events.InProcessBroker'
+
+
+class Subscription:
+    """One open event stream. Events are queued on the subscriber's event loop."""
+
+    def __init__(self, broker, channels, loop, max_queue=100):
+        self.broker = broker
+        self.channels = set(channels)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_queue)
+
+    def deliver(self, event):
+        # Called from any thread
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.queue.full():
+            # A stalled client only loses its oldest updates
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    def add_channel(self, channel):
+        self.broker.add_channel(self, channel)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    """Fan out events to subscribers in this process."""
+
+    def __init__(self):
+        self._channels = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, event):
+        self._deliver(channel, event)
+
+    def _deliver(self, channel, event):
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def subscribe(self, channels, loop=None):
+        subscription = Subscription(self, channels, loop or asyncio.get_running_loop())
+        with self._lock:
+            for channel in subscription.channels:
+                self._channels[channel].add(subscription)
+        return subscription
+
+    def add_channel(self, subscription, channel):
+        with self._lock:
+            subscription.channels.add(channel)
+            self._channels[channel].add(subscription)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._channels.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._channels[channel]
+
+
+class PostgresBroker(InProcessBroker):
+    """
+    Multi-node broker using Postgres LISTEN/NOTIFY.
+
+    Publishing sends a NOTIFY on the Django connection, so events are only sent
+    when the surrounding transaction commits. Every node runs one listener
+    thread that hands notifications to its local subscribers.
+    """
+    pg_channel = 'matwana_events'
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+
+    def publish(self, channel, event):
+        payload = json.dumps({'channel': channel, 'event': event}, default=str)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.pg_channel, payload])
+
+    def subscribe(self, channels, loop=None):
+        self._start_listener()
+        return super().subscribe(channels, loop)
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='matwana-events', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        import psycopg
+
+        db = settings.DATABASES['default']
+        conn = psycopg.connect(
+            dbname=db['NAME'],
+            user=db['USER'],
+            password=db['PASSWORD'],
+            host=db['HOST'],
+            port=db['PORT'] or None,
+            autocommit=True,
+            **db.get('OPTIONS', {})
+        )
+        with conn:
+            conn.execute(f'LISTEN {self.pg_channel}')
+            for notify in conn.notifies():
+                try:
+                    message = json.loads(notify.payload)
+                    self._deliver(message['channel'], message['event'])
+                except (ValueError, KeyError):
+                    logger.warning('Ignoring malformed event payload: %r', notify.payload)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                path = getattr(settings, 'MATWANA_EVENT_BROKER', DEFAULT_BROKER)
+                _broker = import_string(path)()
+    return _broker
+
+
+def publish(channel, event_type, **data):
+    """Publish an event once the current transaction (if any) commits."""
+    event = {'type': event_type, **data}
+
+    def send():
+        try:
+            get_broker().publish(channel, event)
+        except Exception:
+            # Live updates are best effort; never fail the write that caused them
+            logger.exception('Failed to publish %s event to %s', event_type, channel)
+
+    transaction.on_commit(send)
+
+
+def format_sse(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
@@ -0,0 +1,222 @@
+# exports.py
+"""
+Streaming exports of payments, trips and users for finance.
+
+``export(dataset, params, fmt)`` returns an iterator of byte chunks, one per
+batch of rows, so a response or file can be written while the rows are still
+being read and memory stays flat however big the table is. Rows are read in
+primary key order:
+
+* with ``.iterator(chunk_size=BATCH_SIZE)`` on Postgres, where it uses a
+  server-side cursor;
+* in keyset batches (``id > last id ... LIMIT BATCH_SIZE``) where server-side
+  cursors are off (``DISABLE_SERVER_SIDE_CURSORS``, needed behind the
+  Supabase transaction pooler) and on SQLite, where a long open read would
+  hold off writers for the whole export.
+
+Formats are CSV and Parquet. Parquet needs ``pyarrow``; without it asking
+for Parquet raises ExportError. Each batch is written as one Parquet row
+group, so columns are typed (decimals stay decimals) and nothing but the
+current batch is held.
+
+The filters are the ones the superadmin list views take (status, type,
+sacco, date range, user search).
+"""
+import csv
+import io
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+
+from .models import Payment, Trip, User
+
+BATCH_SIZE = 2000
+FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+
+class ExportError(Exception):
+    """Raised for an unknown dataset, format or filter. The message is safe to show."""
+
+
+def _dates(rows, params, field):
+    for param, lookup in (('date_from', 'gte'), ('date_to', 'lte')):
+        if params.get(param):
+            day = parse_date(params[param])
+            if day is None:
+                raise ExportError(f'{param} must be a date (YYYY-MM-DD)')
+            rows = rows.filter(**{f'{field}__date__{lookup}': day})
+    return rows
+
+
+def _payments(params):
+    rows = Payment.objects.all()
+    if params.get('status'):
+        rows = rows.filter(status=params['status'])
+    if params.get('payment_type'):
+        rows = rows.filter(payment_type=params['payment_type'])
+    return _dates(rows, params, 'created_at')
+
+
+def _trips(params):
+    rows = Trip.objects.all()
+    if params.get('status'):
+        rows = rows.filter(status=params['status'])
+    if params.get('sacco'):
+        if not str(params['sacco']).isdigit():
+            raise ExportError('sacco must be a sacco id')
+        rows = rows.filter(matatu__sacco_id=params['sacco'])
+    return _dates(rows, params, 'scheduled_departure')
+
+
+def _users(params):
+    rows = User.objects.all()
+    if params.get('user_type'):
+        rows = rows.filter(user_type=params['user_type'])
+    if params.get('search'):
+        search = params['search']
+        rows = rows.filter(
+            Q(first_name__icontains=search) | Q(last_name__icontains=search) | Q(email__icontains=search) |
+            Q(phone_number__icontains=search) | Q(id_number__icontains=search)
+        )
+    return _dates(rows, params, 'date_joined')
+
+
+# dataset: (filtered queryset, columns); the first column must be the primary key
+DATASETS = {
+    'payments': (_payments, (
+        'id', 'transaction_id', 'created_at', 'completed_at', 'passenger_id', 'passenger__phone_number',
+        'sacco_id', 'sacco__name', 'payment_type', 'payment_method', 'status', 'amount',
+        'provider_reference', 'receipt_number',
+    )),
+    'trips': (_trips, (
+        'id', 'route_id', 'route__name', 'matatu__sacco__name', 'matatu__plate_number', 'matatu__capacity',
+        'driver_id', 'scheduled_departure', 'actual_departure', 'scheduled_arrival', 'actual_arrival',
+        'status', 'seats_booked', 'generated',
+    )),
+    # No passwords or national id numbers
+    'users': (_users, (
+        'id', 'user_type', 'first_name', 'last_name', 'email', 'phone_number', 'date_joined',
+        'is_active', 'is_verified', 'credits',
+    )),
+}
+
+
+def batches(queryset, columns, batch_size=BATCH_SIZE):
+    """Lists of value tuples, ``batch_size`` rows at a time, in primary key order."""
+    rows = queryset.order_by('pk').values_list(*columns)
+    if connection.vendor == 'postgresql' and not connection.settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    last = None
+    while True:
+        batch = list((rows if last is None else rows.filter(pk__gt=last))[:batch_size])
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1][0]
+
+
+def _field(model, lookup):
+    """The model field a ``values_list`` lookup such as ``route__sacco__name`` ends at."""
+    *path, name = lookup.split('__')
+    for step in path:
+        model = model._meta.get_field(step).related_model
+    field = model._meta.get_field(name)
+    # passenger_id and the like are the related model's primary key
+    return field.target_field if field.is_relation else field
+
+
+def _csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue().encode()
+    for batch in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            [value.isoformat() if hasattr(value, 'isoformat') else value for value in row] for row in batch
+        )
+        yield buffer.getvalue().encode()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands back whatever was written since the last ``drain``."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_type(pa, field):
+    internal = field.get_internal_type()
+    if internal == 'DecimalField':
+        return pa.decimal128(field.max_digits, field.decimal_places)
+    if internal == 'DateTimeField':
+        return pa.timestamp('us', tz='UTC')
+    if internal == 'DateField':
+        return pa.date32()
+    if internal == 'BooleanField':
+        return pa.bool_()
+    if internal.endswith('IntegerField') or internal.endswith('AutoField'):
+        return pa.int64()
+    if internal == 'FloatField':
+        return pa.float64()
+    return pa.string()
+
+
+def _parquet(model, columns, rows):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError('Parquet export needs pyarrow installed; use CSV instead')
+
+    schema = pa.schema([(column, _arrow_type(pa, _field(model, column))) for column in columns])
+
+    def chunks():
+        sink = _Sink()
+        with pq.ParquetWriter(sink, schema, compression='snappy') as writer:
+            for batch in rows:
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*batch), schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                yield sink.drain()
+        yield sink.drain()  # the footer
+
+    return chunks()
+
+
+def export(dataset, params=None, fmt='csv', batch_size=BATCH_SIZE):
+    """Byte chunks of ``dataset`` filtered by ``params``, as CSV or Parquet."""
+    if dataset not in DATASETS:
+        raise ExportError(f'Unknown dataset {dataset}; choose from {", ".join(DATASETS)}')
+    if fmt not in FORMATS:
+        raise ExportError(f'Unknown format {fmt}; choose from {", ".join(FORMATS)}')
+    filtered, columns = DATASETS[dataset]
+    queryset = filtered(params or {})
+    rows = batches(queryset, columns, batch_size)
+    if fmt == 'parquet':
+        return _parquet(queryset.model, columns, rows)
+    return _csv(columns, rows)
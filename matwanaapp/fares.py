@@ -0,0 +1,198 @@
+# fares.py
+"""
+Stop-to-stop fares.
+
+A route's stops (RouteStop) run from its start point to its end point, each
+with its distance along the route. The fare between two stops is the route's
+standard fare prorated by the distance travelled, rounded up to ``FARE_STEP``
+shillings and never more than the standard fare, so a ride over the whole
+route costs what it always did. Routes without stops only sell the whole
+route.
+
+Each route's fares are worked out once into a matrix held in memory, so a
+quote for any pair of stops is a lookup. A route's table is dropped when the
+route or its stops are saved (signals.py) and rebuilt after
+``MATWANA_FARE_TABLE_TTL`` seconds so other processes see edits too.
+"""
+import threading
+import time
+from decimal import Decimal, ROUND_CEILING, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+
+from . import planner
+from .models import RouteStop, TripSegment
+
+FARE_STEP = Decimal('10')
+DEFAULT_TTL = 300
+
+
+class FareError(Exception):
+    """Raised for unknown stops or impossible journeys. The message is safe to show to the passenger."""
+
+
+class FareTable:
+
+    def __init__(self, route, stops):
+        self.route_id = route.id
+        self.standard_fare = route.standard_fare
+        # A route without stops is one segment from its start point to its end point
+        self.has_stops = len(stops) >= 2
+        if not self.has_stops:
+            stops = [
+                RouteStop(name=route.start_point, sequence=0, distance_km=Decimal('0')),
+                RouteStop(name=route.end_point, sequence=1, distance_km=route.distance_km),
+            ]
+        self.stops = [{'id': stop.id, 'name': stop.name, 'distance_km': stop.distance_km} for stop in stops]
+        self.positions = {}
+        for i, stop in enumerate(stops):
+            self.positions.setdefault(stop.name.strip().lower(), i)
+            if stop.id is not None:
+                self.positions[stop.id] = i
+
+        # fares[i][j] for every i < j
+        n = len(stops)
+        length = stops[-1].distance_km - stops[0].distance_km
+        self.fares = [[None] * n for _ in range(n)]
+        for i in range(n):
+            for j in range(i + 1, n):
+                share = (stops[j].distance_km - stops[i].distance_km) / length if length > 0 else 1
+                fare = (self.standard_fare * share / FARE_STEP).to_integral_value(ROUND_CEILING) * FARE_STEP
+                self.fares[i][j] = min(max(fare, FARE_STEP), self.standard_fare)
+        self.fares[0][n - 1] = self.standard_fare
+        self.built_at = time.monotonic()
+
+    @property
+    def segments(self):
+        return len(self.stops) - 1
+
+    def position(self, stop):
+        """Position of a stop given by id or by name."""
+        if isinstance(stop, str) and stop.strip().isdigit():
+            stop = int(stop)
+        key = stop.strip().lower() if isinstance(stop, str) else stop
+        try:
+            return self.positions[key]
+        except (KeyError, TypeError):
+            raise FareError(f'{stop} is not a stop on this route')
+
+    def journey(self, boarding=None, alighting=None):
+        """(boarding position, alighting position, fare); missing stops default to the route's ends."""
+        first = 0 if boarding in (None, '') else self.position(boarding)
+        last = self.segments if alighting in (None, '') else self.position(alighting)
+        if first >= last:
+            raise FareError('The alighting stop must come after the boarding stop')
+        return first, last, self.fares[first][last]
+
+    def fare(self, boarding, alighting):
+        return self.journey(boarding, alighting)[2]
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_table(route):
+    """The fare table of a route instance, built from its stops on first use."""
+    ttl = getattr(settings, 'MATWANA_FARE_TABLE_TTL', DEFAULT_TTL)
+    table = _tables.get(route.id)
+    if table is None or time.monotonic() - table.built_at > ttl or table.standard_fare != route.standard_fare:
+        table = FareTable(route, list(RouteStop.objects.filter(route_id=route.id).order_by('sequence')))
+        with _tables_lock:
+            _tables[route.id] = table
+    return table
+
+
+def invalidate(route_id=None):
+    with _tables_lock:
+        if route_id is None:
+            _tables.clear()
+        else:
+            _tables.pop(route_id, None)
+
+
+def parse_stops(text):
+    """
+    Stops typed one per line as ``Name`` or ``Name, km from the start``.
+    Returns (name, distance or None) pairs.
+    """
+    stops = []
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        name, _, km = line.rpartition(',')
+        if not name:
+            stops.append((line, None))
+            continue
+        try:
+            stops.append((name.strip(), Decimal(km.strip())))
+        except InvalidOperation:
+            # A comma that is part of the name
+            stops.append((line, None))
+    return stops
+
+
+def set_stops(route, stops):
+    """
+    Replace the stops between a route's start and end points with ``stops``
+    ((name, km) pairs as from ``parse_stops``). Missing distances are spread
+    evenly between their neighbours. An empty list removes the stops. Returns
+    True if anything changed.
+    """
+    length = Decimal(str(route.distance_km))
+    points = [(route.start_point, Decimal('0'))] + list(stops) + [(route.end_point, length)] if stops else []
+
+    # Interpolate the stops typed without a distance
+    i = 0
+    while i < len(points):
+        if points[i][1] is not None:
+            i += 1
+            continue
+        j = i
+        while points[j][1] is None:
+            j += 1
+        before, after = points[i - 1][1], points[j][1]
+        for k in range(i, j):
+            share = Decimal(k - i + 1) / (j - i + 1)
+            points[k] = (points[k][0], (before + (after - before) * share).quantize(Decimal('0.01')))
+        i = j
+
+    names = set()
+    for (name, km), (_, next_km) in zip(points, points[1:]):
+        if not name:
+            raise FareError('Every stop needs a name')
+        if next_km <= km:
+            raise FareError(f'Stops must be listed in order, each further along than {name}')
+    for name, km in points:
+        if name.lower() in names:
+            raise FareError(f'{name} is listed more than once')
+        names.add(name.lower())
+
+    current = list(RouteStop.objects.filter(route=route).order_by('sequence').values_list('name', 'distance_km'))
+    if current == [(name, km) for name, km in points]:
+        return False
+    # Seats booked between the old stops would no longer line up with the new segments
+    if TripSegment.objects.filter(trip__route=route, trip__status__in=('scheduled', 'active'),
+                                  seats_booked__gt=0).exists():
+        raise FareError('Stops cannot change while trips on this route have bookings')
+
+    with transaction.atomic():
+        RouteStop.objects.filter(route=route).delete()
+        # Counts of the old layout; recreated from the trip's count on its next booking
+        TripSegment.objects.filter(trip__route=route).delete()
+        RouteStop.objects.bulk_create([
+            RouteStop(route=route, name=name, sequence=sequence, distance_km=km)
+            for sequence, (name, km) in enumerate(points)
+        ])
+        # bulk_create sends no signals
+        transaction.on_commit(lambda: invalidate(route.id))
+        transaction.on_commit(lambda: planner.route_changed(route.id))
+    return True
+
+
+def stops_text(route):
+    """The stops between the route's ends, one per line as ``set_stops`` reads them."""
+    stops = list(RouteStop.objects.filter(route=route).order_by('sequence'))
+    return '\n'.join(f'{stop.name}, {stop.distance_km}' for stop in stops[1:-1])
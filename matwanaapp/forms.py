@@ -84,26 +84,12 @@ class SignupForm(forms.ModelForm):
     # forms.py
 
     def clean_phone_number(self):
-        phone = self.cleaned_data.get('phone_number')
-        # 1. Remove all non-digits (keeps just 254740095168)
-        digits = ''.join(filter(str.isdigit, phone))
-        
-        # 2. If it starts with 0, remove it (0740... -> 740...)
-        if digits.startswith('0'):
-            digits = digits[1:]
-        
-        # 3. If it starts with 254 and is long, it's already prefixed
-        if digits.startswith('254') and len(digits) > 9:
-            # Just use the digits as they are, but we'll add the + back
-            clean_digits = digits
-        else:
-            # It's a raw number like 740...
-            clean_digits = f"254{digits}"
-
-        # 4. Final formatted number for storage
-        formatted_phone = f"+{clean_digits}"
-        
-        # 5. Check uniqueness (VERY IMPORTANT)
+        # Stored as +254..., the form login looks up (login_lookups)
+        formatted_phone = normalize_phone(self.cleaned_data.get('phone_number') or '')
+        if not formatted_phone:
+            raise ValidationError('Enter a Kenyan mobile number, e.g. 0712 345 678')
+        
+        # Check uniqueness (VERY IMPORTANT)
         # Exclude the current user if this is an update form
         user_exists = User.objects.filter(phone_number=formatted_phone)
         if self.instance.pk:
@@ -157,15 +143,49 @@ class SignupForm(forms.ModelForm):
             user.save()
         return user
 
+def normalize_phone(value):
+    """Return a Kenyan mobile number as +254XXXXXXXXX, or None if it isn't one."""
+    digits = ''.join(filter(str.isdigit, value))
+    if len(digits) == 10 and digits.startswith('0'):
+        digits = '254' + digits[1:]
+    elif len(digits) == 9 and digits[0] in '17':
+        digits = '254' + digits
+    if len(digits) == 12 and digits.startswith('254'):
+        return f'+{digits}'
+    return None
+
+
+def login_lookups(value):
+    """
+    Classify a login identifier and return the lookups to try, in order.
+
+    Each lookup hits one unique index. Only a bare 9 digit number starting
+    with 7 or 1 is ambiguous (ID number or a phone without the leading 0), so
+    it is tried as an ID first and then as a phone number.
+    """
+    value = value.strip()
+    if '@' in value:
+        # Signup stores emails lowercased; accounts added by admins keep their case
+        return [{'email__in': {value, value.lower()}}]
+
+    lookups = []
+    if value.isdigit() and len(value) in (8, 9):
+        lookups.append({'id_number': value})
+    phone = normalize_phone(value)
+    if phone:
+        lookups.append({'phone_number': phone})
+    return lookups
+
+
 class LoginForm(forms.Form):
     username = forms.CharField(
         max_length=255,
         required=True,
         widget=forms.TextInput(attrs={
-            'placeholder': 'Email or ID number',
+            'placeholder': 'Email, phone or ID number',
             'class': 'form-control'
         }),
-        error_messages={'required': 'Please enter your email or ID number'}
+        error_messages={'required': 'Please enter your email, phone or ID number'}
     )
     
     password = forms.CharField(
@@ -177,6 +197,15 @@ class LoginForm(forms.Form):
         error_messages={'required': 'Password is required'}
     )
 
+    def get_user(self):
+        """The account matching the cleaned username, or None."""
+        for lookup in login_lookups(self.cleaned_data['username']):
+            # No ORDER BY, so this stays a single unique-index probe
+            match = User.objects.filter(**lookup).order_by()[:1]
+            if match:
+                return match[0]
+        return None
+
 
 class ForgotPasswordForm(forms.Form):
     email = forms.EmailField(
@@ -0,0 +1,67 @@
+# ids.py
+"""
+Transaction ids.
+
+``transaction_id(prefix)`` returns the prefix followed by a ULID: 26
+Crockford base32 characters holding a 48-bit millisecond timestamp and 80
+random bits. Ids sort by the time they were made, need no database round
+trip, and two made anywhere (other threads, processes, servers) in the same
+millisecond only collide if 80 random bits do.
+
+Within a process ids are strictly increasing: an id made in the same
+millisecond as the last one (or while the clock has stepped back) is the
+last one plus one instead of a fresh random draw. The state is reset in
+forked children, which would otherwise continue the parent's sequence and
+hand out the same ids as their siblings.
+"""
+import os
+import threading
+import time
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+RANDOM_BITS = 80
+
+_lock = threading.Lock()
+_last = 0  # the last ULID made here, as an integer
+
+
+def _reset():
+    global _last, _lock
+    _last = 0
+    _lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
+
+
+def encode(value):
+    chars = []
+    for _ in range(26):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def ulid():
+    global _last
+    millis = time.time_ns() // 1_000_000
+    with _lock:
+        if millis > _last >> RANDOM_BITS:
+            value = (millis << RANDOM_BITS) | int.from_bytes(os.urandom(RANDOM_BITS // 8), 'big')
+        else:
+            value = _last + 1
+        _last = value
+    return encode(value)
+
+
+def timestamp(ulid_text):
+    """Seconds since the epoch encoded in a ULID (or a prefixed transaction id)."""
+    value = 0
+    for char in ulid_text[-26:]:
+        value = (value << 5) | ALPHABET.index(char)
+    return (value >> RANDOM_BITS) / 1000
+
+
+def transaction_id(prefix):
+    return f'{prefix}{ulid()}'
@@ -0,0 +1,173 @@
+# jobs.py
+"""
+Database backed background jobs.
+
+Slow side effects (completing payments, notification fan-out, QR images) are
+written to the Job table instead of running in the request. The row is
+inserted in the caller's transaction, so a job exists exactly when the work
+that needs it was committed, and no broker is needed: ``manage.py run_jobs``
+polls the table.
+
+Workers claim ready jobs with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+database supports it (Postgres), so any number of workers can share a queue
+without waiting on each other. Elsewhere (SQLite) a job is claimed with a
+conditional UPDATE on its status. Failed jobs are retried with exponential
+backoff up to ``max_attempts``; jobs left running by a crashed worker are put
+back after ``MATWANA_JOB_TIMEOUT`` seconds. Tasks should therefore be safe to
+run more than once.
+
+``MATWANA_JOB_QUEUES`` maps each queue to the number of worker threads
+``run_jobs`` starts for it.
+"""
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUES = {'default': 1}
+DEFAULT_TIMEOUT = 600
+# First retry after RETRY_DELAY, doubling up to MAX_RETRY_DELAY
+RETRY_DELAY = timedelta(seconds=10)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+
+def task(queue='default', max_attempts=3):
+    """Mark a function as a job task. Its arguments must be JSON serialisable."""
+    def decorate(func):
+        func.job_name = f'{func.__module__}.{func.__qualname__}'
+        func.job_queue = queue
+        func.job_max_attempts = max_attempts
+        return func
+    return decorate
+
+
+def queues():
+    return getattr(settings, 'MATWANA_JOB_QUEUES', DEFAULT_QUEUES)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def enqueue(func, *, key=None, queue=None, delay=None, **kwargs):
+    """
+    Add a job calling ``func(**kwargs)``. With a ``key``, enqueueing again
+    returns the job already stored under it instead of adding another.
+    """
+    job = Job(
+        queue=queue or func.job_queue,
+        task=func.job_name,
+        payload=kwargs,
+        idempotency_key=key,
+        max_attempts=func.job_max_attempts,
+        run_at=timezone.now() + (delay or timedelta()),
+    )
+    if key is None:
+        job.save()
+    else:
+        try:
+            with transaction.atomic():
+                job.save()
+        except IntegrityError:
+            return Job.objects.get(idempotency_key=key)
+
+    if getattr(settings, 'MATWANA_JOBS_EAGER', False):
+        transaction.on_commit(lambda: run_now(job.id))
+    return job
+
+
+def _claim_values(worker):
+    return {'status': 'running', 'locked_by': worker, 'locked_at': timezone.now(), 'attempts': F('attempts') + 1}
+
+
+def claim(queue=None, worker=None, limit=1):
+    """Lock up to ``limit`` ready jobs for this worker and return them."""
+    worker = worker or worker_name()
+    ready = Job.objects.filter(status='pending', run_at__lte=timezone.now()).order_by('run_at', 'id')
+    if queue is not None:
+        ready = ready.filter(queue=queue)
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(ready.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            Job.objects.filter(id__in=ids).update(**_claim_values(worker))
+    else:
+        ids = []
+        for job_id in ready.values_list('id', flat=True)[:limit]:
+            # No row locks: whoever flips the status first owns the job
+            if Job.objects.filter(id=job_id, status='pending').update(**_claim_values(worker)):
+                ids.append(job_id)
+    return list(Job.objects.filter(id__in=ids).order_by('run_at', 'id'))
+
+
+def retry_delay(attempts):
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def run(job):
+    """Run a claimed job and record the outcome. Returns True if it succeeded."""
+    owned = Job.objects.filter(id=job.id, status='running', locked_by=job.locked_by)
+    try:
+        func = import_string(job.task)
+        if not hasattr(func, 'job_name'):
+            raise ImportError(f'{job.task} is not a job task')
+        func(**job.payload)
+    except Exception:
+        now = timezone.now()
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            owned.update(status='failed', last_error=error, finished_at=now, locked_by='')
+            logger.exception('Job %s (%s) failed after %s attempts', job.id, job.task, job.attempts)
+        else:
+            owned.update(status='pending', last_error=error, run_at=now + retry_delay(job.attempts), locked_by='')
+            logger.warning('Job %s (%s) failed, attempt %s of %s', job.id, job.task, job.attempts, job.max_attempts)
+        return False
+
+    owned.update(status='done', finished_at=timezone.now(), locked_by='')
+    return True
+
+
+def run_now(job_id):
+    """Claim and run one job in this process (MATWANA_JOBS_EAGER)."""
+    worker = worker_name()
+    if Job.objects.filter(id=job_id, status='pending').update(**_claim_values(worker)):
+        run(Job.objects.get(id=job_id))
+
+
+def run_pending(queue=None, limit=None):
+    """Run ready jobs one at a time until none are left (or ``limit`` have run)."""
+    worker = worker_name()
+    count = 0
+    while limit is None or count < limit:
+        jobs = claim(queue, worker)
+        if not jobs:
+            break
+        run(jobs[0])
+        count += 1
+    return count
+
+
+def release_stale(timeout=None):
+    """Put back jobs whose worker stopped while running them. Returns how many."""
+    timeout = timeout if timeout is not None else getattr(settings, 'MATWANA_JOB_TIMEOUT', DEFAULT_TIMEOUT)
+    stale = Job.objects.filter(status='running', locked_at__lt=timezone.now() - timedelta(seconds=timeout))
+    message = 'Worker stopped while running the job'
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status='failed', last_error=message, finished_at=timezone.now(), locked_by=''
+    )
+    retried = stale.filter(attempts__lt=F('max_attempts')).update(
+        status='pending', last_error=message, run_at=timezone.now(), locked_by=''
+    )
+    return failed + retried
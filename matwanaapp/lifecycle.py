@@ -0,0 +1,147 @@
+# lifecycle.py
+"""
+The trip state machine.
+
+    scheduled -> active -> completed
+        |          |
+        +----------+-----> cancelled
+
+Drivers move their own trips with ``transition``, which records the actual
+departure or arrival time and saves the trip, so the usual Trip signals run.
+
+Everything else is left to ``sweep``, run every minute or so by
+``manage.py sweep_trips``. It advances trips by the clock, one rule at a
+time, with set-based UPDATEs over batches of ids:
+
+* depart:  scheduled trips with a driver whose departure time has come,
+* abandon: scheduled trips with bookings but no driver (the timetable
+  leaves trips driverless when drivers clash), ``EXPIRE_AFTER`` past their
+  departure; every booking is cancelled and refunded first,
+* expire:  scheduled trips nobody drove or booked, ``EXPIRE_AFTER`` past
+  their departure,
+* arrive:  active trips ``ARRIVAL_GRACE`` past their arrival time that have
+  stopped sending positions (or are ``MAX_OVERRUN`` late regardless). The
+  arrival is taken from the last position if there is one, so the travel
+  time estimates (eta.py) only learn from trips that really reported.
+
+``.update()`` sends no signals, so the sweep does their work itself: it
+moves the daily rollup counts, publishes a ``trip`` event per trip and one
+summary event to ``admin``, and drops the live grid and the journey planner
+graph after commit. The rules' filters are covered by partial indexes on the
+scheduled and active trips (migration 0012).
+"""
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Case, F, Q, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import nearby, planner, rollups
+from .booking import cancel_booking
+from .events import publish
+from .models import PassengerTrip, Trip
+
+TRANSITIONS = {
+    'scheduled': ('active', 'cancelled'),
+    'active': ('completed', 'cancelled'),
+    'completed': (),
+    'cancelled': (),
+}
+EXPIRE_AFTER = timedelta(minutes=30)
+ARRIVAL_GRACE = timedelta(minutes=15)
+# An active trip still sending positions is still on the road
+IDLE_AFTER = timedelta(minutes=10)
+MAX_OVERRUN = timedelta(hours=6)
+BATCH_SIZE = 1000
+
+
+class LifecycleError(Exception):
+    """Raised for a transition the state machine does not allow. The message is safe to show."""
+
+
+def transition(trip_id, status, driver_id=None, at=None):
+    """
+    Move one trip to ``status``, recording the actual departure or arrival.
+    With ``driver_id`` only that driver's trip may be moved. Returns the trip.
+    """
+    at = at or timezone.now()
+    with transaction.atomic():
+        trip = Trip.objects.select_for_update().filter(id=trip_id).first()
+        if trip is None or (driver_id is not None and trip.driver_id != driver_id):
+            raise LifecycleError('Trip not found')
+        if status not in TRANSITIONS[trip.status]:
+            raise LifecycleError(f'A {trip.status} trip cannot become {status}')
+        trip.status = status
+        fields = ['status']
+        if status == 'active':
+            trip.actual_departure = at
+            fields.append('actual_departure')
+        elif status == 'completed':
+            trip.actual_arrival = at
+            fields.append('actual_arrival')
+        trip.save(update_fields=fields)
+    return trip
+
+
+def rules(now):
+    """(name, from status, to status, condition, extra changes) in the order they are applied."""
+    return [
+        ('depart', 'scheduled', 'active',
+         Q(scheduled_departure__lte=now, driver__isnull=False),
+         {'actual_departure': Coalesce('actual_departure', 'scheduled_departure')}),
+        ('abandon', 'scheduled', 'cancelled',
+         Q(scheduled_departure__lte=now - EXPIRE_AFTER, driver__isnull=True, seats_booked__gt=0),
+         {}),
+        ('expire', 'scheduled', 'cancelled',
+         Q(scheduled_departure__lte=now - EXPIRE_AFTER, seats_booked=0),
+         {}),
+        ('arrive', 'active', 'completed',
+         Q(scheduled_arrival__lte=now - ARRIVAL_GRACE) & (
+             Q(location_updated_at__isnull=True) | Q(location_updated_at__lte=now - IDLE_AFTER)
+         ) | Q(scheduled_arrival__lte=now - MAX_OVERRUN),
+         {'actual_arrival': Coalesce('actual_arrival', Case(
+             When(location_updated_at__gt=F('actual_departure'), then=F('location_updated_at'))
+         ))}),
+    ]
+
+
+def _apply(name, old, new, condition, changes):
+    """Apply one rule to a batch of trips. Returns how many moved."""
+    with transaction.atomic():
+        trips = Trip.objects.filter(condition, status=old)
+        if connection.features.has_select_for_update_skip_locked:
+            # Another sweeper (or a driver) holding a trip gets it next time
+            trips = trips.select_for_update(skip_locked=True, of=('self',))
+        rows = list(trips.order_by('id').values_list('id', 'scheduled_departure', 'route__sacco_id')[:BATCH_SIZE])
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        if new == 'cancelled':
+            # Passengers get their fares back while the trips can still take cancellations
+            for booking in PassengerTrip.objects.filter(trip_id__in=ids).select_related('trip__route'):
+                cancel_booking(booking)
+        Trip.objects.filter(id__in=ids, status=old).update(status=new, **changes)
+
+        # What the Trip signals would have done
+        rollups.trips_moved([row[1:] for row in rows], old, new)
+        for trip_id in ids:
+            publish(f'trip:{trip_id}', 'trip', trip_id=trip_id, status=new)
+        publish('admin', 'trips', transition=name, status=new, count=len(ids))
+        transaction.on_commit(nearby.invalidate)
+        transaction.on_commit(planner.invalidate)
+    return len(ids)
+
+
+def sweep(now=None):
+    """Advance every trip whose time has come. Returns the number moved by each rule."""
+    now = now or timezone.now()
+    moved = {}
+    for name, old, new, condition, changes in rules(now):
+        moved[name] = 0
+        while True:
+            count = _apply(name, old, new, condition, changes)
+            moved[name] += count
+            if count < BATCH_SIZE:
+                break
+    return moved
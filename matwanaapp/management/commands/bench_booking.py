@@ -0,0 +1,161 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+from django.db.models import Sum
+from django.utils import timezone
+
+from matwanaapp import rollups
+from matwanaapp.booking import book_trip, BookingError
+from matwanaapp.models import User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment
+
+
+class Command(BaseCommand):
+    help = 'Fire concurrent bookings at a single trip and check that no seats are oversold'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=2000, help='Number of booking attempts')
+        parser.add_argument('--capacity', type=int, default=14, help='Seats on the benchmark matatu')
+        parser.add_argument('--workers', type=int, default=32, help='Concurrent worker threads')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark rows afterwards')
+
+    def handle(self, *args, **options):
+        bookings = options['bookings']
+        workers = options['workers']
+        capacity = options['capacity']
+        if bookings < 1 or workers < 1 or capacity < 1:
+            raise CommandError('--bookings, --workers and --capacity must be positive')
+
+        tag = uuid.uuid4().hex[:8].upper()
+        fare = Decimal('100.00')
+        sacco, trip, passengers = self._setup(tag, capacity, fare, bookings)
+
+        # Every passenger fires twice to simulate double taps on the Book button
+        attempts = [p for p in passengers for _ in range(2)][:bookings]
+        chunks = [attempts[i::workers] for i in range(workers)]
+        outcomes = Counter()
+        lock = threading.Lock()
+        barrier = threading.Barrier(workers)
+
+        def worker(chunk):
+            local = Counter()
+            barrier.wait()
+            try:
+                for passenger in chunk:
+                    try:
+                        book_trip(passenger, trip.id)
+                        local['booked'] += 1
+                    except BookingError as e:
+                        local[str(e)] += 1
+                    except OperationalError:
+                        local['database error'] += 1
+            finally:
+                connection.close()
+                with lock:
+                    outcomes.update(local)
+
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        try:
+            self._report(trip, passengers, capacity, fare, outcomes, len(attempts), elapsed)
+        finally:
+            if not options['keep']:
+                User.objects.filter(id__in=[p.id for p in passengers]).delete()
+                sacco.delete()
+            # The passengers were bulk created without rollup signals
+            rollups.rebuild(since=timezone.localdate())
+
+    def _setup(self, tag, capacity, fare, bookings):
+        sacco = Sacco.objects.create(
+            name=f'BENCH-{tag}',
+            registration_number=f'BENCH-{tag}',
+            contact_person='Benchmark',
+            contact_phone='+254700000000',
+            contact_email='bench@example.com',
+            address='Benchmark'
+        )
+        route = Route.objects.create(
+            name=f'Bench Route {tag}',
+            start_point='Town',
+            end_point='Estate',
+            distance_km=10,
+            estimated_duration_minutes=30,
+            standard_fare=fare,
+            sacco=sacco
+        )
+        matatu = Matatu.objects.create(
+            plate_number=f'BENCH{tag}',
+            fleet_number=f'BENCH{tag}',
+            sacco=sacco,
+            capacity=capacity,
+            qr_code_data=f'MATATU:BENCH:{tag}'
+        )
+        departure = timezone.now() + timedelta(hours=1)
+        trip = Trip.objects.create(
+            matatu=matatu,
+            route=route,
+            scheduled_departure=departure,
+            scheduled_arrival=departure + timedelta(minutes=30)
+        )
+
+        # Each passenger can afford exactly one seat
+        seed = int(tag, 16) % 10**6
+        count = (bookings + 1) // 2
+        User.objects.bulk_create([
+            User(
+                email=f'bench{tag.lower()}{i}@example.com',
+                id_number=f'9{seed:06d}{i:06d}',
+                phone_number=f'+2549{seed % 100:02d}{i:06d}',
+                first_name='Bench',
+                last_name=str(i),
+                credits=fare,
+                password='!'
+            )
+            for i in range(count)
+        ], batch_size=500)
+        passengers = list(User.objects.filter(email__startswith=f'bench{tag.lower()}'))
+        return sacco, trip, passengers
+
+    def _report(self, trip, passengers, capacity, fare, outcomes, attempts, elapsed):
+        trip.refresh_from_db()
+        booked_rows = PassengerTrip.objects.filter(trip=trip).count()
+        payment_total = Payment.objects.filter(
+            passenger__in=passengers, payment_type='trip'
+        ).aggregate(total=Sum('amount'))['total'] or 0
+        wallet_total = User.objects.filter(
+            id__in=[p.id for p in passengers]
+        ).aggregate(total=Sum('credits'))['total'] or 0
+
+        self.stdout.write(f'Attempts:       {attempts}')
+        self.stdout.write(f'Elapsed:        {elapsed:.2f}s ({attempts / elapsed:.0f} bookings/s)')
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write(f'  {outcome}: {count}')
+        self.stdout.write(f'Seats booked:   {trip.seats_booked}/{capacity}')
+        self.stdout.write(f'Booking rows:   {booked_rows}')
+
+        problems = []
+        if trip.seats_booked > capacity:
+            problems.append(f'trip oversold: {trip.seats_booked} seats on a {capacity}-seater')
+        if booked_rows != trip.seats_booked:
+            problems.append(f'seat counter {trip.seats_booked} != {booked_rows} booking rows')
+        if booked_rows != outcomes['booked']:
+            problems.append(f'{outcomes["booked"]} successful calls but {booked_rows} booking rows')
+        if payment_total != booked_rows * fare:
+            problems.append(f'payments total {payment_total}, expected {booked_rows * fare}')
+        if wallet_total != len(passengers) * fare - payment_total:
+            problems.append(f'wallets hold {wallet_total}, expected {len(passengers) * fare - payment_total}')
+
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('No seats oversold and every debit has a booking and payment'))
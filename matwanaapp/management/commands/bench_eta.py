@@ -0,0 +1,105 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from matwanaapp import eta, rollups
+from matwanaapp.models import Sacco, Matatu, Route, Trip
+
+
+class Command(BaseCommand):
+    help = 'Measure building, refreshing and querying the learned travel times'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=200, help='Routes to create')
+        parser.add_argument('--history', type=int, default=100000, help='Completed trips to learn from')
+        parser.add_argument('--active', type=int, default=5000, help='Active trips to estimate')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark data afterwards')
+
+    def handle(self, *args, **options):
+        if min(options['routes'], options['history'], options['active']) < 1:
+            raise CommandError('--routes, --history and --active must be positive')
+        if eta.np is None:
+            raise CommandError('The travel time model needs numpy installed')
+
+        # Everything runs in one transaction that is rolled back unless --keep
+        with transaction.atomic():
+            self._bench(options)
+            if not options['keep']:
+                transaction.set_rollback(True)
+        eta.invalidate()
+        if options['keep']:
+            # Trips were bulk created without rollup signals
+            rollups.rebuild(since=timezone.localdate() - timedelta(days=eta.HISTORY_DAYS))
+
+    def _bench(self, options):
+        tag = uuid.uuid4().hex[:8].upper()
+        rng = random.Random(0)
+        sacco = Sacco.objects.create(
+            name=f'BENCH-{tag}',
+            registration_number=f'BENCH-{tag}',
+            contact_person='Benchmark',
+            contact_phone='+254700000000',
+            contact_email='bench@example.com',
+            address='Benchmark'
+        )
+        routes, matatu = self._setup(sacco, tag, options['routes'])
+        now = timezone.now()
+        self._trips(routes, matatu, options['history'], now, rng, completed=True)
+
+        eta.invalidate()
+        started = time.perf_counter()
+        model = eta.get_model()
+        self.stdout.write(f'Full build:         {(time.perf_counter() - started) * 1000:.0f} ms '
+                          f'for {len(model.minutes)} trips on {len(model.route_index)} routes')
+
+        self._trips(routes, matatu, options['history'] // 100, now, rng, completed=True, recent=True)
+        started = time.perf_counter()
+        added = model.refresh()
+        self.stdout.write(f'Refresh:            {(time.perf_counter() - started) * 1000:.0f} ms '
+                          f'for {added} new trips')
+
+        active = self._trips(routes, matatu, options['active'], now, rng, completed=False)
+        active = list(Trip.objects.filter(id__in=[trip.id for trip in active]).select_related('route'))
+        started = time.perf_counter()
+        results = eta.estimates(active)
+        elapsed = (time.perf_counter() - started) * 1000
+        learned = sum(result['source'] == 'history' for result in results)
+        self.stdout.write(f'Estimate:           {elapsed:.1f} ms for {len(active)} active trips '
+                          f'({learned} from history)')
+
+    def _setup(self, sacco, tag, count):
+        Route.objects.bulk_create([
+            Route(name=f'Route {i}', start_point='Town', end_point=f'Stage {i}', distance_km=20,
+                  estimated_duration_minutes=60, standard_fare=Decimal('100.00'), sacco=sacco)
+            for i in range(count)
+        ])
+        matatu = Matatu.objects.create(plate_number=f'E{tag}', fleet_number='1', sacco=sacco, capacity=14,
+                                       qr_code_data=f'MATATU:E{tag}')
+        return list(Route.objects.filter(sacco=sacco)), matatu
+
+    def _trips(self, routes, matatu, count, now, rng, completed, recent=False):
+        trips = []
+        for _ in range(count):
+            if completed:
+                back = timedelta(minutes=rng.randrange(90, 180)) if recent else timedelta(days=rng.uniform(1, 60))
+                departure = now - back
+                minutes = rng.gauss(45 + 30 * (departure.hour in (7, 8, 17, 18)), 8)
+                trips.append(Trip(
+                    matatu=matatu, route=rng.choice(routes), status='completed',
+                    scheduled_departure=departure, scheduled_arrival=departure + timedelta(hours=1),
+                    actual_departure=departure, actual_arrival=departure + timedelta(minutes=max(minutes, 5))
+                ))
+            else:
+                departure = now - timedelta(minutes=rng.randrange(60))
+                trips.append(Trip(
+                    matatu=matatu, route=rng.choice(routes), status='active',
+                    scheduled_departure=departure, scheduled_arrival=departure + timedelta(hours=1),
+                    actual_departure=departure
+                ))
+        return Trip.objects.bulk_create(trips, batch_size=1000)
@@ -0,0 +1,176 @@
+import json
+import statistics
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from matwanaapp import rollups, tracking
+from matwanaapp.models import User, Sacco, Matatu, Route, Trip, TripLocation
+
+
+class Command(BaseCommand):
+    help = 'Measure GPS ingest throughput with many vehicles posting batched 1 Hz pings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vehicles', type=int, default=2000, help='Vehicles on the road')
+        parser.add_argument('--seconds', type=int, default=20, help='Seconds of driving to simulate')
+        parser.add_argument('--batch', type=int, default=10, help='Pings per request (1 per second)')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent client threads')
+        parser.add_argument('--baseline', type=int, default=1000, help='Pings written with Trip.save() for comparison')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark data afterwards')
+
+    def handle(self, *args, **options):
+        if min(options['vehicles'], options['seconds'], options['batch'], options['workers']) < 1:
+            raise CommandError('--vehicles, --seconds, --batch and --workers must be positive')
+
+        tag = uuid.uuid4().hex[:8].upper()
+        sacco, trips, sessions = self._setup(tag, options['vehicles'])
+        try:
+            requests = self._requests(trips, sessions, options['seconds'], options['batch'])
+            self._bench_ingest(requests, options['workers'], trips)
+            self._bench_baseline(trips, options['baseline'])
+        finally:
+            if not options['keep']:
+                TripLocation.objects.filter(trip_id__in=[trip.id for trip in trips]).delete()
+                User.objects.filter(email__startswith=f'gps{tag.lower()}').delete()
+                sacco.delete()
+                Session.objects.filter(session_key__in=sessions).delete()
+            # Users and trips were bulk created without rollup signals
+            rollups.rebuild(since=timezone.localdate())
+
+    def _setup(self, tag, count):
+        sacco = Sacco.objects.create(
+            name=f'BENCH-{tag}',
+            registration_number=f'BENCH-{tag}',
+            contact_person='Benchmark',
+            contact_phone='+254700000000',
+            contact_email='bench@example.com',
+            address='Benchmark'
+        )
+        route = Route.objects.create(
+            name='Bench route', start_point='Town', end_point='Rongai', distance_km=20,
+            estimated_duration_minutes=60, standard_fare=Decimal('100.00'), sacco=sacco
+        )
+        seed = int(tag, 16) % 100
+        User.objects.bulk_create([
+            User(
+                email=f'gps{tag.lower()}{i}@example.com',
+                id_number=f'9{i:08d}',
+                phone_number=f'+2541{seed:02d}{i:06d}',
+                first_name='Driver',
+                last_name=str(i),
+                user_type='driver'
+            )
+            for i in range(count)
+        ], batch_size=1000)
+        drivers = list(User.objects.filter(email__startswith=f'gps{tag.lower()}').order_by('id'))
+        Matatu.objects.bulk_create([
+            Matatu(plate_number=f'G{tag}{i}', fleet_number=str(i), sacco=sacco, capacity=14,
+                   qr_code_data=f'MATATU:G{tag}{i}')
+            for i in range(count)
+        ], batch_size=1000)
+        matatus = list(Matatu.objects.filter(sacco=sacco).order_by('id'))
+        now = timezone.now()
+        Trip.objects.bulk_create([
+            Trip(matatu=matatu, route=route, driver=driver, status='active',
+                 scheduled_departure=now, scheduled_arrival=now + timedelta(hours=1))
+            for matatu, driver in zip(matatus, drivers)
+        ], batch_size=1000)
+        trips = list(Trip.objects.filter(route=route).order_by('id'))
+
+        sessions = []
+        for driver in drivers:
+            session = SessionStore()
+            session['user_id'] = driver.id
+            session['user_type'] = 'driver'
+            session.create()
+            sessions.append(session.session_key)
+        return sacco, trips, sessions
+
+    def _requests(self, trips, sessions, seconds, batch):
+        # Every vehicle drives north at 1 Hz; requests are ordered by when they would be sent
+        start = timezone.now() - timedelta(seconds=seconds)
+        requests = []
+        for first in range(0, seconds, batch):
+            for i, (trip, session_key) in enumerate(zip(trips, sessions)):
+                pings = [
+                    {
+                        'lat': -1.3 + (first + k) * 0.0001,
+                        'lng': 36.8 + i * 0.00001,
+                        'ts': (start + timedelta(seconds=first + k)).timestamp(),
+                        'speed': 30,
+                    }
+                    for k in range(min(batch, seconds - first))
+                ]
+                requests.append((session_key, json.dumps({'trip_id': trip.id, 'pings': pings})))
+        return requests
+
+    def _bench_ingest(self, requests, workers, trips):
+        chunks = [requests[i::workers] for i in range(workers)]
+        latencies = []
+        failures = []
+        lock = threading.Lock()
+        url = reverse('ingest_locations_api')
+
+        def worker(chunk):
+            client = Client(HTTP_HOST='localhost')
+            timings = []
+            try:
+                for session_key, body in chunk:
+                    client.cookies[settings.SESSION_COOKIE_NAME] = session_key
+                    started = time.perf_counter()
+                    response = client.post(url, body, content_type='application/json')
+                    timings.append((time.perf_counter() - started) * 1000)
+                    if not response.json().get('success'):
+                        with lock:
+                            failures.append(response.json().get('message'))
+            finally:
+                connection.close()
+                with lock:
+                    latencies.extend(timings)
+
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        tracking.flush()
+        elapsed = time.perf_counter() - started
+
+        pings = sum(len(json.loads(body)['pings']) for _, body in requests)
+        latencies.sort()
+        self.stdout.write(f'Vehicles:           {len(trips)}, {len(requests)} requests, {pings} pings, {workers} workers')
+        self.stdout.write(f'Ingest:             {pings / elapsed:,.0f} pings/s ({len(requests) / elapsed:,.0f} requests/s)')
+        self.stdout.write(f'Request latency:    p50 {statistics.median(latencies):.1f} ms, '
+                          f'p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f} ms')
+        self.stdout.write(f'Capacity:           ~{pings / elapsed:,.0f} vehicles at 1 Hz on this node')
+        placed = Trip.objects.filter(id__in=[trip.id for trip in trips], location_updated_at__isnull=False).count()
+        self.stdout.write(f'Positions on trips: {placed}/{len(trips)} '
+                          f'(flushed every {getattr(settings, "MATWANA_LOCATION_FLUSH_INTERVAL", tracking.DEFAULT_FLUSH_INTERVAL)} s)')
+        if failures:
+            self.stdout.write(self.style.ERROR(f'{len(failures)} requests rejected, e.g. {failures[0]}'))
+
+    def _bench_baseline(self, trips, count):
+        if count < 1:
+            return
+        # What the ingest replaces: a full Trip.save() per ping
+        started = time.perf_counter()
+        for i in range(count):
+            trip = trips[i % len(trips)]
+            trip.current_location_lat = Decimal('-1.300000')
+            trip.current_location_lng = Decimal('36.800000')
+            trip.save()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Trip.save() per ping: {count / elapsed:,.0f} pings/s (single thread, for comparison)')
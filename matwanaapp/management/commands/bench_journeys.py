@@ -0,0 +1,133 @@
+import random
+import statistics
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from matwanaapp import planner
+from matwanaapp.models import Sacco, Matatu, Route, RouteStop, Trip
+
+
+class Command(BaseCommand):
+    help = 'Measure building the journey planner graph and planning journeys on a metro-sized network'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--places', type=int, default=45, help='The network is a grid of places this many wide')
+        parser.add_argument('--routes', type=int, default=400, help='Routes to create')
+        parser.add_argument('--stops', type=int, default=20, help='Stops per route')
+        parser.add_argument('--trips', type=int, default=30, help='Trips per route over the next day')
+        parser.add_argument('--queries', type=int, default=1000, help='Journeys to plan')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark data afterwards')
+
+    def handle(self, *args, **options):
+        if min(options['places'], options['routes'], options['stops'] - 1, options['trips'], options['queries']) < 1:
+            raise CommandError('--places, --routes, --trips and --queries must be positive and --stops at least 2')
+
+        # Everything runs in one transaction that is rolled back unless --keep
+        with transaction.atomic():
+            self._bench(options)
+            if not options['keep']:
+                transaction.set_rollback(True)
+        planner.invalidate()
+
+    def _bench(self, options):
+        tag = uuid.uuid4().hex[:8].upper()
+        rng = random.Random(0)
+        sacco = Sacco.objects.create(
+            name=f'BENCH-{tag}',
+            registration_number=f'BENCH-{tag}',
+            contact_person='Benchmark',
+            contact_phone='+254700000000',
+            contact_email='bench@example.com',
+            address='Benchmark'
+        )
+        places = self._network(sacco, tag, options, rng)
+
+        planner.invalidate()
+        started = time.perf_counter()
+        graph = planner.get_graph()
+        trips = sum(len(pattern.trips) for pattern in graph.patterns.values())
+        self.stdout.write(f'Graph build:        {(time.perf_counter() - started) * 1000:.0f} ms for '
+                          f'{len(graph.names)} stops, {len(graph.patterns)} routes, {trips} trips')
+
+        now = timezone.now()
+        latencies, found, transfers = [], 0, []
+        for _ in range(options['queries']):
+            origin, destination = rng.sample(places, 2)
+            depart = now + timedelta(minutes=rng.randrange(12 * 60))
+            started = time.perf_counter()
+            legs = graph.plan(origin, destination, depart)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if legs:
+                found += 1
+                transfers.append(len(legs) - 1)
+        latencies.sort()
+        self.stdout.write(f'Plan:               p50 {statistics.median(latencies):.2f} ms, '
+                          f'p95 {latencies[int(len(latencies) * 0.95) - 1]:.2f} ms, '
+                          f'max {latencies[-1]:.2f} ms over {len(latencies)} queries')
+        if transfers:
+            self.stdout.write(f'Journeys found:     {found}/{len(latencies)}, '
+                              f'{statistics.mean(transfers):.1f} changes on average')
+
+        # Incremental updates, as the Trip and Route signals apply them
+        sample = list(Trip.objects.filter(route__sacco=sacco).values_list('id', flat=True)[:200])
+        Trip.objects.filter(id__in=sample).update(scheduled_departure=now + timedelta(hours=1),
+                                                  scheduled_arrival=now + timedelta(hours=2))
+        started = time.perf_counter()
+        for trip_id in sample:
+            planner.trip_changed(trip_id)
+        self.stdout.write(f'Trip update:        {(time.perf_counter() - started) * 1000 / len(sample):.2f} ms each')
+        routes = list(Route.objects.filter(sacco=sacco).values_list('id', flat=True)[:20])
+        started = time.perf_counter()
+        for route_id in routes:
+            planner.route_changed(route_id)
+        self.stdout.write(f'Route update:       {(time.perf_counter() - started) * 1000 / len(routes):.2f} ms each')
+
+    def _network(self, sacco, tag, options, rng):
+        """Routes wandering across a grid of places; a place shared by routes is an interchange."""
+        width = options['places']
+        Route.objects.bulk_create([
+            Route(name=f'Route {i}', start_point='', end_point='', distance_km=options['stops'] * 2,
+                  estimated_duration_minutes=options['stops'] * 4, standard_fare=Decimal('100.00'), sacco=sacco)
+            for i in range(options['routes'])
+        ], batch_size=1000)
+        routes = list(Route.objects.filter(sacco=sacco).order_by('id'))
+
+        stops, used = [], set()
+        for route in routes:
+            x, y = rng.randrange(width), rng.randrange(width)
+            dx, dy = rng.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+            path = []
+            for _ in range(options['stops']):
+                path.append(f'{tag} {x}-{y}')
+                # Mostly straight on, sometimes a turn
+                if rng.random() < 0.3:
+                    dx, dy = dy, dx
+                x, y = (x + dx) % width, (y + dy) % width
+            if len(set(path)) < len(path):
+                path = list(dict.fromkeys(path))
+            route.start_point, route.end_point = path[0], path[-1]
+            stops.extend(
+                RouteStop(route=route, name=name, sequence=i, distance_km=Decimal(2 * i))
+                for i, name in enumerate(path)
+            )
+            used.update(path)
+        Route.objects.bulk_update(routes, ['start_point', 'end_point'], batch_size=1000)
+        RouteStop.objects.bulk_create(stops, batch_size=1000)
+
+        matatu = Matatu.objects.create(plate_number=f'J{tag}', fleet_number='1', sacco=sacco, capacity=14,
+                                       qr_code_data=f'MATATU:J{tag}')
+        now = timezone.now()
+        trips = []
+        for route in routes:
+            for i in range(options['trips']):
+                departure = now + timedelta(minutes=i * 24 * 60 // options['trips'] + rng.randrange(20))
+                trips.append(Trip(matatu=matatu, route=route, scheduled_departure=departure,
+                                  scheduled_arrival=departure + timedelta(minutes=route.estimated_duration_minutes)))
+        Trip.objects.bulk_create(trips, batch_size=1000)
+        return sorted(used)
@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+import uuid
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from matwanaapp import rollups
+from matwanaapp.forms import LoginForm
+from matwanaapp.models import User
+
+PASSWORD = 'bench-password'
+
+
+class Command(BaseCommand):
+    help = 'Measure login lookup cost and end-to-end login throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Accounts to create')
+        parser.add_argument('--lookups', type=int, default=5000, help='Lookups per strategy')
+        parser.add_argument('--logins', type=int, default=200, help='Full logins through the view')
+        parser.add_argument('--workers', type=int, default=4, help='Concurrent login threads')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark accounts afterwards')
+
+    def handle(self, *args, **options):
+        if min(options['users'], options['lookups'], options['logins'], options['workers']) < 1:
+            raise CommandError('--users, --lookups, --logins and --workers must be positive')
+
+        tag = uuid.uuid4().hex[:8].upper()
+        users = self._setup(tag, options['users'])
+        try:
+            rng = random.Random(0)
+            identifiers = [self._identifier(rng.choice(users), rng) for _ in range(options['lookups'])]
+            self._bench_lookups(identifiers)
+            self._bench_logins(identifiers[:options['logins']], options['workers'])
+        finally:
+            if not options['keep']:
+                User.objects.filter(id__in=[u.id for u in users]).delete()
+            # The accounts were bulk created without rollup signals
+            rollups.rebuild(since=timezone.localdate())
+
+    def _setup(self, tag, count):
+        seed = int(tag, 16) % 100
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(
+                email=f'login{tag.lower()}{i}@example.com',
+                id_number=f'8{i:08d}',
+                phone_number=f'+2547{seed:02d}{i:06d}',
+                first_name='Bench',
+                last_name=str(i),
+                password=password
+            )
+            for i in range(count)
+        ], batch_size=1000)
+        return list(User.objects.filter(email__startswith=f'login{tag.lower()}'))
+
+    def _identifier(self, user, rng):
+        # Mix the forms people actually type
+        kind = rng.randrange(4)
+        if kind == 0:
+            return user.id_number
+        if kind == 1:
+            return user.email
+        if kind == 2:
+            return '0' + user.phone_number[4:]
+        return user.phone_number
+
+    def _bench_lookups(self, identifiers):
+        started = time.perf_counter()
+        for value in identifiers:
+            User.objects.filter(Q(id_number=value) | Q(email=value) | Q(phone_number=value)).first()
+        three_way = time.perf_counter() - started
+
+        started = time.perf_counter()
+        found = 0
+        for value in identifiers:
+            form = LoginForm({'username': value, 'password': PASSWORD})
+            form.is_valid()
+            found += form.get_user() is not None
+        classified = time.perf_counter() - started
+
+        n = len(identifiers)
+        self.stdout.write(f'Lookups:            {n}')
+        self.stdout.write(f'Three-way OR:       {three_way / n * 1e6:.0f} us/lookup')
+        self.stdout.write(f'Classified lookup:  {classified / n * 1e6:.0f} us/lookup ({found}/{n} found)')
+        if found != n:
+            self.stdout.write(self.style.ERROR('Some identifiers did not resolve to an account'))
+
+    def _bench_logins(self, identifiers, workers):
+        chunks = [identifiers[i::workers] for i in range(workers)]
+        failures = []
+        lock = threading.Lock()
+        url = reverse('login')
+
+        def worker(chunk):
+            client = Client(HTTP_HOST='localhost')
+            try:
+                for value in chunk:
+                    response = client.post(url, {'username': value, 'password': PASSWORD})
+                    client.cookies.clear()  # log out again
+                    if response.status_code != 302:
+                        with lock:
+                            failures.append(value)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        n = len(identifiers)
+        self.stdout.write(f'Logins:             {n} with {workers} workers')
+        self.stdout.write(f'Throughput:         {n / elapsed:.1f} logins/s (includes password hashing)')
+        if failures:
+            self.stdout.write(self.style.ERROR(f'{len(failures)} logins failed'))
+        else:
+            self.stdout.write(self.style.SUCCESS('All logins succeeded'))
@@ -0,0 +1,169 @@
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection
+from django.db.models import Count
+from django.test import override_settings
+from django.utils import timezone
+
+from matwanaapp import ids, payments, rollups, wallet
+from matwanaapp.models import User, Payment, CreditEntry
+from matwanaapp.mpesa_simulator import DarajaSimulator
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Run M-Pesa top-ups end to end against the Daraja simulator and check every one settles exactly once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topups', type=int, default=1000, help='Top-ups to request')
+        parser.add_argument('--workers', type=int, default=16, help='Threads sending STK pushes')
+        parser.add_argument('--callback-workers', type=int, default=32, help='Concurrent callbacks from the simulator')
+        parser.add_argument('--delay', type=float, default=1.0, help='Seconds before the simulator calls back')
+        parser.add_argument('--fail-rate', type=float, default=0.1)
+        parser.add_argument('--drop-rate', type=float, default=0.05)
+        parser.add_argument('--duplicate-rate', type=float, default=0.1)
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark rows afterwards')
+
+    def handle(self, *args, **options):
+        topups, workers = options['topups'], options['workers']
+        if topups < 1 or workers < 1 or options['callback_workers'] < 1:
+            raise CommandError('--topups, --workers and --callback-workers must be positive')
+
+        tag = uuid.uuid4().hex[:8].upper()
+        simulator = DarajaSimulator(
+            consumer_key='bench', consumer_secret='bench', passkey='bench', delay=options['delay'],
+            fail_rate=options['fail_rate'], drop_rate=options['drop_rate'],
+            duplicate_rate=options['duplicate_rate'], callback_workers=options['callback_workers'], seed=0,
+        )
+        # The app itself, to receive the callbacks over HTTP
+        app = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler)
+        app.set_app(WSGIHandler())
+        threading.Thread(target=app.serve_forever, daemon=True).start()
+        config = {
+            'BASE_URL': simulator.start(),
+            'CONSUMER_KEY': 'bench',
+            'CONSUMER_SECRET': 'bench',
+            'SHORTCODE': simulator.shortcode,
+            'PASSKEY': 'bench',
+            'CALLBACK_URL': f'http://127.0.0.1:{app.server_address[1]}/api/payments/mpesa/callback/{tag}/',
+            'CALLBACK_TOKEN': tag,
+        }
+
+        users = self._setup(tag, topups)
+        try:
+            with override_settings(MATWANA_MPESA=config):
+                self._bench(simulator, users, workers, options)
+        finally:
+            simulator.stop()
+            app.shutdown()
+            app.server_close()
+            if not options['keep']:
+                User.objects.filter(id__in=users).delete()
+            # Users and payments were bulk created without rollup signals
+            rollups.rebuild(since=timezone.localdate())
+
+    def _setup(self, tag, topups):
+        seed = int(tag, 16) % 10**6
+        User.objects.bulk_create([
+            User(
+                email=f'mpesa{tag.lower()}{i}@example.com',
+                id_number=f'7{seed:06d}{i:06d}',
+                phone_number=f'+2547{seed % 100:02d}{i:06d}',
+                first_name='Bench',
+                last_name=str(i),
+                password='!'
+            )
+            for i in range(topups)
+        ], batch_size=500)
+        users = list(User.objects.filter(email__startswith=f'mpesa{tag.lower()}').values_list('id', flat=True))
+        Payment.objects.bulk_create([
+            Payment(passenger_id=user_id, payment_type='credit_topup', amount=Decimal('200.00'),
+                    transaction_id=ids.transaction_id('PAY'), payment_method='mpesa')
+            for user_id in users
+        ], batch_size=500)
+        return users
+
+    def _bench(self, simulator, users, workers, options):
+        pending = list(Payment.objects.filter(passenger_id__in=users).values_list('id', flat=True))
+        chunks = [pending[i::workers] for i in range(workers)]
+        outcomes = Counter()
+        lock = threading.Lock()
+
+        def worker(chunk):
+            local = Counter()
+            try:
+                for payment_id in chunk:
+                    try:
+                        payments.request_topup(payment_id)
+                        local['pushed'] += 1
+                    except payments.PaymentError as e:
+                        local[str(e)] += 1
+            finally:
+                connection.close()
+                with lock:
+                    outcomes.update(local)
+
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pushed = time.perf_counter() - started
+
+        # Wait for the callback burst to drain
+        while simulator.pending_callbacks():
+            time.sleep(0.1)
+        drained = time.perf_counter() - started
+        after_callbacks = Counter(dict(
+            Payment.objects.filter(passenger_id__in=users).values_list('status').annotate(n=Count('id'))
+        ))
+
+        # The dropped callbacks are found by asking
+        reconciled = payments.reconcile(timezone.now() + payments.RECONCILE_AFTER)
+
+        latencies = sorted(seconds * 1000 for seconds in simulator.callback_seconds)
+        self.stdout.write(f'STK pushes:     {outcomes["pushed"]}/{len(pending)} in {pushed:.2f}s '
+                          f'({len(pending) / pushed:.0f}/s)')
+        for outcome, count in sorted(outcomes.items()):
+            if outcome != 'pushed':
+                self.stdout.write(f'  {outcome}: {count}')
+        self.stdout.write(f'Callbacks:      {simulator.stats["callbacks"]} delivered '
+                          f'({simulator.stats["callback errors"]} errors, {simulator.stats["callbacks lost"]} lost), '
+                          f'all done {drained:.2f}s after the first push')
+        if latencies:
+            self.stdout.write(f'Callback time:  p50 {statistics.median(latencies):.1f} ms, '
+                              f'p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f} ms, max {latencies[-1]:.1f} ms')
+        self.stdout.write(f'After callbacks: {dict(after_callbacks)}')
+        self.stdout.write(f'Reconciled:     {reconciled}')
+
+        statuses = Counter(dict(
+            Payment.objects.filter(passenger_id__in=users).values_list('status').annotate(n=Count('id'))
+        ))
+        entries = CreditEntry.objects.filter(user_id__in=users)
+        problems = []
+        if statuses['pending']:
+            problems.append(f'{statuses["pending"]} top-ups still pending')
+        if statuses['completed'] != simulator.stats['paid']:
+            problems.append(f'{statuses["completed"]} completed but the simulator took {simulator.stats["paid"]} payments')
+        if entries.count() != statuses['completed']:
+            problems.append(f'{entries.count()} ledger entries for {statuses["completed"]} completed top-ups')
+        if list(wallet.drifted(users)):
+            problems.append('wallets disagree with their ledger')
+
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('Every top-up settled once, duplicates ignored, wallets match the ledger'))
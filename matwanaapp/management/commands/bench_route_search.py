@@ -0,0 +1,110 @@
+import random
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from matwanaapp import search
+from matwanaapp.models import Sacco, Route
+
+STAGES = [
+    'Kencom', 'Westlands', 'Rongai', 'Kitengela', 'Githurai', 'Kahawa', 'Ruiru', 'Thika',
+    'Kikuyu', 'Kawangware', 'Kibera', 'Karen', 'Ngong', 'Embakasi', 'Donholm', 'Umoja',
+    'Kayole', 'Eastleigh', 'Parklands', 'Kasarani', 'Roysambu', 'Zimmerman', 'Lavington',
+    'Kilimani', 'Langata', 'Madaraka', 'Syokimau', 'Mlolongo', 'Athi River', 'Juja',
+]
+
+
+def misspell(word, rng):
+    # Drop one letter from the middle of the word
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1:]
+
+
+class Command(BaseCommand):
+    help = 'Measure route search latency against the icontains scan it replaced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--routes', type=int, default=10000, help='Routes to create')
+        parser.add_argument('--queries', type=int, default=500, help='Queries per strategy')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark routes afterwards')
+
+    def handle(self, *args, **options):
+        if options['routes'] < 1 or options['queries'] < 1:
+            raise CommandError('--routes and --queries must be positive')
+
+        tag = uuid.uuid4().hex[:8].upper()
+        rng = random.Random(0)
+        sacco = Sacco.objects.create(
+            name=f'BENCH-{tag}',
+            registration_number=f'BENCH-{tag}',
+            contact_person='Benchmark',
+            contact_phone='+254700000000',
+            contact_email='bench@example.com',
+            address='Benchmark'
+        )
+        try:
+            Route.objects.bulk_create([
+                Route(
+                    name=f'Route {i}',
+                    start_point=rng.choice(STAGES),
+                    end_point=f'{rng.choice(STAGES)} Stage {i % 97}',
+                    distance_km=10,
+                    estimated_duration_minutes=30,
+                    standard_fare=Decimal('100.00'),
+                    sacco=sacco
+                )
+                for i in range(options['routes'])
+            ], batch_size=1000)
+            # bulk_create skips the signals that refresh the index
+            search.invalidate()
+
+            started = time.perf_counter()
+            index = search.get_index()
+            self.stdout.write(f'Index build:    {(time.perf_counter() - started) * 1000:.0f} ms '
+                              f'for {len(index)} routes')
+
+            queries = [rng.choice(STAGES) for _ in range(options['queries'])]
+            self._report('icontains scan', queries, self._icontains)
+            self._report('search index', queries, lambda q: search.search_route_ids(q, limit=10))
+            self._report('prefix', [q[:3] for q in queries], lambda q: search.search_route_ids(q, limit=10))
+
+            typos = [(misspell(q, rng), q) for q in queries]
+            self._report('typo', [typo for typo, _ in typos], lambda q: search.search_route_ids(q, limit=10))
+            self._recall(typos)
+        finally:
+            if not options['keep']:
+                sacco.delete()
+            search.invalidate()
+
+    def _icontains(self, query):
+        return list(Route.objects.filter(
+            Q(name__icontains=query) |
+            Q(start_point__icontains=query) |
+            Q(end_point__icontains=query) |
+            Q(sacco__name__icontains=query),
+            is_active=True
+        ).values_list('id', flat=True)[:10])
+
+    def _report(self, label, queries, run):
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            run(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+        self.stdout.write(f'{label + ":":<16}p50 {statistics.median(timings):.2f} ms, p95 {p95:.2f} ms')
+
+    def _recall(self, typos):
+        hits = 0
+        for typo, intended in typos:
+            route_ids = search.search_route_ids(typo, limit=10)
+            names = Route.objects.filter(id__in=route_ids).values_list('start_point', 'end_point')
+            hits += any(intended in start or intended in end for start, end in names)
+        self.stdout.write(f'Typo recall:    {hits}/{len(typos)} misspelt queries found the intended stage')
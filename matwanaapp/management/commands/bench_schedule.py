@@ -0,0 +1,86 @@
+import random
+import time
+import uuid
+from datetime import time as clock, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from matwanaapp import planner, scheduling
+from matwanaapp.models import User, Sacco, Matatu, Route, Headway, Trip
+
+# (start, end, minutes between departures)
+BANDS = [(clock(5, 30), clock(9, 0), 5), (clock(9, 0), clock(16, 0), 12), (clock(16, 0), clock(21, 0), 6)]
+
+
+class Command(BaseCommand):
+    help = 'Measure generating a month of trips for a large sacco from its headways'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vehicles', type=int, default=500, help='Matatus in the sacco, each with a driver')
+        parser.add_argument('--routes', type=int, default=30, help='Routes with headways')
+        parser.add_argument('--days', type=int, default=30, help='Days to schedule')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark data afterwards')
+
+    def handle(self, *args, **options):
+        if min(options['vehicles'], options['routes'], options['days']) < 1:
+            raise CommandError('--vehicles, --routes and --days must be positive')
+
+        # Everything runs in one transaction that is rolled back unless --keep
+        with transaction.atomic():
+            self._bench(options)
+            if not options['keep']:
+                transaction.set_rollback(True)
+        planner.invalidate()
+
+    def _bench(self, options):
+        tag = uuid.uuid4().hex[:8].upper()
+        rng = random.Random(0)
+        sacco = Sacco.objects.create(
+            name=f'BENCH-{tag}',
+            registration_number=f'BENCH-{tag}',
+            contact_person='Benchmark',
+            contact_phone='+254700000000',
+            contact_email='bench@example.com',
+            address='Benchmark'
+        )
+        seed = int(tag, 16) % 100
+        User.objects.bulk_create([
+            User(email=f'sched{tag.lower()}{i}@example.com', id_number=f'8{i:08d}', phone_number=f'+2542{seed:02d}{i:06d}',
+                 first_name='Driver', last_name=str(i), user_type='driver')
+            for i in range(options['vehicles'])
+        ], batch_size=1000)
+        drivers = list(User.objects.filter(email__startswith=f'sched{tag.lower()}').values_list('id', flat=True))
+        Matatu.objects.bulk_create([
+            Matatu(plate_number=f'S{tag}{i}', fleet_number=str(i), sacco=sacco, capacity=14,
+                   qr_code_data=f'MATATU:S{tag}{i}', current_driver_id=driver_id)
+            for i, driver_id in enumerate(drivers)
+        ], batch_size=1000)
+        Route.objects.bulk_create([
+            Route(name=f'Route {i}', start_point='Town', end_point=f'Stage {i}', distance_km=20,
+                  estimated_duration_minutes=rng.randrange(30, 75), standard_fare=Decimal('100.00'), sacco=sacco)
+            for i in range(options['routes'])
+        ])
+        Headway.objects.bulk_create([
+            Headway(route=route, start_time=start, end_time=end, minutes=minutes)
+            for route in Route.objects.filter(sacco=sacco)
+            for start, end, minutes in BANDS
+        ])
+
+        first_day = timezone.localdate() + timedelta(days=1)
+        started = time.perf_counter()
+        result = scheduling.generate(sacco, first_day, options['days'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Generate:           {elapsed:.2f} s for {options["days"]} days, {options["vehicles"]} matatus: '
+                          f'{result["created"]} trips ({result["created"] / elapsed:,.0f}/s), '
+                          f'{result["unassigned"]} without a matatu')
+
+        started = time.perf_counter()
+        again = scheduling.generate(sacco, first_day, options['days'])
+        self.stdout.write(f'Rerun:              {time.perf_counter() - started:.2f} s, {again["created"]} created, '
+                          f'{again["existing"]} already there')
+
+        busiest = Trip.objects.filter(route__sacco=sacco, scheduled_departure__date=first_day).count()
+        self.stdout.write(f'First day:          {busiest} trips, {busiest / options["vehicles"]:.1f} per matatu')
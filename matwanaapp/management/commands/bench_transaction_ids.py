@@ -0,0 +1,56 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import ids
+
+
+def _generate(args):
+    count, prefix = args
+    started = time.perf_counter()
+    made = [ids.transaction_id(prefix) for _ in range(count)]
+    return made, time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Generate transaction ids from many processes at once and check none collide'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8, help='Worker processes')
+        parser.add_argument('--ids', type=int, default=250000, help='Ids per process')
+        parser.add_argument('--start-method', choices=multiprocessing.get_all_start_methods(),
+                            help='How workers are started (default: the platform default)')
+
+    def handle(self, *args, **options):
+        processes, count = options['processes'], options['ids']
+        if processes < 1 or count < 1:
+            raise CommandError('--processes and --ids must be positive')
+
+        # Every worker uses the same prefix so only the ULID part can keep them apart
+        context = multiprocessing.get_context(options['start_method'])
+        started = time.perf_counter()
+        with context.Pool(processes) as pool:
+            results = pool.map(_generate, [(count, 'PAY')] * processes)
+        elapsed = time.perf_counter() - started
+
+        problems = []
+        seen = set()
+        for i, (made, _) in enumerate(results):
+            if made != sorted(made):
+                problems.append(f'process {i} made ids out of order')
+            seen.update(made)
+        total = processes * count
+        duplicates = total - len(seen)
+        if duplicates:
+            problems.append(f'{duplicates} duplicate ids')
+
+        fastest = min(seconds for _, seconds in results)
+        self.stdout.write(f'Ids:            {total} from {processes} processes ({context.get_start_method()})')
+        self.stdout.write(f'Elapsed:        {elapsed:.2f}s, {total / elapsed:,.0f} ids/s overall')
+        self.stdout.write(f'Per process:    {count / fastest:,.0f} ids/s at best')
+        self.stdout.write(f'Duplicates:     {duplicates}')
+
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('Every id is unique and each process made them in order'))
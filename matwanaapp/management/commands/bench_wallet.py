@@ -0,0 +1,141 @@
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from matwanaapp import rollups, wallet
+from matwanaapp.models import User, CreditEntry
+
+
+class Command(BaseCommand):
+    help = 'Fire concurrent top-ups, debits and replays at a few wallets and check the ledger adds up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=5000, help='Number of wallet posts')
+        parser.add_argument('--wallets', type=int, default=20, help='Wallets to spread them over (fewer means more contention)')
+        parser.add_argument('--workers', type=int, default=32, help='Concurrent worker threads')
+        parser.add_argument('--replays', type=float, default=0.1, help='Share of posts that repeat an earlier key')
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark rows afterwards')
+
+    def handle(self, *args, **options):
+        posts, workers, wallets = options['posts'], options['workers'], options['wallets']
+        if posts < 1 or workers < 1 or wallets < 1 or not 0 <= options['replays'] < 1:
+            raise CommandError('--posts, --wallets and --workers must be positive and --replays in [0, 1)')
+
+        tag = uuid.uuid4().hex[:8].upper()
+        users = self._setup(tag, wallets)
+        plan = self._plan(tag, users, posts, options['replays'])
+
+        chunks = [plan[i::workers] for i in range(workers)]
+        outcomes = Counter()
+        latencies = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(workers)
+
+        def worker(chunk):
+            local, timings = Counter(), []
+            barrier.wait()
+            try:
+                for user_id, amount, key in chunk:
+                    started = time.perf_counter()
+                    try:
+                        _, created = wallet.post(user_id, amount, 'adjustment', key=key)
+                        local['posted' if created else 'replayed'] += 1
+                    except wallet.WalletError as e:
+                        local[str(e)] += 1
+                    except OperationalError:
+                        local['database error'] += 1
+                    timings.append((time.perf_counter() - started) * 1000)
+            finally:
+                connection.close()
+                with lock:
+                    outcomes.update(local)
+                    latencies.extend(timings)
+
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        try:
+            self._report(users, outcomes, sorted(latencies), len(plan), elapsed)
+        finally:
+            if not options['keep']:
+                User.objects.filter(id__in=users).delete()
+            # The wallets were bulk created without rollup signals
+            rollups.rebuild(since=timezone.localdate())
+
+    def _setup(self, tag, wallets):
+        seed = int(tag, 16) % 10**6
+        User.objects.bulk_create([
+            User(
+                email=f'wallet{tag.lower()}{i}@example.com',
+                id_number=f'8{seed:06d}{i:06d}',
+                phone_number=f'+2548{seed % 100:02d}{i:06d}',
+                first_name='Bench',
+                last_name=str(i),
+                password='!'
+            )
+            for i in range(wallets)
+        ], batch_size=500)
+        users = list(User.objects.filter(email__startswith=f'wallet{tag.lower()}').values_list('id', flat=True))
+        for user_id in users:
+            wallet.post(user_id, Decimal('500.00'), 'opening', key=f'bench:{tag}:opening:{user_id}')
+        return users
+
+    def _plan(self, tag, users, posts, replays):
+        """(wallet, amount, key) posts; debits outnumber top-ups so some run out of credit."""
+        rng = random.Random(0)
+        plan = []
+        for i in range(posts):
+            if plan and rng.random() < replays:
+                plan.append(rng.choice(plan))
+                continue
+            amount = Decimal(rng.choice((50, 100, 200)))
+            plan.append((rng.choice(users), amount if rng.random() < 0.4 else -amount, f'bench:{tag}:{i}'))
+        rng.shuffle(plan)
+        return plan
+
+    def _report(self, users, outcomes, latencies, posts, elapsed):
+        entries = CreditEntry.objects.filter(user_id__in=users)
+        duplicate_keys = entries.values('idempotency_key').annotate(n=Count('id')).filter(n__gt=1).count()
+        ledger_total = entries.aggregate(total=Sum('amount'))['total'] or 0
+        balance_total = User.objects.filter(id__in=users).aggregate(total=Sum('credits'))['total'] or 0
+        negative = User.objects.filter(id__in=users, credits__lt=0).count()
+        drifted = list(wallet.drifted(users))
+
+        self.stdout.write(f'Posts:          {posts} over {len(users)} wallets')
+        self.stdout.write(f'Elapsed:        {elapsed:.2f}s ({posts / elapsed:.0f} posts/s)')
+        self.stdout.write(f'Latency:        p50 {statistics.median(latencies):.1f} ms, '
+                          f'p95 {latencies[int(len(latencies) * 0.95) - 1]:.1f} ms, max {latencies[-1]:.1f} ms')
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write(f'  {outcome}: {count}')
+        self.stdout.write(f'Ledger total:   {ledger_total} in {entries.count()} entries')
+        self.stdout.write(f'Balance total:  {balance_total}')
+
+        problems = []
+        if duplicate_keys:
+            problems.append(f'{duplicate_keys} keys posted more than once')
+        if negative:
+            problems.append(f'{negative} wallets overdrawn')
+        if drifted:
+            problems.append(f'{len(drifted)} wallets disagree with their ledger')
+        if ledger_total != balance_total:
+            problems.append(f'balances total {balance_total}, ledger {ledger_total}')
+        if entries.count() != outcomes['posted'] + len(users):
+            problems.append(f'{outcomes["posted"]} successful posts but {entries.count() - len(users)} entries')
+
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('Every post applied once and every balance matches its ledger'))
@@ -0,0 +1,61 @@
+import sys
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import exports
+
+
+class Command(BaseCommand):
+    help = 'Stream payments, trips or users to a CSV or Parquet file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(exports.DATASETS))
+        parser.add_argument('--format', default='csv', choices=sorted(exports.FORMATS))
+        parser.add_argument('--output', default='-', help='File to write (default: standard output)')
+        parser.add_argument('--batch-size', type=int, default=exports.BATCH_SIZE, help='Rows read per query')
+        parser.add_argument('--status')
+        parser.add_argument('--payment-type')
+        parser.add_argument('--user-type')
+        parser.add_argument('--sacco', help='Sacco id (trips)')
+        parser.add_argument('--search', help='Name, email, phone or id number (users)')
+        parser.add_argument('--date-from', help='YYYY-MM-DD')
+        parser.add_argument('--date-to', help='YYYY-MM-DD')
+        parser.add_argument('--memory', action='store_true', help='Report the peak Python memory used')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        params = {
+            name: options[name]
+            for name in ('status', 'payment_type', 'user_type', 'sacco', 'search', 'date_from', 'date_to')
+            if options[name]
+        }
+        if options['memory']:
+            tracemalloc.start()
+
+        started = time.perf_counter()
+        written = 0
+        try:
+            chunks = exports.export(options['dataset'], params, options['format'], options['batch_size'])
+            out = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+            try:
+                for chunk in chunks:
+                    out.write(chunk)
+                    written += len(chunk)
+            finally:
+                if out is not sys.stdout.buffer:
+                    out.close()
+                else:
+                    out.flush()
+        except exports.ExportError as e:
+            raise CommandError(str(e))
+
+        seconds = time.perf_counter() - started
+        summary = f'Exported {options["dataset"]}: {written / 1024:.0f} KiB in {seconds:.2f}s'
+        if options['memory']:
+            summary += f', peak memory {tracemalloc.get_traced_memory()[1] / 1024:.0f} KiB'
+            tracemalloc.stop()
+        # Keep standard output for the data
+        self.stderr.write(self.style.SUCCESS(summary))
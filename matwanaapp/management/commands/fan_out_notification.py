@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp.models import Notification
+from matwanaapp.notifications import fan_out, FAN_OUT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Write a delivery row for every user a notification is addressed to, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('notification_id', type=int)
+        parser.add_argument('--batch-size', type=int, default=FAN_OUT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        try:
+            notification = Notification.objects.get(id=options['notification_id'])
+        except Notification.DoesNotExist:
+            raise CommandError(f"Notification {options['notification_id']} does not exist")
+
+        visited = fan_out(notification, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Delivered "{notification.title}" to {visited} users ({notification.get_audience_display()})'
+        ))
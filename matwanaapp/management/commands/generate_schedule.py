@@ -0,0 +1,38 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from matwanaapp import scheduling
+from matwanaapp.models import Sacco
+
+
+class Command(BaseCommand):
+    help = "Create trips from the routes' headways, assigning matatus and drivers without double booking"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sacco', type=int, action='append', help='Sacco id (repeatable, default all active saccos)')
+        parser.add_argument('--start', help='First day to schedule (YYYY-MM-DD, default tomorrow)')
+        parser.add_argument('--days', type=int, default=7, help='Days to schedule')
+        parser.add_argument('--turnaround', type=int, default=scheduling.TURNAROUND_MINUTES,
+                            help='Minutes a matatu rests between trips')
+
+    def handle(self, *args, **options):
+        start = timezone.localdate() + timedelta(days=1)
+        if options['start']:
+            try:
+                start = date.fromisoformat(options['start'])
+            except ValueError:
+                raise CommandError('--start must be a date in the format YYYY-MM-DD')
+        if options['days'] < 1 or options['turnaround'] < 0:
+            raise CommandError('--days must be positive and --turnaround must not be negative')
+
+        saccos = Sacco.objects.filter(is_active=True)
+        if options['sacco']:
+            saccos = Sacco.objects.filter(id__in=options['sacco'])
+        for sacco in saccos:
+            result = scheduling.generate(sacco, start, options['days'], turnaround=options['turnaround'])
+            message = (f"{sacco.name}: {result['created']} trips created, {result['existing']} already scheduled, "
+                       f"{result['unassigned']} without a free matatu")
+            style = self.style.WARNING if result['unassigned'] else self.style.SUCCESS
+            self.stdout.write(style(message))
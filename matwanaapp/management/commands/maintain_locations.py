@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import tracking
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming location history partitions and drop history past the retention window'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=2, help='Days of partitions to create ahead (Postgres)')
+        parser.add_argument('--keep-days', type=int, help='Days of history to keep (default MATWANA_LOCATION_RETENTION_DAYS)')
+
+    def handle(self, *args, **options):
+        if options['ahead'] < 0 or (options['keep_days'] is not None and options['keep_days'] < 1):
+            raise CommandError('--ahead must not be negative and --keep-days must be positive')
+
+        created = tracking.ensure_partitions(options['ahead'])
+        removed = tracking.prune(options['keep_days'])
+        self.stdout.write(f"Partitions ready: {', '.join(created) or 'none (not Postgres)'}")
+        self.stdout.write(self.style.SUCCESS(f"Removed: {', '.join(removed) or 'nothing'}"))
@@ -0,0 +1,45 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp.mpesa_simulator import DarajaSimulator
+
+
+class Command(BaseCommand):
+    help = 'Serve a local Daraja (M-Pesa STK push) simulator so top-ups can be tried offline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--delay', type=float, default=2.0, help='Seconds before the customer "answers" a push')
+        parser.add_argument('--fail-rate', type=float, default=0.1, help='Share of pushes the customer cancels')
+        parser.add_argument('--drop-rate', type=float, default=0.05, help='Share of results never called back')
+        parser.add_argument('--duplicate-rate', type=float, default=0.05, help='Share of results called back twice')
+
+    def handle(self, *args, **options):
+        for name in ('fail_rate', 'drop_rate', 'duplicate_rate'):
+            if not 0 <= options[name] <= 1:
+                raise CommandError('Rates must be between 0 and 1')
+        config = settings.MATWANA_MPESA
+        simulator = DarajaSimulator(
+            consumer_key=config['CONSUMER_KEY'],
+            consumer_secret=config['CONSUMER_SECRET'],
+            shortcode=config['SHORTCODE'],
+            passkey=config['PASSKEY'],
+            delay=options['delay'],
+            fail_rate=options['fail_rate'],
+            drop_rate=options['drop_rate'],
+            duplicate_rate=options['duplicate_rate'],
+            verbose=True,
+        )
+        url = simulator.start(options['host'], options['port'])
+        self.stdout.write(f'Daraja simulator on {url}; run the app with MPESA_BASE_URL={url}')
+        if not config['CALLBACK_URL']:
+            self.stdout.write('Set MPESA_CALLBACK_URL and MPESA_CALLBACK_TOKEN so results reach the app')
+        try:
+            while True:
+                time.sleep(60)
+                self.stdout.write(', '.join(f'{name} {count}' for name, count in sorted(simulator.stats.items())))
+        except KeyboardInterrupt:
+            simulator.stop()
@@ -0,0 +1,24 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import rollups
+
+
+class Command(BaseCommand):
+    help = 'Backfill the daily payment, registration and trip rollups from the source tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only rebuild days on or after this date (YYYY-MM-DD)')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError('--since must be a date in the format YYYY-MM-DD')
+
+        rollups.rebuild(since)
+        scope = f'from {since}' if since else 'for all days'
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt daily rollups {scope}'))
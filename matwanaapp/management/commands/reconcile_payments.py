@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import payments
+
+
+class Command(BaseCommand):
+    help = 'Settle top-ups whose provider callback never arrived, and fail the ones pending too long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help='Keep reconciling, this many seconds apart')
+
+    def handle(self, *args, **options):
+        every = options['every']
+        if every is not None and every <= 0:
+            raise CommandError('--every must be positive')
+
+        while True:
+            counts = payments.reconcile()
+            self.stdout.write(self.style.SUCCESS(
+                f"Settled {counts['settled']}, expired {counts['expired']}, still pending {counts['pending']}"
+            ))
+            if every is None:
+                return
+            try:
+                time.sleep(every)
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from matwanaapp.models import PassengerTrip, Trip, TripSegment
+
+
+class Command(BaseCommand):
+    help = 'Recount bookings per trip (and per segment on routes with stops) and fix any drift in the seat counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        # Trips without segments: one counter, one seat per booking
+        drifted = Trip.objects.exclude(
+            Exists(TripSegment.objects.filter(trip_id=OuterRef('pk')))
+        ).annotate(
+            booked=Count('passengers')
+        ).exclude(
+            booked=F('seats_booked')
+        ).values_list('id', 'seats_booked', 'booked')
+
+        fixed = 0
+        for trip_id, counter, booked in drifted.iterator():
+            self.stdout.write(f'Trip {trip_id}: counter says {counter}, {booked} bookings')
+            if not dry_run:
+                # Only overwrite if nothing moved since we counted
+                fixed += Trip.objects.filter(id=trip_id, seats_booked=counter).update(seats_booked=booked)
+
+        # Trips with segments: each segment counts the bookings riding over it
+        # (ones without stops ride all of it), and the trip counts its busiest segment
+        on_board = PassengerTrip.objects.filter(trip_id=OuterRef('trip_id')).filter(
+            Q(boarding_index__isnull=True) |
+            Q(boarding_index__lte=OuterRef('index'), alighting_index__gt=OuterRef('index'))
+        ).order_by().values('trip_id').annotate(n=Count('id')).values('n')
+        segment_trips = set(TripSegment.objects.annotate(
+            booked=Coalesce(Subquery(on_board), 0)
+        ).exclude(
+            booked=F('seats_booked')
+        ).values_list('trip_id', flat=True))
+        segment_trips.update(Trip.objects.annotate(
+            peak=Max('segments__seats_booked')
+        ).filter(
+            peak__isnull=False
+        ).exclude(
+            peak=F('seats_booked')
+        ).values_list('id', flat=True))
+
+        for trip_id in sorted(segment_trips):
+            fixed += self.recount_segments(trip_id, dry_run)
+
+        if dry_run:
+            self.stdout.write('Dry run, nothing changed')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Reconciled {fixed} trip(s)'))
+
+    def recount_segments(self, trip_id, dry_run):
+        with transaction.atomic():
+            # The lock bookings on segments take, so none land while we count
+            counter = Trip.objects.select_for_update().filter(id=trip_id).values_list('seats_booked', flat=True).first()
+            if counter is None:
+                return 0
+            counted = dict(TripSegment.objects.filter(trip_id=trip_id).values_list('index', 'seats_booked'))
+            booked = dict.fromkeys(counted, 0)
+            for first, last in PassengerTrip.objects.filter(trip_id=trip_id).values_list('boarding_index', 'alighting_index'):
+                for index in booked:
+                    if first is None or first <= index < last:
+                        booked[index] += 1
+            peak = max(booked.values(), default=0)
+
+            wrong = [index for index in sorted(booked) if booked[index] != counted[index]]
+            self.stdout.write(
+                f'Trip {trip_id}: counter says {counter}, busiest segment has {peak} bookings'
+                + ''.join(f'; segment {i} says {counted[i]}, {booked[i]} bookings' for i in wrong)
+            )
+            if dry_run:
+                return 0
+            for index in wrong:
+                TripSegment.objects.filter(trip_id=trip_id, index=index).update(seats_booked=booked[index])
+            Trip.objects.filter(id=trip_id).update(seats_booked=peak)
+        return 1
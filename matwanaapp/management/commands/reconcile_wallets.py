@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from matwanaapp import wallet
+
+
+class Command(BaseCommand):
+    help = 'Add up the credit ledger and fix any drift in User.credits'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without fixing it')
+
+    def handle(self, *args, **options):
+        rows = wallet.reconcile(fix=not options['dry_run'])
+        for user_id, credits, ledger in rows:
+            self.stdout.write(f'User {user_id}: balance says {credits}, ledger adds up to {ledger}')
+
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing changed')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Reconciled {len(rows)} wallet(s)'))
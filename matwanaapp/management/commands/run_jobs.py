@@ -0,0 +1,70 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from matwanaapp import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs from the database job queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', action='append', dest='queues',
+                            help='Queue to work on (repeatable; default: every queue in MATWANA_JOB_QUEUES)')
+        parser.add_argument('--concurrency', type=int, help='Threads per queue, overriding MATWANA_JOB_QUEUES')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to sleep when a queue is empty')
+        parser.add_argument('--once', action='store_true', help='Run the ready jobs and exit')
+
+    def handle(self, *args, **options):
+        configured = jobs.queues()
+        names = options['queues'] or list(configured)
+        if options['concurrency'] is not None and options['concurrency'] < 1:
+            raise CommandError('--concurrency must be positive')
+        if options['poll'] <= 0:
+            raise CommandError('--poll must be positive')
+
+        jobs.release_stale()
+        if options['once']:
+            ran = sum(jobs.run_pending(queue) for queue in names)
+            self.stdout.write(self.style.SUCCESS(f'Ran {ran} jobs'))
+            return
+
+        stop = threading.Event()
+        threads = []
+        for queue in names:
+            for _ in range(options['concurrency'] or configured.get(queue, 1)):
+                thread = threading.Thread(target=self._work, args=(queue, options['poll'], stop), daemon=True)
+                thread.start()
+                threads.append(thread)
+        self.stdout.write(f'Working on {", ".join(names)} with {len(threads)} threads')
+
+        try:
+            while True:
+                time.sleep(options['poll'] * 30)
+                released = jobs.release_stale()
+                if released:
+                    self.stdout.write(f'Put back {released} stale jobs')
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping after the running jobs finish')
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _work(self, queue, poll, stop):
+        worker = jobs.worker_name()
+        try:
+            while not stop.is_set():
+                try:
+                    claimed = jobs.claim(queue, worker)
+                except Exception as e:
+                    # e.g. the database is briefly unavailable; try again after a pause
+                    self.stderr.write(f'Could not claim a job from {queue}: {e}')
+                    claimed = []
+                if not claimed:
+                    stop.wait(poll)
+                    continue
+                jobs.run(claimed[0])
+        finally:
+            connection.close()
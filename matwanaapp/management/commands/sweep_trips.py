@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from matwanaapp import lifecycle
+
+
+class Command(BaseCommand):
+    help = 'Depart, cancel and complete trips whose scheduled times have passed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help='Keep sweeping, this many seconds apart')
+
+    def handle(self, *args, **options):
+        every = options['every']
+        if every is not None and every <= 0:
+            raise CommandError('--every must be positive')
+
+        while True:
+            moved = lifecycle.sweep()
+            self.stdout.write(self.style.SUCCESS(
+                f"Departed {moved['depart']}, cancelled {moved['abandon']} driverless and expired {moved['expire']}, "
+                f"completed {moved['arrive']}"
+            ))
+            if every is None:
+                return
+            try:
+                time.sleep(every)
+            except KeyboardInterrupt:
+                return
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:11
+
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_seats_booked(apps, schema_editor):
+    Trip = apps.get_model('matwanaapp', 'Trip')
+    for trip in Trip.objects.annotate(booked=Count('passengers')).filter(booked__gt=0):
+        Trip.objects.filter(id=trip.id).update(seats_booked=trip.booked)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='seats_booked',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_seats_booked, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='user',
+            name='phone_number',
+            field=models.CharField(max_length=15, unique=True, validators=[django.core.validators.RegexValidator('^\\+254\\d{9}$', 'Phone must be in the format +254XXXXXXXXX')]),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_payment_sacco(apps, schema_editor):
+    # Trip payments are keyed TRIP<booking id>
+    Payment = apps.get_model('matwanaapp', 'Payment')
+    PassengerTrip = apps.get_model('matwanaapp', 'PassengerTrip')
+    for payment in Payment.objects.filter(payment_type='trip', transaction_id__startswith='TRIP').iterator():
+        booking_id = payment.transaction_id[4:]
+        if not booking_id.isdigit():
+            continue
+        sacco_id = PassengerTrip.objects.filter(id=int(booking_id)).values_list(
+            'trip__route__sacco_id', flat=True
+        ).first()
+        if sacco_id:
+            Payment.objects.filter(id=payment.id).update(sacco_id=sacco_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0002_trip_seats_booked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='sacco',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to='matwanaapp.sacco'),
+        ),
+        migrations.CreateModel(
+            name='RegistrationDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('user_type', models.CharField(choices=[('passenger', 'Passenger'), ('conductor', 'Conductor'), ('driver', 'Driver'), ('sacco_admin', 'Sacco Admin'), ('super_admin', 'Super Admin')], max_length=20)),
+                ('user_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('day', 'user_type')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('failed', 'Failed'), ('refunded', 'Refunded')], max_length=20)),
+                ('payment_type', models.CharField(choices=[('trip', 'Trip Payment'), ('credit_topup', 'Credit Top-up'), ('refund', 'Refund')], max_length=20)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('payment_count', models.IntegerField(default=0)),
+                ('sacco', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='matwanaapp.sacco')),
+            ],
+            options={
+                'unique_together': {('day', 'sacco', 'status', 'payment_type')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TripDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('scheduled', 'Scheduled'), ('active', 'Active'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('trip_count', models.IntegerField(default=0)),
+                ('sacco', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='matwanaapp.sacco')),
+            ],
+            options={
+                'unique_together': {('day', 'sacco', 'status')},
+            },
+        ),
+        migrations.RunPython(backfill_payment_sacco, migrations.RunPython.noop),
+    ]
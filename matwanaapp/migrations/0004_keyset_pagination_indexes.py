@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('matwanaapp', '0003_daily_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='matatu',
+            index=models.Index(fields=['-registration_date', '-id'], name='matatu_reg_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['-created_at', '-id'], name='notif_created_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['-created_at', '-id'], name='payment_created_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['-scheduled_departure', '-id'], name='trip_departure_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['-date_joined', '-id'], name='user_joined_keyset_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations
+
+# (index name, table, column) for the pg_trgm route search in search.py
+TRIGRAM_INDEXES = [
+    ('route_name_trgm_idx', 'matwanaapp_route', 'name'),
+    ('route_start_trgm_idx', 'matwanaapp_route', 'start_point'),
+    ('route_end_trgm_idx', 'matwanaapp_route', 'end_point'),
+    ('sacco_name_trgm_idx', 'matwanaapp_sacco', 'name'),
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # Other databases use the in-memory index instead
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0004_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
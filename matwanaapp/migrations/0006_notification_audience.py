@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_audience(apps, schema_editor):
+    # Dashboards showed notifications without recipients to everyone
+    Notification = apps.get_model('matwanaapp', 'Notification')
+    Notification.objects.filter(recipients__isnull=False).update(audience='specific')
+    Notification.objects.filter(
+        recipients__isnull=True, saccos__isnull=False
+    ).update(audience='saccos')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0005_route_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('delivered_at', models.DateTimeField(auto_now_add=True)),
+                ('is_read', models.BooleanField(default=False)),
+                ('read_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='audience',
+            field=models.CharField(choices=[('all', 'All users'), ('saccos', 'Members of selected saccos'), ('specific', 'Specific users')], default='all', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['audience', '-created_at'], name='notif_audience_idx'),
+        ),
+        migrations.AddField(
+            model_name='usernotification',
+            name='notification',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='matwanaapp.notification'),
+        ),
+        migrations.AddField(
+            model_name='usernotification',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='usernotification',
+            unique_together={('user', 'notification')},
+        ),
+        migrations.RunPython(backfill_audience, migrations.RunPython.noop),
+    ]
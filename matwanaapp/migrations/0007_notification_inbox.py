@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:30
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_unread_counts(apps, schema_editor):
+    User = apps.get_model('matwanaapp', 'User')
+    UserNotification = apps.get_model('matwanaapp', 'UserNotification')
+    unread = UserNotification.objects.filter(is_read=False).values('user_id').annotate(n=Count('id')).order_by()
+    for row in unread:
+        User.objects.filter(id=row['user_id']).update(unread_notifications=row['n'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0006_notification_audience'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='usernotification',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='inbox_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usernotification',
+            index=models.Index(fields=['user', 'is_read'], name='inbox_user_unread_idx'),
+        ),
+        migrations.RunPython(backfill_unread_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+TABLE = 'matwanaapp_triplocation'
+
+
+def partition_by_day(apps, schema_editor):
+    # Other databases keep the plain table and prune it with DELETE
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # Rebuild the (still empty) table as a partitioned one. The primary key
+    # has to include the partition column; daily partitions are created ahead
+    # of time by tracking.ensure_partitions(), anything else lands in DEFAULT.
+    schema_editor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_template')
+    schema_editor.execute('ALTER INDEX triploc_trip_time_idx RENAME TO triploc_trip_time_template_idx')
+    schema_editor.execute(
+        f'CREATE TABLE {TABLE} (LIKE {TABLE}_template INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING CONSTRAINTS) '
+        f'PARTITION BY RANGE (recorded_at)'
+    )
+    schema_editor.execute(f'DROP TABLE {TABLE}_template')
+    schema_editor.execute(f'ALTER TABLE {TABLE} ADD PRIMARY KEY (id, recorded_at)')
+    schema_editor.execute(f'CREATE INDEX triploc_trip_time_idx ON {TABLE} (trip_id, recorded_at)')
+    schema_editor.execute(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0008_background_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='location_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='TripLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('speed_kmh', models.FloatField(blank=True, null=True)),
+                ('heading', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('recorded_at', models.DateTimeField()),
+                ('trip', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='locations', to='matwanaapp.trip')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trip', 'recorded_at'], name='triploc_trip_time_idx')],
+            },
+        ),
+        migrations.RunPython(partition_by_day, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0009_trip_location_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='passengertrip',
+            name='alighting_index',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='passengertrip',
+            name='boarding_index',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RouteStop',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('sequence', models.PositiveSmallIntegerField()),
+                ('distance_km', models.DecimalField(decimal_places=2, max_digits=6)),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stops', to='matwanaapp.route')),
+            ],
+            options={
+                'ordering': ['route', 'sequence'],
+                'unique_together': {('route', 'sequence')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TripSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('seats_booked', models.PositiveIntegerField(default=0)),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='matwanaapp.trip')),
+            ],
+            options={
+                'unique_together': {('trip', 'index')},
+            },
+        ),
+    ]
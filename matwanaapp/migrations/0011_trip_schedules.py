@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0010_route_stops_and_segments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Headway',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('days', models.CharField(default='0123456', max_length=7)),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('minutes', models.PositiveSmallIntegerField()),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+            options={
+                'ordering': ['route', 'start_time'],
+            },
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='generated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddConstraint(
+            model_name='trip',
+            constraint=models.UniqueConstraint(condition=models.Q(('generated', True)), fields=('route', 'scheduled_departure'), name='trip_generated_slot_unique'),
+        ),
+        migrations.AddField(
+            model_name='headway',
+            name='route',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='headways', to='matwanaapp.route'),
+        ),
+        migrations.AddConstraint(
+            model_name='headway',
+            constraint=models.CheckConstraint(condition=models.Q(('end_time__gt', models.F('start_time'))), name='headway_band_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='headway',
+            constraint=models.CheckConstraint(condition=models.Q(('minutes__gt', 0)), name='headway_minutes_positive'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0011_trip_schedules'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(condition=models.Q(('status', 'scheduled')), fields=['route', 'scheduled_departure'], name='trip_scheduled_route_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(condition=models.Q(('status', 'scheduled')), fields=['scheduled_departure'], name='trip_scheduled_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(condition=models.Q(('status', 'active')), fields=['scheduled_arrival'], name='trip_active_arrival_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def open_ledgers(apps, schema_editor):
+    # Balances from before the ledger become each wallet's first entry
+    User = apps.get_model('matwanaapp', 'User')
+    CreditEntry = apps.get_model('matwanaapp', 'CreditEntry')
+    CreditEntry.objects.bulk_create((
+        CreditEntry(user_id=user_id, kind='opening', amount=credits, balance_after=credits,
+                    idempotency_key=f'opening:{user_id}')
+        for user_id, credits in User.objects.exclude(credits=0).values_list('id', 'credits').iterator()
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0012_trip_lifecycle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CreditEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening Balance'), ('topup', 'Top-up'), ('trip', 'Trip Payment'), ('refund', 'Refund'), ('adjustment', 'Adjustment')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('balance_after', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('idempotency_key', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='credit_entries', to='matwanaapp.payment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credit_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-id'], name='credit_user_entries_idx')],
+            },
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
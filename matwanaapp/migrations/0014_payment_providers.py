@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0013_credit_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='provider_reference',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='receipt_number',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='payment_pending_idx'),
+        ),
+    ]
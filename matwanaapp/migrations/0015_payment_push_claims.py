@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0014_payment_providers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='provider_phone',
+            field=models.CharField(blank=True, max_length=15),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='provider_requested_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ProviderCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reference', models.CharField(max_length=64, unique=True)),
+                ('success', models.BooleanField()),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('phone', models.CharField(blank=True, max_length=15)),
+                ('receipt_number', models.CharField(blank=True, max_length=32)),
+                ('reason', models.CharField(blank=True, max_length=255)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='matwanaapp.payment')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('payment__isnull', True)), fields=['received_at'], name='callback_unmatched_idx')],
+            },
+        ),
+    ]
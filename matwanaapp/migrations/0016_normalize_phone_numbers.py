@@ -0,0 +1,36 @@
+from django.db import migrations
+
+
+def normalize_phone(value):
+    # A copy of forms.normalize_phone as it was when this migration was written
+    digits = ''.join(filter(str.isdigit, value))
+    if len(digits) == 10 and digits.startswith('0'):
+        digits = '254' + digits[1:]
+    elif len(digits) == 9 and digits[0] in '17':
+        digits = '254' + digits
+    if len(digits) == 12 and digits.startswith('254'):
+        return f'+{digits}'
+    return None
+
+
+def normalize_phone_numbers(apps, schema_editor):
+    """Store phone numbers admins typed as 07... in the +254... form login looks up."""
+    User = apps.get_model('matwanaapp', 'User')
+    taken = set(User.objects.values_list('phone_number', flat=True))
+    for user_id, phone in User.objects.exclude(phone_number__regex=r'^\+254[0-9]{9}$').values_list('id', 'phone_number'):
+        normalized = normalize_phone(phone)
+        # Left as they are: numbers that aren't Kenyan mobiles, or whose normal form another account has
+        if normalized and normalized not in taken:
+            User.objects.filter(id=user_id).update(phone_number=normalized)
+            taken.add(normalized)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matwanaapp', '0015_payment_push_claims'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_phone_numbers, migrations.RunPython.noop),
+    ]
@@ -55,6 +55,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     date_joined = models.DateTimeField(auto_now_add=True)
     last_login = models.DateTimeField(null=True, blank=True)
     credits = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    # Unread rows in the notification inbox, kept up to date by notifications.py
+    unread_notifications = models.PositiveIntegerField(default=0)
 
     is_staff = models.BooleanField(default=False) 
     is_active = models.BooleanField(default=True)
@@ -66,6 +68,10 @@ class User(AbstractBaseUser, PermissionsMixin):
     
     class Meta:
         ordering = ['-date_joined']
+        indexes = [
+            # Keyset pagination in admin_manage_users
+            models.Index(fields=['-date_joined', '-id'], name='user_joined_keyset_idx'),
+        ]
     
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
@@ -121,6 +127,11 @@ class Matatu(models.Model):
         related_name='assigned_matatu_as_conductor'  # Added unique related_name
     )
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['-registration_date', '-id'], name='matatu_reg_keyset_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.plate_number} - {self.fleet_number}"
 
@@ -140,6 +151,47 @@ class Route(models.Model):
     def __str__(self):
         return f"{self.name} ({self.start_point} to {self.end_point})"
 
+class RouteStop(models.Model):
+    """
+    A stop on a route, in travel order from its start point (sequence 0) to
+    its end point. Fares between stops are derived in fares.py.
+    """
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='stops')
+    name = models.CharField(max_length=255)
+    sequence = models.PositiveSmallIntegerField()
+    # Along the route from its start point
+    distance_km = models.DecimalField(max_digits=6, decimal_places=2)
+    
+    class Meta:
+        ordering = ['route', 'sequence']
+        unique_together = ['route', 'sequence']
+    
+    def __str__(self):
+        return f"{self.route.name}: {self.name}"
+
+class Headway(models.Model):
+    """
+    How often a route runs during a band of the day, e.g. every 10 minutes
+    from 06:00 to 09:00 on weekdays. scheduling.py turns these into trips.
+    """
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='headways')
+    # Days of the week the band applies to, Monday = 0
+    days = models.CharField(max_length=7, default='0123456')
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    minutes = models.PositiveSmallIntegerField()
+    is_active = models.BooleanField(default=True)
+    
+    class Meta:
+        ordering = ['route', 'start_time']
+        constraints = [
+            models.CheckConstraint(condition=models.Q(end_time__gt=models.F('start_time')), name='headway_band_order'),
+            models.CheckConstraint(condition=models.Q(minutes__gt=0), name='headway_minutes_positive'),
+        ]
+    
+    def __str__(self):
+        return f"{self.route.name}: every {self.minutes} min {self.start_time:%H:%M}-{self.end_time:%H:%M}"
+
 class Trip(models.Model):
     TRIP_STATUS = [
         ('scheduled', 'Scheduled'),
@@ -171,10 +223,41 @@ class Trip(models.Model):
     status = models.CharField(max_length=20, choices=TRIP_STATUS, default='scheduled')
     current_location_lat = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     current_location_lng = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    # Device time of the position above; written by tracking.py at a bounded rate
+    location_updated_at = models.DateTimeField(null=True, blank=True)
+    # Seat counter, only ever changed with conditional UPDATEs (see booking.py).
+    # With stops it is the busiest segment's count, i.e. seats for the whole ride.
+    seats_booked = models.PositiveIntegerField(default=0)
+    # Created from the route's headways by scheduling.py
+    generated = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['-scheduled_departure', '-id'], name='trip_departure_keyset_idx'),
+            # The hot status queries: upcoming trips of a route, and the lifecycle sweep (lifecycle.py)
+            models.Index(fields=['route', 'scheduled_departure'], condition=models.Q(status='scheduled'),
+                         name='trip_scheduled_route_idx'),
+            models.Index(fields=['scheduled_departure'], condition=models.Q(status='scheduled'),
+                         name='trip_scheduled_departure_idx'),
+            models.Index(fields=['scheduled_arrival'], condition=models.Q(status='active'),
+                         name='trip_active_arrival_idx'),
+        ]
+        constraints = [
+            # Makes generating a timetable again a no-op for the slots already filled
+            models.UniqueConstraint(fields=['route', 'scheduled_departure'], condition=models.Q(generated=True),
+                                    name='trip_generated_slot_unique'),
+        ]
+    
     def __str__(self):
         return f"{self.matatu.plate_number} - {self.route.name} ({self.scheduled_departure.date()})"
+    
+    @property
+    def seats_available(self):
+        # No extra query as long as matatu is select_related
+        if not self.matatu_id:
+            return 0
+        return max(self.matatu.capacity - self.seats_booked, 0)
 
 class PassengerTrip(models.Model):
     PAYMENT_METHODS = [
@@ -188,6 +271,9 @@ class PassengerTrip(models.Model):
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='passengers')
     boarding_stop = models.CharField(max_length=255)
     alighting_stop = models.CharField(max_length=255)
+    # Stop positions the seat is held between; null for the whole route
+    boarding_index = models.PositiveSmallIntegerField(null=True, blank=True)
+    alighting_index = models.PositiveSmallIntegerField(null=True, blank=True)
     fare_paid = models.DecimalField(max_digits=6, decimal_places=2)
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHODS)
     payment_reference = models.CharField(max_length=255, blank=True)
@@ -204,6 +290,39 @@ class PassengerTrip(models.Model):
     def __str__(self):
         return f"{self.passenger} - {self.trip}"
 
+class TripSegment(models.Model):
+    """
+    Seats taken between stop ``index`` and the next one on a trip whose route
+    has stops, so a seat given up mid-route can be sold again (see booking.py).
+    """
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='segments')
+    index = models.PositiveSmallIntegerField()
+    seats_booked = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['trip', 'index']
+
+class TripLocation(models.Model):
+    """
+    Append-only GPS history, written in batches by tracking.py. On Postgres
+    the table is range partitioned by day on recorded_at (migration 0009).
+    """
+    # No FK constraint: the history outlives trips and inserts skip the lookup
+    trip = models.ForeignKey(Trip, on_delete=models.DO_NOTHING, db_constraint=False, related_name='locations')
+    latitude = models.DecimalField(max_digits=9, decimal_places=6)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6)
+    speed_kmh = models.FloatField(null=True, blank=True)
+    heading = models.PositiveSmallIntegerField(null=True, blank=True)
+    recorded_at = models.DateTimeField()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['trip', 'recorded_at'], name='triploc_trip_time_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Trip {self.trip_id} @ {self.recorded_at}: {self.latitude}, {self.longitude}"
+
 class Payment(models.Model):
     PAYMENT_TYPES = [
         ('trip', 'Trip Payment'),
@@ -219,18 +338,86 @@ class Payment(models.Model):
     ]
     
     passenger = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments', limit_choices_to={'user_type': 'passenger'})
+    # Set for trip payments and refunds so revenue can be reported per sacco
+    sacco = models.ForeignKey('Sacco', on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
     payment_type = models.CharField(max_length=20, choices=PAYMENT_TYPES)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     transaction_id = models.CharField(max_length=255, unique=True)
     payment_method = models.CharField(max_length=20)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     description = models.TextField(blank=True)
+    # The provider's id for the request (M-Pesa CheckoutRequestID) and its receipt; see payments.py
+    provider_reference = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    receipt_number = models.CharField(max_length=32, blank=True)
+    # When the request went to the provider and the phone it prompted; set before sending, so it is never sent twice
+    provider_requested_at = models.DateTimeField(null=True, blank=True)
+    provider_phone = models.CharField(max_length=15, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='payment_created_keyset_idx'),
+            # Stuck top-ups for the reconciliation (payments.reconcile)
+            models.Index(fields=['created_at'], condition=models.Q(status='pending'), name='payment_pending_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.passenger} - {self.amount} - {self.status}"
 
+class ProviderCallback(models.Model):
+    """
+    A provider result that matched no payment when it arrived, kept until
+    payments.reconcile finds the payment it belongs to.
+    """
+    reference = models.CharField(max_length=64, unique=True)
+    success = models.BooleanField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    phone = models.CharField(max_length=15, blank=True)
+    receipt_number = models.CharField(max_length=32, blank=True)
+    reason = models.CharField(max_length=255, blank=True)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    received_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['received_at'], condition=models.Q(payment__isnull=True), name='callback_unmatched_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.reference} ({'matched' if self.payment_id else 'unmatched'})"
+
+class CreditEntry(models.Model):
+    """
+    Append-only wallet ledger; User.credits is the running balance it adds
+    up to. Written only by wallet.post (see wallet.py).
+    """
+    KINDS = [
+        ('opening', 'Opening Balance'),
+        ('topup', 'Top-up'),
+        ('trip', 'Trip Payment'),
+        ('refund', 'Refund'),
+        ('adjustment', 'Adjustment'),
+    ]
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='credit_entries')
+    kind = models.CharField(max_length=20, choices=KINDS)
+    # Signed: credits are positive, debits negative
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name='credit_entries')
+    # Posting the same key twice returns the existing entry
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-id'], name='credit_user_entries_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} {self.kind} {self.amount} -> {self.balance_after}"
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = [
         ('price_change', 'Price Change'),
@@ -243,12 +430,120 @@ class Notification(models.Model):
     message = models.TextField()
     notification_type = models.CharField(max_length=20, choices=NOTIFICATION_TYPES)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, limit_choices_to={'user_type__in': ['super_admin', 'sacco_admin']})
+    AUDIENCES = [
+        ('all', 'All users'),
+        ('saccos', 'Members of selected saccos'),
+        ('specific', 'Specific users'),
+    ]
+    
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    # Who sees it is resolved when notifications are read (notifications.py),
+    # so broadcasts don't write a row per user when they are sent
+    audience = models.CharField(max_length=10, choices=AUDIENCES, default='all')
     
     # Many-to-many for targeted notifications
     recipients = models.ManyToManyField(User, related_name='notifications', blank=True)
     saccos = models.ManyToManyField(Sacco, blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='notif_created_keyset_idx'),
+            models.Index(fields=['audience', '-created_at'], name='notif_audience_idx'),
+        ]
+    
+    def __str__(self):
+        return self.title
+
+class UserNotification(models.Model):
+    """Per-user delivery and read state, written lazily or by notifications.fan_out()"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox')
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE, related_name='deliveries')
+    created_at = models.DateTimeField()  # copied from the notification for ordering
+    delivered_at = models.DateTimeField(auto_now_add=True)
+    is_read = models.BooleanField(default=False)
+    read_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        unique_together = ['user', 'notification']
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='inbox_user_created_idx'),
+            models.Index(fields=['user', 'is_read'], name='inbox_user_unread_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.notification} -> {self.user}"
+
+class Job(models.Model):
+    """A unit of background work, claimed and run by manage.py run_jobs (see jobs.py)"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
+    queue = models.CharField(max_length=50, default='default')
+    task = models.CharField(max_length=255)  # dotted path of a @jobs.task function
+    payload = models.JSONField(default=dict, blank=True)
+    # Enqueueing the same key twice returns the existing job
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # Workers only ever scan the ready jobs of one queue
+            models.Index(fields=['queue', 'run_at', 'id'], condition=models.Q(status='pending'), name='job_ready_idx'),
+            models.Index(fields=['status', 'locked_at'], name='job_status_locked_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.task} [{self.queue}] {self.status}"
+
+# Daily rollups, maintained incrementally by rollups.py and rebuilt by the
+# rebuild_rollups command. Always read them with Sum(): a bucket may be split
+# over more than one row.
+class PaymentDailyRollup(models.Model):
+    day = models.DateField()
+    sacco = models.ForeignKey(Sacco, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=20, choices=Payment.STATUS_CHOICES)
+    payment_type = models.CharField(max_length=20, choices=Payment.PAYMENT_TYPES)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payment_count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['day', 'sacco', 'status', 'payment_type']
+    
+    def __str__(self):
+        return f"{self.day} {self.payment_type}/{self.status}: {self.total_amount} ({self.payment_count})"
+
+class RegistrationDailyRollup(models.Model):
+    day = models.DateField()
+    user_type = models.CharField(max_length=20, choices=User.USER_TYPES)
+    user_count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['day', 'user_type']
+    
+    def __str__(self):
+        return f"{self.day} {self.user_type}: {self.user_count}"
+
+class TripDailyRollup(models.Model):
+    day = models.DateField()
+    sacco = models.ForeignKey(Sacco, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=20, choices=Trip.TRIP_STATUS)
+    trip_count = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['day', 'sacco', 'status']
+    
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return f"{self.day} {self.status}: {self.trip_count}"
@@ -0,0 +1,268 @@
+# mpesa_simulator.py
+"""
+A local stand-in for Safaricom's Daraja API, enough of it for STK push:
+
+    GET  /oauth/v1/generate?grant_type=client_credentials
+    POST /mpesa/stkpush/v1/processrequest
+    POST /mpesa/stkpushquery/v1/query
+
+Requests are checked the way Daraja checks them (access token, password
+made from the shortcode, passkey and timestamp) and answered with Daraja's
+field names and error codes. Each accepted push is decided up front: the
+customer pays, or cancels with ``fail_rate``. After ``delay`` seconds the
+result is posted to the push's CallBackURL, except that ``drop_rate`` of
+callbacks are never sent (so only a query finds them) and
+``duplicate_rate`` are sent twice. A callback that does not get a 2xx
+answer is retried a few times, as M-Pesa does.
+
+``manage.py mpesa_simulator`` serves it; ``manage.py bench_mpesa`` runs one
+in-process against the app to load test the callback path.
+"""
+import base64
+import heapq
+import json
+import random
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+CANCELLED = (1032, 'Request cancelled by user')
+CALLBACK_ATTEMPTS = 3
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = 'DarajaSimulator/1.0'
+
+    def log_message(self, format, *args):
+        if self.server.simulator.verbose:
+            super().log_message(format, *args)
+
+    def _answer(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != '/oauth/v1/generate' or parse_qs(url.query).get('grant_type') != ['client_credentials']:
+            return self._answer(404, {'errorCode': '404.001.01', 'errorMessage': 'Resource not found'})
+        self._answer(*self.server.simulator.token(self.headers.get('Authorization', '')))
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        if not simulator.authorised(self.headers.get('Authorization', '')):
+            return self._answer(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+        except ValueError:
+            return self._answer(400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid JSON'})
+        if self.path == '/mpesa/stkpush/v1/processrequest':
+            return self._answer(*simulator.push(body))
+        if self.path == '/mpesa/stkpushquery/v1/query':
+            return self._answer(*simulator.query(body))
+        self._answer(404, {'errorCode': '404.001.01', 'errorMessage': 'Resource not found'})
+
+
+class DarajaSimulator:
+
+    def __init__(self, consumer_key='', consumer_secret='', shortcode='174379', passkey='', delay=2.0,
+                 fail_rate=0.1, drop_rate=0.05, duplicate_rate=0.05, callback_workers=16, seed=None, verbose=False):
+        self.credentials = f'{consumer_key}:{consumer_secret}'
+        self.shortcode = str(shortcode)
+        self.passkey = passkey
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.duplicate_rate = duplicate_rate
+        self.verbose = verbose
+        self.rng = random.Random(seed)
+        self.tokens = set()
+        self.pushes = {}  # CheckoutRequestID -> push
+        self.stats = Counter()
+        self.callback_seconds = []
+        self._lock = threading.Lock()
+        self._due = []  # (time, CheckoutRequestID)
+        self._wake = threading.Condition(self._lock)
+        self._callbacks = ThreadPoolExecutor(callback_workers, thread_name_prefix='mpesa-callback')
+        self._stopped = False
+        self._in_flight = 0
+        self.server = None
+
+    # Endpoints
+
+    def token(self, authorization):
+        expected = 'Basic ' + base64.b64encode(self.credentials.encode()).decode()
+        if authorization != expected:
+            return 400, {'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'}
+        token = secrets.token_urlsafe(24)
+        with self._lock:
+            self.tokens.add(token)
+        return 200, {'access_token': token, 'expires_in': '3599'}
+
+    def authorised(self, authorization):
+        return authorization.startswith('Bearer ') and authorization[7:] in self.tokens
+
+    def _password_ok(self, body):
+        stamp = str(body.get('Timestamp', ''))
+        expected = base64.b64encode(f'{self.shortcode}{self.passkey}{stamp}'.encode()).decode()
+        return str(body.get('BusinessShortCode')) == self.shortcode and body.get('Password') == expected
+
+    def push(self, body):
+        if not self._password_ok(body):
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid Password'}
+        try:
+            amount = int(body['Amount'])
+            phone = str(body['PhoneNumber'])
+            callback = body['CallBackURL']
+        except (KeyError, TypeError, ValueError):
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid Request'}
+        if amount < 1 or not phone.startswith('254') or len(phone) != 12 or not callback.startswith('http'):
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber, Amount or CallBackURL'}
+
+        merchant = f'{self.rng.randrange(10**4, 10**5)}-{self.rng.randrange(10**7, 10**8)}-1'
+        reference = f'ws_CO_{datetime.now():%d%m%Y%H%M%S}{secrets.token_hex(6)}'
+        with self._lock:
+            paid = self.rng.random() >= self.fail_rate
+            push = {
+                'merchant': merchant,
+                'amount': amount,
+                'phone': phone,
+                'callback': callback,
+                'result': (0, 'The service request is processed successfully.') if paid else CANCELLED,
+                'receipt': secrets.token_hex(5).upper() if paid else None,
+                'due': time.monotonic() + self.delay,
+                'sends': 0 if self.rng.random() < self.drop_rate else 2 if self.rng.random() < self.duplicate_rate else 1,
+            }
+            self.pushes[reference] = push
+            self.stats['pushes'] += 1
+            self.stats['paid' if paid else 'cancelled'] += 1
+            if push['sends']:
+                heapq.heappush(self._due, (push['due'], reference))
+                self._wake.notify()
+            else:
+                self.stats['dropped'] += 1
+        return 200, {
+            'MerchantRequestID': merchant,
+            'CheckoutRequestID': reference,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def query(self, body):
+        if not self._password_ok(body):
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid Password'}
+        with self._lock:
+            push = self.pushes.get(body.get('CheckoutRequestID'))
+        if push is None:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}
+        if time.monotonic() < push['due']:
+            return 500, {'requestId': push['merchant'], 'errorCode': '500.001.1001',
+                         'errorMessage': 'The transaction is being processed'}
+        code, description = push['result']
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': push['merchant'],
+            'CheckoutRequestID': body['CheckoutRequestID'],
+            'ResultCode': str(code),
+            'ResultDesc': description,
+        }
+
+    # Callbacks
+
+    def callback_body(self, reference):
+        push = self.pushes[reference]
+        code, description = push['result']
+        result = {
+            'MerchantRequestID': push['merchant'],
+            'CheckoutRequestID': reference,
+            'ResultCode': code,
+            'ResultDesc': description,
+        }
+        if code == 0:
+            result['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': push['amount']},
+                {'Name': 'MpesaReceiptNumber', 'Value': push['receipt']},
+                {'Name': 'TransactionDate', 'Value': int(datetime.now().strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(push['phone'])},
+            ]}
+        return {'Body': {'stkCallback': result}}
+
+    def _send(self, reference):
+        try:
+            self._deliver(reference)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _deliver(self, reference):
+        push = self.pushes[reference]
+        data = json.dumps(self.callback_body(reference)).encode()
+        for attempt in range(CALLBACK_ATTEMPTS):
+            started = time.perf_counter()
+            request = urllib.request.Request(push['callback'], data=data, headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                with self._lock:
+                    self.stats['callbacks'] += 1
+                    self.callback_seconds.append(time.perf_counter() - started)
+                return
+            except (urllib.error.URLError, OSError):
+                with self._lock:
+                    self.stats['callback errors'] += 1
+                time.sleep(0.5 * 2 ** attempt)
+        with self._lock:
+            self.stats['callbacks lost'] += 1
+
+    def _dispatch(self):
+        with self._lock:
+            while not self._stopped:
+                if not self._due:
+                    self._wake.wait()
+                    continue
+                due, reference = self._due[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._wake.wait(wait)
+                    continue
+                heapq.heappop(self._due)
+                for _ in range(self.pushes[reference]['sends']):
+                    self._in_flight += 1
+                    self._callbacks.submit(self._send, reference)
+
+    def pending_callbacks(self):
+        """Callbacks not yet delivered (or given up on)."""
+        with self._lock:
+            return sum(self.pushes[reference]['sends'] for _, reference in self._due) + self._in_flight
+
+    # Serving
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in background threads; returns the base URL."""
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        return f'http://{host}:{self.server.server_address[1]}'
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._wake.notify()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self._callbacks.shutdown(wait=True, cancel_futures=True)
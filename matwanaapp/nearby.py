@@ -0,0 +1,249 @@
+# nearby.py
+"""
+"Matatus near me": an in-memory grid index of the active trips.
+
+The index holds every active trip with its route, plate, seats and last known
+position, bucketed into grid cells of ``CELL_DEGREES``. Queries only look at
+the cells around the point, so they never touch the database. It is fed by:
+
+* tracking.py, which moves a trip as pings arrive in this process,
+* the Trip signals, which add a trip when it becomes active and drop it when
+  it completes, is cancelled or is deleted, and
+* the PassengerTrip signals, which keep the booked seat count current.
+
+Other processes' pings only reach the index through the positions flushed onto
+Trip, so the whole index is rebuilt from the database after
+``MATWANA_NEARBY_INDEX_TTL`` seconds, like the route search index.
+"""
+import heapq
+import math
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Trip
+
+# About 1.1 km of latitude
+CELL_DEGREES = 0.01
+KM_PER_DEGREE = 111.32
+DEFAULT_TTL = 30
+# k-nearest searches stop widening here
+MAX_RADIUS_KM = 50
+# Positions older than this are not shown
+MAX_POSITION_AGE = timedelta(minutes=15)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+def cell_of(lat, lng):
+    return (math.floor(lat / CELL_DEGREES), math.floor(lng / CELL_DEGREES))
+
+
+class LiveTrip:
+    __slots__ = ('id', 'route_id', 'route_name', 'plate_number', 'capacity', 'seats_booked',
+                 'lat', 'lng', 'updated_at', 'cell')
+
+    def __init__(self, row):
+        self.id = row['id']
+        self.route_id = row['route_id']
+        self.route_name = row['route__name']
+        self.plate_number = row['matatu__plate_number']
+        self.capacity = row['matatu__capacity']
+        self.seats_booked = row['seats_booked']
+        self.lat = self.lng = self.updated_at = self.cell = None
+
+    @property
+    def seats_available(self):
+        return max(self.capacity - self.seats_booked, 0)
+
+    def as_dict(self, distance_km):
+        return {
+            'trip_id': self.id,
+            'route_id': self.route_id,
+            'route_name': self.route_name,
+            'matatu': self.plate_number,
+            'lat': self.lat,
+            'lng': self.lng,
+            'distance_km': round(distance_km, 3),
+            'seats_available': self.seats_available,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
+
+TRIP_COLUMNS = ('id', 'route_id', 'route__name', 'matatu__plate_number', 'matatu__capacity', 'seats_booked',
+                'current_location_lat', 'current_location_lng', 'location_updated_at')
+
+
+class TripGrid:
+
+    def __init__(self, rows=()):
+        self.trips = {}
+        self.cells = {}
+        self._lock = threading.Lock()
+        for row in rows:
+            self._add(row)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        return cls(Trip.objects.filter(status='active').values(*TRIP_COLUMNS))
+
+    def __len__(self):
+        return len(self.trips)
+
+    def _add(self, row):
+        self._remove(row['id'])
+        trip = self.trips[row['id']] = LiveTrip(row)
+        if row['current_location_lat'] is not None:
+            self._place(trip, float(row['current_location_lat']), float(row['current_location_lng']),
+                        row['location_updated_at'])
+
+    def _place(self, trip, lat, lng, updated_at):
+        cell = cell_of(lat, lng)
+        if cell != trip.cell:
+            if trip.cell is not None:
+                self.cells[trip.cell].discard(trip.id)
+                if not self.cells[trip.cell]:
+                    del self.cells[trip.cell]
+            self.cells.setdefault(cell, set()).add(trip.id)
+            trip.cell = cell
+        trip.lat, trip.lng, trip.updated_at = lat, lng, updated_at
+
+    def _remove(self, trip_id):
+        trip = self.trips.pop(trip_id, None)
+        if trip is not None and trip.cell is not None:
+            self.cells[trip.cell].discard(trip_id)
+            if not self.cells[trip.cell]:
+                del self.cells[trip.cell]
+
+    def upsert(self, row):
+        with self._lock:
+            self._add(row)
+
+    def remove(self, trip_id):
+        with self._lock:
+            self._remove(trip_id)
+
+    def move(self, trip_id, lat, lng, updated_at):
+        """Move a trip the index knows; pings for other trips are ignored."""
+        with self._lock:
+            trip = self.trips.get(trip_id)
+            if trip is not None and (trip.updated_at is None or trip.updated_at <= updated_at):
+                self._place(trip, lat, lng, updated_at)
+
+    def adjust_seats(self, trip_id, delta):
+        with self._lock:
+            trip = self.trips.get(trip_id)
+            if trip is not None:
+                trip.seats_booked = max(trip.seats_booked + delta, 0)
+
+    def _ring(self, center, r):
+        """Cells on the square ring ``r`` cells away from ``center``."""
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for j in range(cj - r, cj + r + 1):
+            yield (ci - r, j)
+            yield (ci + r, j)
+        for i in range(ci - r + 1, ci + r):
+            yield (i, cj - r)
+            yield (i, cj + r)
+
+    def nearby(self, lat, lng, radius_km=None, k=None, route_id=None, min_seats=0, max_age=MAX_POSITION_AGE):
+        """
+        Active trips around (lat, lng), nearest first: every trip within
+        ``radius_km``, the ``k`` nearest, or the ``k`` nearest within the radius.
+        """
+        if radius_km is None and k is None:
+            raise ValueError('Give a radius, k or both')
+        limit_km = min(radius_km if radius_km is not None else MAX_RADIUS_KM, MAX_RADIUS_KM)
+        oldest = timezone.now() - max_age if max_age else None
+        # Cells are narrower in longitude away from the equator
+        cell_km = CELL_DEGREES * KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+        center = cell_of(lat, lng)
+
+        found = []
+        with self._lock:
+            if not self.cells:
+                return []
+            r = 0
+            while True:
+                for cell in self._ring(center, r):
+                    for trip_id in self.cells.get(cell, ()):
+                        trip = self.trips[trip_id]
+                        if route_id is not None and trip.route_id != route_id:
+                            continue
+                        if trip.seats_available < min_seats:
+                            continue
+                        if oldest is not None and trip.updated_at is not None and trip.updated_at < oldest:
+                            continue
+                        distance = haversine_km(lat, lng, trip.lat, trip.lng)
+                        if distance <= limit_km:
+                            found.append((distance, trip_id))
+                # Anything in ring r + 1 is at least r cells away
+                reach = r * cell_km
+                if reach > limit_km:
+                    break
+                if k is not None and len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= reach:
+                    break
+                r += 1
+
+            nearest = heapq.nsmallest(k, found) if k is not None else sorted(found)
+            return [self.trips[trip_id].as_dict(distance) for distance, trip_id in nearest]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    ttl = getattr(settings, 'MATWANA_NEARBY_INDEX_TTL', DEFAULT_TTL)
+    index = _index
+    if index is None or time.monotonic() - index.built_at > ttl:
+        with _index_lock:
+            if _index is None or _index is index:
+                _index = TripGrid.build()
+            index = _index
+    return index
+
+
+def invalidate():
+    global _index
+    _index = None
+
+
+def trip_changed(trip_id):
+    """Re-read one trip after it was saved: add it if active, drop it otherwise."""
+    index = _index
+    if index is None:
+        return  # built fresh on the next query
+    row = Trip.objects.filter(id=trip_id, status='active').values(*TRIP_COLUMNS).first()
+    if row is None:
+        index.remove(trip_id)
+    else:
+        index.upsert(row)
+
+
+def trip_moved(trip_id, lat, lng, updated_at):
+    index = _index
+    if index is not None:
+        index.move(trip_id, lat, lng, updated_at)
+
+
+def seats_changed(trip_id, delta):
+    index = _index
+    if index is not None:
+        index.adjust_seats(trip_id, delta)
+
+
+def nearby(lat, lng, radius_km=None, k=None, route_id=None, min_seats=0):
+    return get_index().nearby(lat, lng, radius_km=radius_km, k=k, route_id=route_id, min_seats=min_seats)
@@ -0,0 +1,162 @@
+# notifications.py
+"""
+Notification audiences and the per-user inbox.
+
+A notification stores who it is for (everyone, members of some saccos, or
+specific users) instead of a recipient row per user. ``notifications_for``
+resolves the rule when a user reads their notifications. Per-user state lives in
+UserNotification and is only written when it is needed: ``deliver`` adds the
+rows for one user as they read, and ``fan_out`` writes them for a whole
+audience in batches, each in its own short transaction, for work that really
+needs a row per user.
+
+``User.unread_notifications`` counts the unread inbox rows. Everything that
+adds, reads or retracts inbox rows adjusts it in the same transaction, so the
+badge is a column on the already loaded user row.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import User, Sacco, Matatu, PassengerTrip, Notification, UserNotification
+
+FAN_OUT_BATCH_SIZE = 1000
+# How far back deliver() looks for notifications a user has not received yet
+DELIVERY_WINDOW = timedelta(days=30)
+
+
+def sacco_ids_for(user):
+    """Subquery of the saccos a user belongs to, by role."""
+    if user.user_type == 'sacco_admin':
+        return Sacco.objects.filter(admin_id=user.id).values('id')
+    if user.user_type == 'driver':
+        return Matatu.objects.filter(current_driver_id=user.id).values('sacco_id')
+    if user.user_type == 'conductor':
+        return Matatu.objects.filter(current_conductor_id=user.id).values('sacco_id')
+    # Passengers belong to the saccos they have travelled with
+    return PassengerTrip.objects.filter(passenger_id=user.id).values('trip__route__sacco_id')
+
+
+def audience_filter(user):
+    """Q matching the notifications addressed to ``user``."""
+    targeted = Notification.recipients.through.objects.filter(
+        user_id=user.id
+    ).values('notification_id')
+    by_sacco = Notification.saccos.through.objects.filter(
+        sacco_id__in=sacco_ids_for(user)
+    ).values('notification_id')
+    return (
+        Q(audience='all') |
+        Q(audience='specific', id__in=targeted) |
+        Q(audience='saccos', id__in=by_sacco)
+    )
+
+
+def notifications_for(user):
+    """Active notifications for ``user``, newest first."""
+    return Notification.objects.filter(audience_filter(user), is_active=True).order_by('-created_at', '-id')
+
+
+def audience_user_ids(notification):
+    """Queryset of the ids of every user a notification is addressed to."""
+    if notification.audience == 'all':
+        return User.objects.filter(is_active=True).values_list('id', flat=True)
+    if notification.audience == 'specific':
+        return notification.recipients.filter(is_active=True).values_list('id', flat=True)
+
+    sacco_ids = notification.saccos.values('id')
+    return User.objects.filter(
+        Q(sacco__in=sacco_ids) |
+        Q(assigned_matatu_as_driver__sacco__in=sacco_ids) |
+        Q(assigned_matatu_as_conductor__sacco__in=sacco_ids) |
+        Q(trips__trip__route__sacco__in=sacco_ids),
+        is_active=True
+    ).distinct().values_list('id', flat=True)
+
+
+def inbox(user):
+    """The user's inbox rows, newest first."""
+    return UserNotification.objects.filter(user_id=user.id).select_related('notification').order_by('-created_at', '-id')
+
+
+def _count_unread(user_id):
+    # Recount from the (user, is_read) index; also repairs any drift
+    unread = UserNotification.objects.filter(user_id=user_id, is_read=False).count()
+    User.objects.filter(id=user_id).update(unread_notifications=unread)
+
+
+def deliver(user):
+    """
+    Write inbox rows for recent notifications the user hasn't received yet.
+    Returns the number of new rows; the unread count is only touched if
+    there were any.
+    """
+    pending = list(notifications_for(user).filter(
+        created_at__gte=timezone.now() - DELIVERY_WINDOW
+    ).exclude(
+        id__in=UserNotification.objects.filter(user_id=user.id).values('notification_id')
+    ).values_list('id', 'created_at'))
+    if not pending:
+        return 0
+    with transaction.atomic():
+        UserNotification.objects.bulk_create([
+            UserNotification(user_id=user.id, notification_id=notification_id, created_at=created_at)
+            for notification_id, created_at in pending
+        ], ignore_conflicts=True)
+        _count_unread(user.id)
+    return len(pending)
+
+
+def mark_read(user, notification_ids=None):
+    """Mark some (or all) of the user's unread notifications read in one UPDATE."""
+    rows = UserNotification.objects.filter(user_id=user.id, is_read=False)
+    if notification_ids is not None:
+        rows = rows.filter(notification_id__in=notification_ids)
+    with transaction.atomic():
+        marked = rows.update(is_read=True, read_at=timezone.now())
+        if marked:
+            User.objects.filter(id=user.id).update(
+                unread_notifications=Greatest(F('unread_notifications') - marked, 0)
+            )
+    return marked
+
+
+def retract(notification):
+    """Take an unread notification out of every inbox count (on delete or deactivation)."""
+    with transaction.atomic():
+        readers = UserNotification.objects.filter(notification=notification, is_read=False)
+        User.objects.filter(id__in=readers.values('user_id')).update(
+            unread_notifications=Greatest(F('unread_notifications') - 1, 0)
+        )
+        readers.update(is_read=True, read_at=timezone.now())
+
+
+def fan_out(notification, batch_size=FAN_OUT_BATCH_SIZE):
+    """
+    Write a delivery row for every user in the audience, walking user ids in
+    batches so no transaction holds more than ``batch_size`` rows. Safe to
+    re-run: users who already have the row are skipped. Returns the number
+    of users visited.
+    """
+    user_ids = audience_user_ids(notification).order_by('id')
+    last_id = 0
+    visited = 0
+    while True:
+        batch = list(user_ids.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return visited
+        with transaction.atomic():
+            delivered = set(UserNotification.objects.filter(
+                notification=notification, user_id__in=batch
+            ).values_list('user_id', flat=True))
+            new = [user_id for user_id in batch if user_id not in delivered]
+            UserNotification.objects.bulk_create([
+                UserNotification(user_id=user_id, notification=notification, created_at=notification.created_at)
+                for user_id in new
+            ], ignore_conflicts=True)
+            User.objects.filter(id__in=new).update(unread_notifications=F('unread_notifications') + 1)
+        last_id = batch[-1]
+        visited += len(batch)
@@ -0,0 +1,116 @@
+# pagination.py
+"""
+Keyset (cursor) pagination for the superadmin list views.
+
+Pages are addressed by the sort key of the row they start after (``?after=``)
+or end before (``?before=``) instead of an OFFSET, so every page costs one
+indexed range scan no matter how deep into the table it is. The primary key
+breaks ties between rows that share a sort value, which keeps pages stable
+while new rows are being inserted.
+"""
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def encode_cursor(value, pk):
+    raw = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value, pk])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, field):
+    """Return (value, pk) for a cursor token, or None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        value, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return field.to_python(value), int(pk)
+    except (ValueError, TypeError, ValidationError):
+        return None
+
+
+class KeysetPage:
+    def __init__(self, object_list, params, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self._params = params
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def _query(self, key, cursor):
+        params = self._params.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        params[key] = cursor
+        return params.urlencode()
+
+    @property
+    def next_query(self):
+        return self._query('after', self.next_cursor) if self.has_next else ''
+
+    @property
+    def previous_query(self):
+        return self._query('before', self.previous_cursor) if self.has_previous else ''
+
+
+def paginate_keyset(request, queryset, ordering, per_page=DEFAULT_PAGE_SIZE):
+    """
+    Return one KeysetPage of ``queryset`` sorted by ``ordering`` (e.g. '-created_at').
+
+    Any other GET parameters (filters, search) are carried over into the
+    next/previous links.
+    """
+    name = ordering.lstrip('-')
+    descending = ordering.startswith('-')
+    field = queryset.model._meta.get_field(name)
+
+    after = decode_cursor(request.GET.get('after'), field)
+    before = None if after else decode_cursor(request.GET.get('before'), field)
+
+    # Walk backwards from the cursor when paging to the previous page
+    forward = before is None
+    newest_first = descending == forward
+    if newest_first:
+        rows = queryset.order_by(f'-{name}', '-pk')
+    else:
+        rows = queryset.order_by(name, 'pk')
+
+    cursor = after or before
+    if cursor:
+        value, pk = cursor
+        op = 'lt' if newest_first else 'gt'
+        rows = rows.filter(Q(**{f'{name}__{op}': value}) | Q(**{name: value, f'pk__{op}': pk}))
+
+    rows = list(rows[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    next_cursor = previous_cursor = None
+    if rows:
+        first, last = rows[0], rows[-1]
+        if (has_more if forward else True):
+            next_cursor = encode_cursor(getattr(last, name), last.pk)
+        if (after is not None if forward else has_more):
+            previous_cursor = encode_cursor(getattr(first, name), first.pk)
+
+    return KeysetPage(rows, request.GET, next_cursor, previous_cursor)
@@ -0,0 +1,409 @@
+# payments.py
+"""
+Wallet top-ups through a payment provider.
+
+A top-up is saved as a pending Payment and handed to the ``complete_topup``
+job (tasks.py), which passes it to the provider for its payment method:
+
+* ``InstantProvider`` confirms it on the spot. It is used for every method
+  except M-Pesa, and for M-Pesa too while ``MATWANA_MPESA['BASE_URL']`` is
+  empty, which is how top-ups always worked.
+* ``DarajaProvider`` sends an M-Pesa STK push (Lipa na M-Pesa Online) to the
+  passenger's phone and stores the CheckoutRequestID. The payment stays
+  pending until Safaricom posts the result to ``mpesa_callback``.
+
+A push is sent at most once. The payment is claimed (``provider_requested_at``)
+before the push goes out, and the job is only retried when the push surely
+never left (``PaymentNotSent``). A push M-Pesa turns down fails the payment
+straight away (``PaymentRefused``). If the connection drops with no answer
+the push may still reach the phone, so the payment waits for the callback
+rather than prompting the passenger again.
+
+A callback whose CheckoutRequestID matches no payment (it raced the
+reference being saved, or the push's answer was lost) is kept as a
+ProviderCallback. It is matched by reference, or else to the claimed push
+with the same phone and amount, straight away and again by ``reconcile``.
+
+``settle`` finishes a pending payment exactly once. It locks only that
+payment's row, flips the status with a normal save (so the rollup and event
+signals run), and credits the wallet with the ``topup:<id>`` ledger key.
+Repeated or late callbacks find the payment already settled and do nothing,
+and callbacks for different payments never wait on each other.
+
+Callbacks get lost, so ``reconcile`` (``manage.py reconcile_payments``)
+asks the provider about top-ups pending for more than ``RECONCILE_AFTER``
+and settles the answered ones. Top-ups still pending after ``EXPIRE_AFTER``
+are failed in bulk with one UPDATE per batch. ``manage.py mpesa_simulator``
+serves the Daraja endpoints locally so the whole flow runs offline.
+"""
+import base64
+import json
+import logging
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import rollups, wallet
+from .events import publish
+from .models import Payment, ProviderCallback
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_AFTER = timedelta(minutes=2)
+EXPIRE_AFTER = timedelta(hours=1)
+BATCH_SIZE = 500
+HTTP_TIMEOUT = 10
+# stkpushquery answers with this error code until the customer has responded
+STILL_PROCESSING = '500.001.1001'
+
+
+class PaymentError(Exception):
+    """Raised when a provider rejects or cannot take a request."""
+
+
+class PaymentRefused(PaymentError):
+    """The provider answered and turned the request down; nothing more will come of it."""
+
+
+class PaymentNotSent(PaymentError):
+    """The request never reached the provider, so it is safe to send again."""
+
+
+class InstantProvider:
+    """Confirms every top-up straight away (no real money moves)."""
+    name = 'instant'
+
+    def prepare(self):
+        pass
+
+    def request(self, payment, phone):
+        settle(payment.id, True)
+        return None
+
+    def query(self, reference):
+        return None
+
+
+class DarajaProvider:
+    """Safaricom's Daraja API, or anything that speaks it (``manage.py mpesa_simulator``)."""
+    name = 'mpesa'
+
+    def __init__(self, config):
+        self.config = config
+        self.base_url = config['BASE_URL'].rstrip('/')
+        self._token = None
+        self._token_expires = 0
+        self._lock = threading.Lock()
+
+    def _post(self, path, body):
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(body).encode(),
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token()}'},
+        )
+        return self._send(request)
+
+    def _send(self, request):
+        try:
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            # Daraja reports errors as JSON bodies on 4xx/5xx responses
+            try:
+                return json.loads(e.read())
+            except ValueError:
+                raise PaymentError(f'M-Pesa answered {e.code}')
+        except urllib.error.URLError as e:
+            # No connection was made, so nothing was sent
+            if isinstance(e.reason, (ConnectionRefusedError, socket.gaierror)):
+                raise PaymentNotSent(f'M-Pesa is unreachable: {e.reason}')
+            raise PaymentError(f'M-Pesa is unreachable: {e.reason}')
+        except (OSError, ValueError) as e:
+            raise PaymentError(f'No answer from M-Pesa: {e}')
+
+    def token(self):
+        with self._lock:
+            if self._token is None or time.monotonic() > self._token_expires:
+                credentials = f"{self.config['CONSUMER_KEY']}:{self.config['CONSUMER_SECRET']}"
+                request = urllib.request.Request(
+                    self.base_url + '/oauth/v1/generate?grant_type=client_credentials',
+                    headers={'Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()},
+                )
+                try:
+                    answer = self._send(request)
+                except PaymentError as e:
+                    # Asking for a token prompts nobody
+                    raise PaymentNotSent(str(e))
+                if 'access_token' not in answer:
+                    raise PaymentNotSent('M-Pesa refused the credentials')
+                self._token = answer['access_token']
+                # Renewed a minute early
+                self._token_expires = time.monotonic() + int(answer.get('expires_in', 3599)) - 60
+            return self._token
+
+    def _password(self):
+        stamp = timezone.localtime().strftime('%Y%m%d%H%M%S')
+        raw = f"{self.config['SHORTCODE']}{self.config['PASSKEY']}{stamp}"
+        return base64.b64encode(raw.encode()).decode(), stamp
+
+    def prepare(self):
+        """Get the access token, so a failure here leaves the push unsent."""
+        self.token()
+
+    def request(self, payment, phone):
+        if payment.amount != payment.amount.to_integral_value():
+            raise PaymentRefused('M-Pesa only takes whole shillings')
+        password, stamp = self._password()
+        answer = self._post('/mpesa/stkpush/v1/processrequest', {
+            'BusinessShortCode': self.config['SHORTCODE'],
+            'Password': password,
+            'Timestamp': stamp,
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': int(payment.amount),
+            'PartyA': phone,
+            'PartyB': self.config['SHORTCODE'],
+            'PhoneNumber': phone,
+            'CallBackURL': self.config['CALLBACK_URL'],
+            'AccountReference': payment.transaction_id[:12],
+            'TransactionDesc': 'Wallet top-up',
+        })
+        if str(answer.get('ResponseCode')) != '0':
+            raise PaymentRefused(answer.get('errorMessage') or answer.get('ResponseDescription') or 'STK push refused')
+        return answer['CheckoutRequestID']
+
+    def query(self, reference):
+        """(success, description) once the customer has answered, else None."""
+        password, stamp = self._password()
+        answer = self._post('/mpesa/stkpushquery/v1/query', {
+            'BusinessShortCode': self.config['SHORTCODE'],
+            'Password': password,
+            'Timestamp': stamp,
+            'CheckoutRequestID': reference,
+        })
+        if answer.get('errorCode') == STILL_PROCESSING or 'ResultCode' not in answer:
+            return None
+        return str(answer['ResultCode']) == '0', answer.get('ResultDesc', '')
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(payment_method):
+    config = getattr(settings, 'MATWANA_MPESA', None) or {}
+    if payment_method != 'mpesa' or not config.get('BASE_URL'):
+        return InstantProvider()
+    key = tuple(sorted(config.items()))
+    with _providers_lock:
+        # One per configuration, so the access token is shared between requests
+        if key not in _providers:
+            _providers[key] = DarajaProvider(config)
+        return _providers[key]
+
+
+def msisdn(phone):
+    """+254712345678 as M-Pesa wants it: 254712345678."""
+    return phone.lstrip('+')
+
+
+def request_topup(payment_id, phone=None):
+    """
+    Hand a pending top-up to its provider, once. Does nothing if that already
+    happened. Raises PaymentNotSent, for the job to retry, only when nothing
+    reached the provider.
+    """
+    payment = Payment.objects.select_related('passenger').filter(id=payment_id).first()
+    if payment is None or payment.status != 'pending' or payment.provider_requested_at:
+        return
+    provider = get_provider(payment.payment_method)
+    phone = msisdn(phone or payment.passenger.phone_number)
+    provider.prepare()
+
+    # Claimed before sending, so a retry or a second worker never prompts the passenger again
+    claimed = Payment.objects.filter(id=payment.id, status='pending', provider_requested_at__isnull=True).update(
+        provider_requested_at=timezone.now(), provider_phone=phone
+    )
+    if not claimed:
+        return
+    try:
+        reference = provider.request(payment, phone)
+    except PaymentNotSent:
+        Payment.objects.filter(id=payment.id).update(provider_requested_at=None, provider_phone='')
+        raise
+    except PaymentRefused as e:
+        settle(payment.id, False, reason=str(e))
+        return
+    except PaymentError as e:
+        logger.warning('Payment %s: push may have been sent (%s); waiting for its callback', payment.id, e)
+        return
+    if reference:
+        Payment.objects.filter(id=payment.id, provider_reference__isnull=True).update(provider_reference=reference)
+        # The callback may have come before the reference was saved
+        callback = ProviderCallback.objects.filter(reference=reference, payment__isnull=True).first()
+        if callback:
+            match_callback(callback)
+
+
+def settle(payment_id, success, receipt='', reason='', reference=None, amount=None):
+    """
+    Complete or fail a pending payment (by id, or by provider reference) and
+    credit the wallet for a completed top-up. Returns False if there was
+    nothing pending to settle.
+    """
+    payments = Payment.objects.filter(provider_reference=reference) if reference else Payment.objects.filter(id=payment_id)
+    with transaction.atomic():
+        payment = payments.select_for_update().first()
+        if payment is None or payment.status != 'pending':
+            if payment is not None and success and payment.status == 'failed':
+                logger.error('Payment %s: paid (receipt %s) after it was failed; refund or credit by hand',
+                             payment.id, receipt or '-')
+            return False
+        if success and amount is not None and amount != payment.amount:
+            logger.warning('Payment %s: provider reported %s, expected %s', payment.id, amount, payment.amount)
+            success, reason = False, f'Paid {amount} instead of {payment.amount}'
+        payment.status = 'completed' if success else 'failed'
+        payment.completed_at = timezone.now()
+        payment.receipt_number = receipt or ''
+        fields = ['status', 'completed_at', 'receipt_number']
+        if reason:
+            payment.description = f'{payment.description} ({reason})'.strip()
+            fields.append('description')
+        payment.save(update_fields=fields)
+        if success and payment.payment_type == 'credit_topup':
+            wallet.post(payment.passenger_id, payment.amount, 'topup', key=f'topup:{payment.id}', payment=payment)
+    return True
+
+
+def handle_callback(body):
+    """
+    Apply an STK push result as Daraja posts it. Returns True if it settled
+    a payment; duplicates return False, and so do unknown requests, which
+    are kept for ``reconcile``. Raises ValueError for a body that is not an
+    STK callback.
+    """
+    try:
+        result = body['Body']['stkCallback']
+        reference = result['CheckoutRequestID']
+        code = str(result['ResultCode'])
+    except (KeyError, TypeError):
+        raise ValueError('Not an STK push callback')
+    items = {
+        item.get('Name'): item.get('Value')
+        for item in (result.get('CallbackMetadata') or {}).get('Item', [])
+        if isinstance(item, dict)
+    }
+    try:
+        amount = Decimal(str(items['Amount'])) if 'Amount' in items else None
+    except InvalidOperation:
+        raise ValueError('Not an STK push callback')
+    success = code == '0'
+    receipt = str(items.get('MpesaReceiptNumber') or '')
+    reason = '' if success else str(result.get('ResultDesc', ''))[:255]
+    if Payment.objects.filter(provider_reference=reference).exists():
+        return settle(None, success, receipt=receipt, reason=reason, reference=reference, amount=amount)
+
+    callback, created = ProviderCallback.objects.get_or_create(reference=reference, defaults={
+        'success': success,
+        'amount': amount,
+        'phone': str(items.get('PhoneNumber') or ''),
+        'receipt_number': receipt,
+        'reason': reason,
+    })
+    if created:
+        logger.warning('M-Pesa callback for unknown request %s (receipt %s) kept for reconciliation',
+                       reference, receipt or '-')
+    return match_callback(callback)
+
+
+def match_callback(callback):
+    """
+    Settle the payment a kept callback belongs to: the one with its
+    reference, or else the oldest claimed push to the same phone for the
+    same amount that never got a reference. Returns True if it settled one.
+    """
+    payment_id = Payment.objects.filter(provider_reference=callback.reference).values_list('id', flat=True).first()
+    if payment_id is None:
+        if callback.amount is None or not callback.phone:
+            return False  # a failed push says neither; its payment expires
+        payment_id = Payment.objects.filter(
+            status='pending', provider_reference__isnull=True, provider_phone=callback.phone,
+            amount=callback.amount, provider_requested_at__lte=callback.received_at,
+        ).order_by('provider_requested_at').values_list('id', flat=True).first()
+        if payment_id is None:
+            return False
+        if not Payment.objects.filter(id=payment_id, provider_reference__isnull=True).update(
+            provider_reference=callback.reference
+        ):
+            return False
+        logger.warning('Payment %s: matched to M-Pesa request %s by phone and amount', payment_id, callback.reference)
+    settled = settle(
+        None, callback.success, receipt=callback.receipt_number, reason=callback.reason,
+        reference=callback.reference, amount=callback.amount,
+    )
+    ProviderCallback.objects.filter(id=callback.id).update(payment_id=payment_id)
+    return settled
+
+
+def _stuck(older_than):
+    return Payment.objects.filter(status='pending', payment_type='credit_topup', created_at__lte=older_than)
+
+
+def reconcile(now=None):
+    """
+    Settle top-ups whose callback never came. Returns counts of payments
+    settled from a provider query, failed as expired, and still pending.
+    """
+    now = now or timezone.now()
+    counts = {'settled': 0, 'expired': 0, 'pending': 0}
+
+    # Callbacks that came before (or without) their payment's reference
+    kept = ProviderCallback.objects.filter(payment__isnull=True, received_at__gte=now - EXPIRE_AFTER)
+    for callback in kept.order_by('received_at')[:BATCH_SIZE]:
+        if match_callback(callback):
+            counts['settled'] += 1
+
+    # Ask the provider about each one it knows
+    asked = _stuck(now - RECONCILE_AFTER).filter(provider_reference__isnull=False).order_by('created_at')
+    for payment_id, method, reference in asked.values_list('id', 'payment_method', 'provider_reference')[:BATCH_SIZE]:
+        try:
+            answer = get_provider(method).query(reference)
+        except PaymentError as e:
+            logger.warning('Payment %s: query failed: %s', payment_id, e)
+            answer = None
+        if answer is None:
+            counts['pending'] += 1
+        elif settle(payment_id, answer[0], reason='' if answer[0] else answer[1]):
+            counts['settled'] += 1
+
+    # Give up on the rest in bulk
+    while True:
+        with transaction.atomic():
+            expired = _stuck(now - EXPIRE_AFTER)
+            if connection.features.has_select_for_update_skip_locked:
+                # Ones a callback is settling right now are left to it
+                expired = expired.select_for_update(skip_locked=True)
+            rows = list(expired.order_by('id').values_list(
+                'id', 'passenger_id', 'created_at', 'sacco_id', 'payment_type', 'amount'
+            )[:BATCH_SIZE])
+            if not rows:
+                break
+            Payment.objects.filter(id__in=[row[0] for row in rows], status='pending').update(
+                status='failed', completed_at=now
+            )
+            # What the Payment signals would have done
+            rollups.payments_moved([row[2:] for row in rows], 'pending', 'failed')
+            for _, passenger_id, _, _, payment_type, amount in rows:
+                publish(f'user:{passenger_id}', 'payment', payment_type=payment_type, status='failed', amount=amount)
+            publish('admin', 'payment', payment_type='credit_topup', status='failed', count=len(rows))
+        counts['expired'] += len(rows)
+        if len(rows) < BATCH_SIZE:
+            break
+    return counts
@@ -0,0 +1,331 @@
+# planner.py
+"""
+Journey planning across routes and saccos.
+
+The network is a graph of stops: every active route contributes its stops
+in order (or just its start and end points when it has none), and stops with
+the same name on different routes are the same place, which is where
+passengers change. Edges are time dependent: riding route R from its i-th
+stop is only possible on one of R's scheduled trips, and what it costs is
+that trip's arrival time at the later stop. A trip's time at each stop is its
+scheduled departure plus the stop's share of the route's distance times the
+trip's scheduled duration.
+
+``JourneyGraph.plan`` is Dijkstra on arrival time. Popping a stop reached at
+time t boards, for every route through it, the first trip leaving after t
+(plus ``TRANSFER_SECONDS`` when changing) and relaxes every later stop of
+that trip at once, so staying on board never counts as a change. A trip is
+only ridden onwards once, from the earliest stop it was boarded at, and
+nothing arriving after the best arrival at the destination so far is relaxed.
+
+The graph holds the trips leaving within ``HORIZON`` of when it was built.
+It is built on first use and rebuilt after ``MATWANA_JOURNEY_GRAPH_TTL``
+seconds; in between, the Trip and Route signals update single trips and
+routes in place (``trip_changed`` / ``route_changed``). Seats are not part of
+the plan; they are checked when a leg is booked.
+"""
+import bisect
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Route, RouteStop, Trip
+
+DEFAULT_TTL = 300
+HORIZON = timedelta(hours=48)
+# Trips that left a little while ago can still be caught further down the route
+LOOKBACK = timedelta(hours=2)
+TRANSFER_SECONDS = 5 * 60
+PLAN_STATUSES = ('scheduled', 'active')
+ROUTE_COLUMNS = ('id', 'name', 'sacco__name', 'start_point', 'end_point', 'distance_km')
+
+
+def normalise(name):
+    return ' '.join(name.lower().split())
+
+
+class Pattern:
+    """One route's stops and the times of its trips at each of them."""
+    __slots__ = ('route_id', 'name', 'sacco', 'stops', 'fractions', 'trips', 'times', 'ids')
+
+    def __init__(self, route_id, name, sacco, stops, fractions):
+        self.route_id = route_id
+        self.name = name
+        self.sacco = sacco
+        self.stops = stops
+        self.fractions = fractions
+        self.trips = {}  # trip id -> epoch seconds at each stop
+        # Per stop, the trips' times there in order, and the matching trip ids
+        self.times = [[] for _ in stops]
+        self.ids = [[] for _ in stops]
+
+    def add_trip(self, trip_id, departure, arrival):
+        self.remove_trip(trip_id)
+        times = [departure + f * (arrival - departure) for f in self.fractions]
+        self.trips[trip_id] = times
+        for i, t in enumerate(times):
+            k = bisect.bisect_right(self.times[i], t)
+            self.times[i].insert(k, t)
+            self.ids[i].insert(k, trip_id)
+
+    def remove_trip(self, trip_id):
+        times = self.trips.pop(trip_id, None)
+        if times is None:
+            return
+        for i, t in enumerate(times):
+            k = bisect.bisect_left(self.times[i], t)
+            while self.ids[i][k] != trip_id:
+                k += 1
+            del self.times[i][k]
+            del self.ids[i][k]
+
+    def next_trip(self, position, ready):
+        """The first trip leaving stop ``position`` at or after ``ready``."""
+        k = bisect.bisect_left(self.times[position], ready)
+        return self.ids[position][k] if k < len(self.ids[position]) else None
+
+
+class JourneyGraph:
+
+    def __init__(self, routes=(), stops=(), trips=(), now=None):
+        now = now or timezone.now()
+        self.window = ((now - LOOKBACK).timestamp(), (now + HORIZON).timestamp())
+        self.names = []
+        self.stop_index = {}
+        self.patterns = {}
+        self.trip_routes = {}
+        self.serving = defaultdict(list)  # stop -> [(route id, position)]
+        self._lock = threading.Lock()
+
+        stops_by_route = defaultdict(list)
+        for route_id, name, distance_km in stops:
+            stops_by_route[route_id].append((name, distance_km))
+        for route in routes:
+            self._set_route(route, stops_by_route.get(route['id'], []))
+        for trip in trips:
+            self._set_trip(*trip)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        now = timezone.now()
+        return cls(
+            Route.objects.filter(is_active=True).values(*ROUTE_COLUMNS),
+            RouteStop.objects.filter(route__is_active=True).order_by('route_id', 'sequence').values_list(
+                'route_id', 'name', 'distance_km'
+            ),
+            Trip.objects.filter(
+                route__is_active=True,
+                status__in=PLAN_STATUSES,
+                scheduled_departure__gte=now - LOOKBACK,
+                scheduled_departure__lte=now + HORIZON,
+            ).values_list('id', 'route_id', 'scheduled_departure', 'scheduled_arrival'),
+            now=now,
+        )
+
+    def _stop(self, name):
+        key = normalise(name)
+        index = self.stop_index.get(key)
+        if index is None:
+            index = self.stop_index[key] = len(self.names)
+            self.names.append(name.strip())
+        return index
+
+    def _drop_route(self, route_id):
+        pattern = self.patterns.pop(route_id, None)
+        if pattern is None:
+            return
+        for stop in set(pattern.stops):
+            self.serving[stop] = [entry for entry in self.serving[stop] if entry[0] != route_id]
+        for trip_id in pattern.trips:
+            self.trip_routes.pop(trip_id, None)
+
+    def _set_route(self, route, stops):
+        self._drop_route(route['id'])
+        if len(stops) < 2:
+            stops = [(route['start_point'], 0), (route['end_point'], route['distance_km'])]
+        first, last = float(stops[0][1]), float(stops[-1][1])
+        length = last - first
+        pattern = self.patterns[route['id']] = Pattern(
+            route['id'], route['name'], route['sacco__name'],
+            [self._stop(name) for name, _ in stops],
+            [(float(km) - first) / length if length > 0 else i / (len(stops) - 1) for i, (_, km) in enumerate(stops)],
+        )
+        for position, stop in enumerate(pattern.stops[:-1]):
+            self.serving[stop].append((route['id'], position))
+
+    def _set_trip(self, trip_id, route_id, departure, arrival):
+        self._drop_trip(trip_id)
+        pattern = self.patterns.get(route_id)
+        if pattern is None:
+            return
+        pattern.add_trip(trip_id, departure.timestamp(), arrival.timestamp())
+        self.trip_routes[trip_id] = route_id
+
+    def _drop_trip(self, trip_id):
+        route_id = self.trip_routes.pop(trip_id, None)
+        if route_id is not None and route_id in self.patterns:
+            self.patterns[route_id].remove_trip(trip_id)
+
+    def set_route(self, route, stops, trips):
+        with self._lock:
+            self._set_route(route, stops)
+            for trip in trips:
+                self._set_trip(*trip)
+
+    def drop_route(self, route_id):
+        with self._lock:
+            self._drop_route(route_id)
+
+    def set_trip(self, trip_id, route_id, departure, arrival):
+        with self._lock:
+            self._set_trip(trip_id, route_id, departure, arrival)
+
+    def drop_trip(self, trip_id):
+        with self._lock:
+            self._drop_trip(trip_id)
+
+    def match(self, text):
+        """Stops named ``text``, or failing that, stops whose name contains it."""
+        key = normalise(text or '')
+        if not key:
+            return set()
+        if key in self.stop_index:
+            return {self.stop_index[key]}
+        return {index for name, index in self.stop_index.items() if key in name}
+
+    def plan(self, origin, destination, depart_after, transfer=TRANSFER_SECONDS):
+        """
+        The earliest arriving journey from ``origin`` to ``destination``
+        (stop names) leaving at or after ``depart_after``: a list of legs, or
+        None when no scheduled trips connect them.
+        """
+        start = depart_after.timestamp()
+        with self._lock:
+            origins, targets = self.match(origin), self.match(destination)
+            if not origins or not targets or origins & targets:
+                return None
+
+            # Labels are (arrival, legs) so equally early journeys prefer fewer changes
+            best = {stop: (start, 0) for stop in origins}
+            via = {}
+            heap = [(start, 0, stop) for stop in origins]
+            heapq.heapify(heap)
+            # Earliest position each trip was boarded at; stops after it are already relaxed
+            boarded = {}
+            # Nothing arriving after the best arrival found so far can help
+            limit = math.inf
+            while heap:
+                arrived, legs, stop = heapq.heappop(heap)
+                if (arrived, legs) > best[stop]:
+                    continue
+                if stop in targets:
+                    return self._legs(via, stop)
+                ready = arrived + (transfer if legs else 0)
+                for route_id, position in self.serving[stop]:
+                    pattern = self.patterns[route_id]
+                    trip_id = pattern.next_trip(position, ready)
+                    if trip_id is None or boarded.get(trip_id, math.inf) <= position:
+                        continue
+                    end = boarded.get(trip_id, len(pattern.stops) - 1)
+                    boarded[trip_id] = position
+                    times = pattern.trips[trip_id]
+                    for later in range(position + 1, end + 1):
+                        if times[later] >= limit:
+                            break
+                        label = (times[later], legs + 1)
+                        nxt = pattern.stops[later]
+                        if label < best.get(nxt, (math.inf, 0)):
+                            best[nxt] = label
+                            via[nxt] = (stop, route_id, trip_id, position, later)
+                            heapq.heappush(heap, (*label, nxt))
+                            if nxt in targets:
+                                limit = times[later]
+            return None
+
+    def _legs(self, via, stop):
+        legs = []
+        while stop in via:
+            previous, route_id, trip_id, board, alight = via[stop]
+            pattern = self.patterns[route_id]
+            times = pattern.trips[trip_id]
+            legs.append({
+                'route_id': route_id,
+                'route_name': pattern.name,
+                'sacco': pattern.sacco,
+                'trip_id': trip_id,
+                'from': self.names[previous],
+                'to': self.names[stop],
+                'depart': datetime.fromtimestamp(times[board], dt_timezone.utc),
+                'arrive': datetime.fromtimestamp(times[alight], dt_timezone.utc),
+            })
+            stop = previous
+        legs.reverse()
+        return legs
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    global _graph
+    ttl = getattr(settings, 'MATWANA_JOURNEY_GRAPH_TTL', DEFAULT_TTL)
+    graph = _graph
+    if graph is None or time.monotonic() - graph.built_at > ttl:
+        with _graph_lock:
+            if _graph is None or _graph is graph:
+                _graph = JourneyGraph.build()
+            graph = _graph
+    return graph
+
+
+def invalidate():
+    global _graph
+    _graph = None
+
+
+def trip_changed(trip_id):
+    """Re-read one trip after it was saved or deleted."""
+    graph = _graph
+    if graph is None:
+        return  # built fresh on the next query
+    row = Trip.objects.filter(id=trip_id, route__is_active=True, status__in=PLAN_STATUSES).values_list(
+        'id', 'route_id', 'scheduled_departure', 'scheduled_arrival'
+    ).first()
+    if row is None or not graph.window[0] <= row[2].timestamp() <= graph.window[1]:
+        graph.drop_trip(trip_id)
+    else:
+        graph.set_trip(*row)
+
+
+def route_changed(route_id):
+    """Re-read one route with its stops and trips after it was edited."""
+    graph = _graph
+    if graph is None:
+        return
+    route = Route.objects.filter(id=route_id, is_active=True).values(*ROUTE_COLUMNS).first()
+    if route is None:
+        graph.drop_route(route_id)
+        return
+    low, high = (datetime.fromtimestamp(t, dt_timezone.utc) for t in graph.window)
+    graph.set_route(
+        route,
+        list(RouteStop.objects.filter(route_id=route_id).order_by('sequence').values_list('name', 'distance_km')),
+        Trip.objects.filter(
+            route_id=route_id,
+            status__in=PLAN_STATUSES,
+            scheduled_departure__gte=low,
+            scheduled_departure__lte=high,
+        ).values_list('id', 'route_id', 'scheduled_departure', 'scheduled_arrival'),
+    )
+
+
+def plan(origin, destination, depart_after=None):
+    return get_graph().plan(origin, destination, depart_after or timezone.now())
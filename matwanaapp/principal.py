@@ -0,0 +1,114 @@
+# principal.py
+"""
+The logged-in principal and the role guard for views.
+
+Sessions only carry ``user_id``. The identity fields a view needs to
+authorise a request (role, name, active flag) are cached for a short TTL, so
+role checks on warm requests don't touch the users table. The cache entry is
+dropped whenever the user row is saved or deleted (see signals.py), which
+covers role changes made in ``admin_edit_user``; other processes see the
+change once the TTL runs out.
+
+Mutable figures such as ``credits`` are deliberately not cached. Views that
+need them load the row with ``request.principal.user``.
+"""
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.shortcuts import redirect
+
+from .models import User
+
+DEFAULT_TTL = 60
+
+
+def cache_key(user_id):
+    return f'matwana:principal:{user_id}'
+
+
+class Principal:
+    """Cached identity of a logged-in user."""
+
+    def __init__(self, id, user_type, first_name, last_name, email, is_active):
+        self.id = id
+        self.pk = id
+        self.user_type = user_type
+        self.first_name = first_name
+        self.last_name = last_name
+        self.email = email
+        self.is_active = is_active
+        self._user = None
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.user_type, user.first_name, user.last_name, user.email, user.is_active)
+
+    def __getstate__(self):
+        # Never cache the loaded row along with the identity
+        state = self.__dict__.copy()
+        state['_user'] = None
+        return state
+
+    def get_full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    @property
+    def user(self):
+        """The full User row, loaded on first access"""
+        if self._user is None:
+            self._user = User.objects.get(id=self.id)
+        return self._user
+
+
+def get_principal(request):
+    """Return the Principal for the session, or None if nobody is logged in."""
+    user_id = request.session.get('user_id')
+    if user_id is None:
+        return None
+
+    key = cache_key(user_id)
+    principal = cache.get(key)
+    if principal is None:
+        user = User.objects.filter(id=user_id).first()
+        if user is None:
+            return None
+        principal = Principal.from_user(user)
+        cache.set(key, principal, getattr(settings, 'MATWANA_PRINCIPAL_TTL', DEFAULT_TTL))
+    return principal
+
+
+def invalidate_principal(user_id):
+    cache.delete(cache_key(user_id))
+
+
+def role_required(*user_types, api=False):
+    """
+    Only let logged-in users with one of ``user_types`` (any type if none are
+    given) reach the view, which finds them on ``request.principal``.
+
+    Page views redirect to the login page with a message; ``api=True`` views
+    answer with the usual ``{'success': False, ...}`` JSON instead.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            principal = get_principal(request)
+            if principal is None:
+                if api:
+                    return JsonResponse({'success': False, 'message': 'Not authenticated'})
+                messages.error(request, 'Please login to access this page')
+                return redirect('login')
+
+            if user_types and principal.user_type not in user_types:
+                if api:
+                    return JsonResponse({'success': False, 'message': 'Access denied'})
+                messages.error(request, 'Access denied')
+                return redirect('login')
+
+            request.principal = principal
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,253 @@
+# profiling.py
+"""
+Per-request profiles: how many queries a view ran and how long they took,
+which statements repeated (the signature of an N+1), time spent rendering
+templates and the size of the response.
+
+``ProfileMiddleware`` profiles a random ``MATWANA_PROFILE_SAMPLE_RATE`` of
+requests (0 turns it off and the middleware drops out of the stack). A
+profile is logged as one JSON line on the ``matwanaapp.profiling`` logger
+(also passed as ``extra={'profile': ...}`` for JSON log handlers), at
+WARNING for slow requests and likely N+1s, and is kept in a ring buffer of
+the last ``MATWANA_PROFILE_BUFFER_SIZE`` profiles, which superadmins can
+read at ``superadmin/api/profiles/`` with a per-view summary.
+
+The buffer lives in each process, so with several workers each endpoint
+call only sees the requests that worker served.
+
+Queries are timed by a wrapper installed on each database connection and
+templates by the ``DjangoTemplates`` backend below. Both find the profile
+being recorded through a context variable, so they also count queries made
+in ``sync_to_async`` threads, and both cost one lookup when a request is
+not being profiled. Queries run while a template renders count towards the
+template time as well as the database time.
+"""
+import contextvars
+import json
+import logging
+import random
+import re
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import DjangoTemplates as BaseDjangoTemplates
+
+logger = logging.getLogger(__name__)
+
+# A statement run this many times in one request is reported as a likely N+1
+REPEATED = 5
+# Requests slower than this are logged as warnings
+SLOW_MS = 1000
+# Statements shown per profile
+TOP_STATEMENTS = 5
+
+_current = contextvars.ContextVar('matwana_profile', default=None)
+_IN_LIST = re.compile(r'IN \(%s(?:, %s)*\)')
+_COLUMNS = re.compile(r'^SELECT .+? FROM ', re.DOTALL)
+
+_buffer = deque(maxlen=500)
+_buffer_lock = threading.Lock()
+
+
+class Profile:
+    """What one request did; filled in by the query wrapper and template backend."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.template_ms = 0.0
+        self.statements = {}  # sql -> [runs, ms]
+        self.identical = defaultdict(int)  # (sql, params) -> runs
+
+    def query(self, sql, params, ms):
+        self.queries += 1
+        self.db_ms += ms
+        # IN (%s, %s, ...) lists of any length are the same statement
+        statement = _IN_LIST.sub('IN (...)', sql)
+        entry = self.statements.setdefault(statement, [0, 0.0])
+        entry[0] += 1
+        entry[1] += ms
+        try:
+            self.identical[(sql, tuple(params) if params is not None else None)] += 1
+        except TypeError:  # executemany or unhashable params
+            pass
+
+    def result(self, request, response):
+        repeated = sorted(
+            ((sql, runs, ms) for sql, (runs, ms) in self.statements.items() if runs >= REPEATED),
+            key=lambda item: -item[1],
+        )
+        match = request.resolver_match
+        return {
+            'at': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'queries': self.queries,
+            'db_ms': round(self.db_ms, 2),
+            'duplicates': sum(runs - 1 for runs in self.identical.values()),
+            'repeated': [
+                # The column list is long and says little about where the statement came from
+                {'sql': _COLUMNS.sub('SELECT ... FROM ', sql, count=1)[:300], 'runs': runs, 'ms': round(ms, 2)}
+                for sql, runs, ms in repeated[:TOP_STATEMENTS]
+            ],
+            'template_ms': round(self.template_ms, 2),
+            # Streamed responses (event stream, exports) have no size up front
+            'bytes': None if response.streaming else len(response.content),
+        }
+
+
+def _time_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.query(sql, params, (time.perf_counter() - started) * 1000)
+
+
+def _install(connection, **kwargs):
+    # The same wrapper object reconnects (and sends connection_created) again
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def _install_all(**kwargs):
+    for connection in connections.all(initialized_only=True):
+        _install(connection)
+
+
+class _TimedTemplate:
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None:
+            return self.template.render(context, request)
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            profile.template_ms += (time.perf_counter() - started) * 1000
+
+
+class DjangoTemplates(BaseDjangoTemplates):
+    """The Django template backend, timing renders for the request profile."""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+
+def record(profile):
+    with _buffer_lock:
+        _buffer.append(profile)
+    level = logging.WARNING if profile['ms'] >= SLOW_MS or profile['repeated'] else logging.INFO
+    logger.log(level, 'request profile %s', json.dumps(profile), extra={'profile': profile})
+
+
+def recent(limit=None):
+    """The newest profiles first."""
+    with _buffer_lock:
+        profiles = list(_buffer)
+    profiles.reverse()
+    return profiles[:limit] if limit else profiles
+
+
+def summary(profiles):
+    """Per view: requests, p50/p95 time, mean and max queries, and how many looked like N+1s."""
+    by_view = defaultdict(list)
+    for profile in profiles:
+        by_view[profile['view'] or profile['path']].append(profile)
+    rows = []
+    for view, group in by_view.items():
+        times = sorted(profile['ms'] for profile in group)
+        queries = [profile['queries'] for profile in group]
+        rows.append({
+            'view': view,
+            'requests': len(group),
+            'p50_ms': round(statistics.median(times), 2),
+            'p95_ms': times[int(len(times) * 0.95) - 1],
+            'mean_queries': round(statistics.fmean(queries), 1),
+            'max_queries': max(queries),
+            'mean_db_ms': round(statistics.fmean(profile['db_ms'] for profile in group), 2),
+            'n_plus_one': sum(1 for profile in group if profile['repeated']),
+        })
+    rows.sort(key=lambda row: -row['p95_ms'])
+    return rows
+
+
+def clear():
+    with _buffer_lock:
+        _buffer.clear()
+
+
+class ProfileMiddleware:
+    """Profile a sample of requests; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.rate = getattr(settings, 'MATWANA_PROFILE_SAMPLE_RATE', 0)
+        if not self.rate:
+            raise MiddlewareNotUsed
+        global _buffer
+        size = getattr(settings, 'MATWANA_PROFILE_BUFFER_SIZE', 500)
+        with _buffer_lock:
+            if _buffer.maxlen != size:
+                _buffer = deque(_buffer, maxlen=size)
+        # Connections opened from now on, and any this thread already has
+        connection_created.connect(_install, dispatch_uid='matwana_profile')
+        request_started.connect(_install_all, dispatch_uid='matwana_profile')
+        _install_all()
+
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= self.rate:
+            return self.get_response(request)
+        profile = Profile()
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        record(profile.result(request, response))
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= self.rate:
+            return await self.get_response(request)
+        profile = Profile()
+        token = _current.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        record(profile.result(request, response))
+        return response
@@ -0,0 +1,244 @@
+# rollups.py
+"""
+Incremental maintenance of the daily rollup tables.
+
+Each tracked instance remembers the rollup bucket it was loaded in. When it is
+saved or deleted, the old bucket is decremented and the new one incremented.
+Updates are applied after the write commits, each as a single UPDATE ... F(),
+so bookings on different trips never queue behind a shared daily row. Anything
+that bypasses model signals (queryset.update(), bulk_create) should move the
+rows it changed with ``trips_added``, ``trips_moved`` or ``payments_moved``
+(and a route moving to another sacco moves its trips with ``route_moved``),
+or else ``rebuild`` the affected days or run ``manage.py rebuild_rollups``.
+"""
+from collections import Counter
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import (
+    User, Route, Trip, Payment,
+    PaymentDailyRollup, RegistrationDailyRollup, TripDailyRollup,
+)
+
+
+def _local_day(value):
+    return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+
+
+def _bump(model, key, **deltas):
+    """Add deltas to the rollup row for key, creating the row if needed."""
+    row = model.objects.filter(**key).first()
+    if row is None:
+        try:
+            with transaction.atomic():
+                row = model.objects.create(**key)
+        except IntegrityError:
+            row = model.objects.filter(**key).first()
+    model.objects.filter(pk=row.pk).update(**{
+        field: F(field) + delta for field, delta in deltas.items()
+    })
+
+
+# Bucket state: (key, deltas) for the instance as last loaded or saved
+
+def payment_state(payment):
+    if payment.pk is None or payment.created_at is None:
+        return None
+    key = {
+        'day': _local_day(payment.created_at),
+        'sacco_id': payment.sacco_id,
+        'status': payment.status,
+        'payment_type': payment.payment_type,
+    }
+    return key, {'total_amount': payment.amount, 'payment_count': 1}
+
+
+def registration_state(user):
+    if user.pk is None or user.date_joined is None:
+        return None
+    key = {'day': _local_day(user.date_joined), 'user_type': user.user_type}
+    return key, {'user_count': 1}
+
+
+def trip_state(trip):
+    if trip.pk is None or trip.scheduled_departure is None:
+        return None
+    # The sacco is resolved from the route when the change is applied; a route
+    # moving to another sacco takes its trips' counts along (route_moved)
+    key = {
+        'day': _local_day(trip.scheduled_departure),
+        'route_id': trip.route_id,
+        'status': trip.status,
+    }
+    return key, {'trip_count': 1}
+
+
+# model: (rollup model, state function, fields the state depends on)
+ROLLUPS = {
+    Payment: (PaymentDailyRollup, payment_state, ('created_at', 'sacco_id', 'status', 'payment_type', 'amount')),
+    User: (RegistrationDailyRollup, registration_state, ('date_joined', 'user_type')),
+    Trip: (TripDailyRollup, trip_state, ('scheduled_departure', 'route_id', 'status')),
+}
+
+# Loaded with deferred fields; the old bucket is read from the database before saving
+UNKNOWN = object()
+
+
+def _resolve_key(key):
+    if 'route_id' in key:
+        key = dict(key)
+        route_id = key.pop('route_id')
+        key['sacco_id'] = Route.objects.filter(id=route_id).values_list('sacco_id', flat=True).first()
+    return key
+
+
+def _apply(rollup_model, old, new):
+    if old == new:
+        return
+    if old is not None:
+        key, deltas = old
+        _bump(rollup_model, _resolve_key(key), **{field: -delta for field, delta in deltas.items()})
+    if new is not None:
+        key, deltas = new
+        _bump(rollup_model, _resolve_key(key), **deltas)
+
+
+def remember(instance):
+    """Snapshot the instance's current bucket (called on load and after each save)."""
+    _, state, fields = ROLLUPS[type(instance)]
+    if instance.get_deferred_fields().intersection(fields):
+        instance._rollup_state = UNKNOWN
+    else:
+        instance._rollup_state = state(instance)
+
+
+def before_save(instance):
+    """Resolve an UNKNOWN snapshot while the database still holds the old values."""
+    if getattr(instance, '_rollup_state', None) is UNKNOWN:
+        model = type(instance)
+        _, state, fields = ROLLUPS[model]
+        values = model.objects.filter(pk=instance.pk).values('pk', *fields).first()
+        instance._rollup_state = state(model(**values)) if values else None
+
+
+def record_change(instance, deleted=False):
+    """Move the instance's contribution from its old bucket to its new one after commit."""
+    rollup_model, state, _ = ROLLUPS[type(instance)]
+    old = getattr(instance, '_rollup_state', None)
+    new = None if deleted else state(instance)
+    instance._rollup_state = new
+    transaction.on_commit(lambda: _apply(rollup_model, old, new))
+
+
+def trips_added(trips, status):
+    """
+    Count trips created with bulk_create in their status bucket after commit.
+    ``trips`` are (scheduled_departure, sacco_id) pairs.
+    """
+    counts = Counter((_local_day(departure), sacco_id) for departure, sacco_id in trips)
+
+    def apply():
+        for (day, sacco_id), count in counts.items():
+            _bump(TripDailyRollup, {'day': day, 'sacco_id': sacco_id, 'status': status}, trip_count=count)
+
+    transaction.on_commit(apply)
+
+
+def trips_moved(trips, old_status, new_status):
+    """
+    Move trips changed with queryset.update() from one status bucket to
+    another after commit. ``trips`` are (scheduled_departure, sacco_id) pairs.
+    """
+    counts = Counter((_local_day(departure), sacco_id) for departure, sacco_id in trips)
+
+    def apply():
+        for (day, sacco_id), count in counts.items():
+            _bump(TripDailyRollup, {'day': day, 'sacco_id': sacco_id, 'status': old_status}, trip_count=-count)
+            _bump(TripDailyRollup, {'day': day, 'sacco_id': sacco_id, 'status': new_status}, trip_count=count)
+
+    transaction.on_commit(apply)
+
+
+def route_moved(route_id, old_sacco_id, new_sacco_id):
+    """
+    Move the counts of a route's trips from its old sacco's buckets to the
+    new one's after commit. Called while the route is saved, so the trips
+    are counted as that transaction sees them.
+    """
+    counts = list(Trip.objects.filter(route_id=route_id).annotate(
+        day=TruncDate('scheduled_departure')
+    ).values('day', 'status').annotate(trip_count=Count('id')).order_by().values_list('day', 'status', 'trip_count'))
+
+    def apply():
+        for day, status, count in counts:
+            _bump(TripDailyRollup, {'day': day, 'sacco_id': old_sacco_id, 'status': status}, trip_count=-count)
+            _bump(TripDailyRollup, {'day': day, 'sacco_id': new_sacco_id, 'status': status}, trip_count=count)
+
+    transaction.on_commit(apply)
+
+
+def payments_moved(payments, old_status, new_status):
+    """
+    Move payments changed with queryset.update() from one status bucket to
+    another after commit. ``payments`` are (created_at, sacco_id,
+    payment_type, amount) tuples.
+    """
+    totals = {}
+    for created_at, sacco_id, payment_type, amount in payments:
+        key = (_local_day(created_at), sacco_id, payment_type)
+        count, total = totals.get(key, (0, 0))
+        totals[key] = (count + 1, total + amount)
+
+    def apply():
+        for (day, sacco_id, payment_type), (count, total) in totals.items():
+            key = {'day': day, 'sacco_id': sacco_id, 'payment_type': payment_type}
+            _bump(PaymentDailyRollup, {**key, 'status': old_status}, payment_count=-count, total_amount=-total)
+            _bump(PaymentDailyRollup, {**key, 'status': new_status}, payment_count=count, total_amount=total)
+
+    transaction.on_commit(apply)
+
+
+def rebuild(since=None):
+    """Recompute every rollup from the source tables, optionally only from a given day."""
+    with transaction.atomic():
+        payments = Payment.objects.all()
+        users = User.objects.all()
+        trips = Trip.objects.all()
+        stale = [PaymentDailyRollup.objects, RegistrationDailyRollup.objects, TripDailyRollup.objects]
+        if since is not None:
+            payments = payments.filter(created_at__date__gte=since)
+            users = users.filter(date_joined__date__gte=since)
+            trips = trips.filter(scheduled_departure__date__gte=since)
+            stale = [manager.filter(day__gte=since) for manager in stale]
+        for rows in stale:
+            rows.all().delete()
+
+        PaymentDailyRollup.objects.bulk_create([
+            PaymentDailyRollup(**row) for row in payments.annotate(
+                day=TruncDate('created_at')
+            ).values('day', 'sacco_id', 'status', 'payment_type').annotate(
+                total_amount=Sum('amount'),
+                payment_count=Count('id')
+            ).order_by()
+        ], batch_size=1000)
+
+        RegistrationDailyRollup.objects.bulk_create([
+            RegistrationDailyRollup(**row) for row in users.annotate(
+                day=TruncDate('date_joined')
+            ).values('day', 'user_type').annotate(
+                user_count=Count('id')
+            ).order_by()
+        ], batch_size=1000)
+
+        TripDailyRollup.objects.bulk_create([
+            TripDailyRollup(day=row['day'], sacco_id=row['route__sacco_id'], status=row['status'],
+                            trip_count=row['trip_count'])
+            for row in trips.annotate(
+                day=TruncDate('scheduled_departure')
+            ).values('day', 'route__sacco_id', 'status').annotate(
+                trip_count=Count('id')
+            ).order_by()
+        ], batch_size=1000)
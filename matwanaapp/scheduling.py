@@ -0,0 +1,163 @@
+# scheduling.py
+"""
+Timetables from headways.
+
+A sacco describes each route's service as Headway bands ("every 10 minutes
+from 06:00 to 09:00 on weekdays"). ``generate`` expands the bands into
+departures for a range of days and gives every departure a matatu with the
+matatu's current driver, then writes the trips with ``bulk_create`` in
+batches.
+
+Vehicles are handed out greedily in departure order, always taking the one
+that has been free the longest, so the fleet rotates evenly. A matatu is free
+once its last trip has arrived plus ``TURNAROUND_MINUTES``, and never while
+it has another trip (generated earlier or created by hand) in that window;
+the same goes for drivers, who are left off a trip rather than double booked.
+Departures no vehicle is free for are reported, not created.
+
+Generated trips carry ``generated=True`` and a partial unique constraint on
+(route, scheduled_departure), so running it again for overlapping days only
+fills the gaps. Concurrent runs for one sacco take turns on a lock of the
+sacco row, and the constraint keeps them from duplicating a departure should
+they not.
+"""
+import bisect
+import heapq
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import planner, rollups
+from .models import Headway, Matatu, Sacco, Trip
+
+TURNAROUND_MINUTES = 10
+BATCH_SIZE = 1000
+BUSY_STATUSES = ('scheduled', 'active')
+
+
+class Intervals:
+    """Non-overlapping busy periods (epoch seconds) of one matatu or driver."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        i = bisect.bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+    def clash(self, start, end):
+        """The end of a period overlapping [start, end), or None."""
+        i = bisect.bisect_left(self.starts, end)
+        if i and self.ends[i - 1] > start:
+            return self.ends[i - 1]
+        return None
+
+
+def departures(headways, first_day, days):
+    """(epoch seconds, route id, departure, duration in seconds) for every slot of the bands, in time order."""
+    slots = []
+    for headway in headways:
+        duration = headway.route.estimated_duration_minutes * 60
+        start = headway.start_time.hour * 60 + headway.start_time.minute
+        end = headway.end_time.hour * 60 + headway.end_time.minute
+        for offset in range(days):
+            day = first_day + timedelta(days=offset)
+            if str(day.weekday()) not in headway.days:
+                continue
+            for minute in range(start, end, headway.minutes):
+                departure = timezone.make_aware(datetime(day.year, day.month, day.day, minute // 60, minute % 60))
+                slots.append((departure.timestamp(), headway.route_id, departure, duration))
+    slots.sort(key=lambda slot: slot[0])
+    return slots
+
+
+def generate(sacco, first_day, days, turnaround=TURNAROUND_MINUTES):
+    """
+    Create the trips of ``sacco``'s active headways for ``days`` days from
+    ``first_day``. Returns counts of trips created, departures that already
+    had a trip, and departures left without a matatu.
+    """
+    headways = list(Headway.objects.filter(
+        route__sacco=sacco, route__is_active=True, is_active=True
+    ).select_related('route'))
+    slots = departures(headways, first_day, days)
+    result = {'created': 0, 'existing': 0, 'unassigned': 0}
+    if not slots:
+        return result
+
+    turnaround = turnaround * 60
+    window_start = slots[0][2]
+    window_end = slots[-1][2] + timedelta(seconds=max(slot[3] for slot in slots) + turnaround)
+    fleet = list(Matatu.objects.filter(sacco=sacco, is_active=True).values_list('id', 'current_driver_id'))
+    drivers = {driver_id for _, driver_id in fleet if driver_id}
+
+    with transaction.atomic():
+        # One run per sacco at a time, so every trip built below is new
+        Sacco.objects.select_for_update().filter(id=sacco.id).first()
+        # Everything these matatus and drivers already do in the window
+        busy = defaultdict(Intervals)
+        driver_busy = defaultdict(Intervals)
+        filled = set()
+        existing = Trip.objects.filter(
+            Q(matatu__sacco=sacco) | Q(driver_id__in=drivers) | Q(route__sacco=sacco, generated=True),
+            status__in=BUSY_STATUSES + ('completed', 'cancelled'),
+            scheduled_departure__lt=window_end,
+            scheduled_arrival__gt=window_start - timedelta(seconds=turnaround),
+        ).values_list('route_id', 'matatu_id', 'driver_id', 'scheduled_departure', 'scheduled_arrival',
+                      'status', 'generated')
+        for route_id, matatu_id, driver_id, departure, arrival, status, generated in existing:
+            if generated:
+                filled.add((route_id, departure.timestamp()))
+            if status in BUSY_STATUSES:
+                span = (departure.timestamp(), arrival.timestamp() + turnaround)
+                busy[matatu_id].add(*span)
+                if driver_id:
+                    driver_busy[driver_id].add(*span)
+
+        # (free from, matatu id, driver id); the longest free comes out first
+        pool = [(float('-inf'), matatu_id, driver_id) for matatu_id, driver_id in fleet]
+        heapq.heapify(pool)
+        driver_free = {}
+        trips = []
+        for start, route_id, departure, duration in slots:
+            if (route_id, start) in filled:
+                result['existing'] += 1
+                continue
+            end = start + duration
+            assigned = None
+            while pool and pool[0][0] <= start:
+                free_from, matatu_id, driver_id = heapq.heappop(pool)
+                clash = busy[matatu_id].clash(start, end + turnaround) if matatu_id in busy else None
+                if clash is not None:
+                    heapq.heappush(pool, (clash, matatu_id, driver_id))
+                    continue
+                assigned = (matatu_id, driver_id)
+                heapq.heappush(pool, (end + turnaround, matatu_id, driver_id))
+                break
+            if assigned is None:
+                result['unassigned'] += 1
+                continue
+
+            matatu_id, driver_id = assigned
+            if driver_id and (driver_free.get(driver_id, float('-inf')) > start or
+                              (driver_id in driver_busy and driver_busy[driver_id].clash(start, end + turnaround))):
+                driver_id = None
+            if driver_id:
+                driver_free[driver_id] = end + turnaround
+            trips.append(Trip(
+                route_id=route_id, matatu_id=matatu_id, driver_id=driver_id, generated=True,
+                scheduled_departure=departure, scheduled_arrival=departure + timedelta(seconds=duration),
+            ))
+
+        Trip.objects.bulk_create(trips, batch_size=BATCH_SIZE)
+        result['created'] = len(trips)
+
+        # bulk_create sends no signals: do what the Trip signals would have
+        rollups.trips_added([(trip.scheduled_departure, sacco.id) for trip in trips], 'scheduled')
+        transaction.on_commit(planner.invalidate)
+    return result
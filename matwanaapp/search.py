@@ -0,0 +1,174 @@
+# search.py
+"""
+Ranked, typo tolerant route search.
+
+On Postgres, routes are matched with pg_trgm word similarity against GIN
+trigram indexes on the route and sacco name columns (migration 0005). On
+other databases an in-memory trigram index of the active routes is built on
+first use, dropped whenever a route or sacco is saved or deleted (see
+signals.py) and rebuilt after ``MATWANA_SEARCH_INDEX_TTL`` seconds so other
+processes pick up changes too.
+
+Both backends score a route by how well each word of the query matches the
+best field (name, start point, end point, sacco name). Misspellings and
+partially typed words still score well because they share most trigrams with
+the stored word.
+"""
+import heapq
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Greatest
+
+from .models import Route
+
+FIELDS = ('name', 'start_point', 'end_point', 'sacco')
+DEFAULT_TTL = 300
+# Share of a query word's trigrams a stored word must contain (pg_trgm's default)
+THRESHOLD = 0.6
+
+# Column holding each searchable field
+COLUMNS = {
+    'name': 'name',
+    'start_point': 'start_point',
+    'end_point': 'end_point',
+    'sacco': 'sacco__name',
+}
+
+_WORD = re.compile(r'\w+')
+
+
+def words(text):
+    return _WORD.findall(text.lower())
+
+
+def trigrams(word):
+    """pg_trgm style trigrams: two leading blanks and one trailing blank."""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class RouteIndex:
+    """
+    Two level index of the active routes: trigram -> distinct words, and
+    word -> route ids per field. A query word is compared against the
+    (small) vocabulary first, so a lookup never walks every route.
+    """
+
+    def __init__(self, rows):
+        self.names = {}
+        self.word_grams = {}
+        self.gram_words = defaultdict(set)
+        self.word_routes = {field: defaultdict(set) for field in FIELDS}
+        for row in rows:
+            self.names[row['id']] = row['name']
+            for field in FIELDS:
+                for word in words(row[COLUMNS[field]] or ''):
+                    self.word_routes[field][word].add(row['id'])
+                    if word not in self.word_grams:
+                        self.word_grams[word] = trigrams(word)
+                        for gram in self.word_grams[word]:
+                            self.gram_words[gram].add(word)
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls):
+        rows = Route.objects.filter(is_active=True).values('id', *COLUMNS.values())
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.names)
+
+    def similar_words(self, word):
+        """Indexed words containing at least THRESHOLD of the word's trigrams, with that share."""
+        grams = trigrams(word)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self.gram_words.get(gram, ()):
+                shared[candidate] += 1
+        return {
+            candidate: count / len(grams)
+            for candidate, count in shared.items()
+            if count / len(grams) >= THRESHOLD
+        }
+
+    def search(self, query, fields=FIELDS, limit=None):
+        query_words = words(query)
+        if not query_words:
+            return []
+
+        scores = None
+        for word in query_words:
+            # Best similarity of this word to any word in the chosen fields
+            best = {}
+            for candidate, similarity in self.similar_words(word).items():
+                for field in fields:
+                    for route_id in self.word_routes[field].get(candidate, ()):
+                        if similarity > best.get(route_id, 0):
+                            best[route_id] = similarity
+            if scores is None:
+                scores = best
+            else:
+                # Every word has to match somewhere
+                scores = {route_id: score + best[route_id] for route_id, score in scores.items() if route_id in best}
+
+        key = lambda route_id: (-scores[route_id], self.names[route_id])
+        if limit:
+            return heapq.nsmallest(limit, scores, key=key)
+        return sorted(scores, key=key)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    ttl = getattr(settings, 'MATWANA_SEARCH_INDEX_TTL', DEFAULT_TTL)
+    index = _index
+    if index is None or time.monotonic() - index.built_at > ttl:
+        with _index_lock:
+            if _index is None or _index is index:
+                _index = RouteIndex.build()
+            index = _index
+    return index
+
+
+def invalidate():
+    global _index
+    _index = None
+
+
+def _postgres_search(query, fields, limit):
+    from django.contrib.postgres.search import TrigramWordSimilarity
+
+    routes = Route.objects.filter(is_active=True)
+    rank = None
+    for word in words(query):
+        # column %> word, served by the GIN trigram indexes
+        match = Q()
+        for field in fields:
+            match |= Q(**{f'{COLUMNS[field]}__trigram_word_similar': word})
+        routes = routes.filter(match)
+
+        similarities = [TrigramWordSimilarity(word, COLUMNS[field]) for field in fields]
+        score = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+        rank = score if rank is None else rank + score
+
+    if rank is None:
+        return []
+    ids = routes.annotate(rank=rank).order_by('-rank', 'name').values_list('id', flat=True)
+    return list(ids[:limit] if limit else ids)
+
+
+def search_route_ids(query, fields=FIELDS, limit=None):
+    """Ids of active routes matching ``query``, best match first."""
+    fields = tuple(fields)
+    if connection.vendor == 'postgresql':
+        return _postgres_search(query, fields, limit)
+    return get_index().search(query, fields, limit)
@@ -0,0 +1,149 @@
+# signals.py
+from django.db import transaction
+from django.db.models.signals import post_init, pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from . import fares, nearby, planner, rollups, search
+from .notifications import retract
+from .events import publish
+from .principal import invalidate_principal
+from .models import User, PassengerTrip, Route, RouteStop, Sacco, Trip, Payment, Notification
+
+
+def booking_seats_changed(booking, delta):
+    # Part-route bookings may or may not change the busiest segment, so re-read the trip
+    if booking.boarding_index is None:
+        transaction.on_commit(lambda: nearby.seats_changed(booking.trip_id, delta))
+    else:
+        transaction.on_commit(lambda: nearby.trip_changed(booking.trip_id))
+
+
+@receiver(post_save, sender=PassengerTrip)
+def booking_saved(sender, instance, created, **kwargs):
+    if created:
+        booking_seats_changed(instance, 1)
+    action = 'created' if created else 'updated'
+    publish(f'user:{instance.passenger_id}', 'booking', action=action, trip_id=instance.trip_id)
+    publish('admin', 'booking', action=action, trip_id=instance.trip_id)
+
+
+@receiver(post_delete, sender=PassengerTrip)
+def booking_deleted(sender, instance, **kwargs):
+    booking_seats_changed(instance, -1)
+    publish(f'user:{instance.passenger_id}', 'booking', action='cancelled', trip_id=instance.trip_id)
+    publish('admin', 'booking', action='cancelled', trip_id=instance.trip_id)
+
+
+@receiver(post_save, sender=Trip)
+def trip_saved(sender, instance, created, **kwargs):
+    publish(f'trip:{instance.id}', 'trip', trip_id=instance.id, status=instance.status)
+    publish('admin', 'trip', trip_id=instance.id, status=instance.status)
+    # Joins or leaves the live grid as it becomes active or finishes
+    transaction.on_commit(lambda: nearby.trip_changed(instance.id))
+    transaction.on_commit(lambda: planner.trip_changed(instance.id))
+
+
+@receiver(post_delete, sender=Trip)
+def trip_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: nearby.trip_changed(instance.id))
+    transaction.on_commit(lambda: planner.trip_changed(instance.id))
+
+
+@receiver(post_save, sender=Payment)
+def payment_saved(sender, instance, created, **kwargs):
+    publish(
+        f'user:{instance.passenger_id}', 'payment',
+        payment_type=instance.payment_type, status=instance.status, amount=instance.amount
+    )
+    publish('admin', 'payment', payment_type=instance.payment_type, status=instance.status)
+
+
+@receiver(post_save, sender=Notification)
+def notification_saved(sender, instance, created, **kwargs):
+    if instance.is_active and instance.audience == 'all':
+        publish('broadcast', 'notification', notification_id=instance.id)
+    publish('admin', 'notification', notification_id=instance.id)
+
+
+@receiver(pre_delete, sender=Notification)
+def notification_deleted(sender, instance, **kwargs):
+    # Inbox rows are cascaded away; take them out of the unread counts first
+    retract(instance)
+
+
+# Cached principals
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which isn't part of the principal
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    # Role or name changes (e.g. in admin_edit_user) apply on the next request
+    invalidate_principal(instance.id)
+
+
+# Route search index
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+@receiver(post_save, sender=Sacco)
+@receiver(post_delete, sender=Sacco)
+def route_search_changed(sender, **kwargs):
+    # Rebuilding before the commit could pick up the old rows again
+    transaction.on_commit(search.invalidate)
+
+
+# Fare tables and the journey planner's graph
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+def route_fares_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fares.invalidate(instance.id))
+    transaction.on_commit(lambda: planner.route_changed(instance.id))
+
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def route_stop_changed(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fares.invalidate(instance.route_id))
+    transaction.on_commit(lambda: planner.route_changed(instance.route_id))
+
+
+# Daily rollups
+ROLLUP_MODELS = [User, Trip, Payment]
+
+
+def rollup_loaded(sender, instance, **kwargs):
+    rollups.remember(instance)
+
+
+def rollup_saving(sender, instance, **kwargs):
+    rollups.before_save(instance)
+
+
+def rollup_saved(sender, instance, **kwargs):
+    rollups.record_change(instance)
+
+
+def rollup_deleted(sender, instance, **kwargs):
+    rollups.record_change(instance, deleted=True)
+
+
+@receiver(pre_save, sender=Route)
+def route_saving(sender, instance, **kwargs):
+    instance._old_sacco_id = (
+        Route.objects.filter(pk=instance.pk).values_list('sacco_id', flat=True).first() if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Route)
+def route_saved(sender, instance, created, **kwargs):
+    # Trip buckets are keyed by sacco, which trips only know through their route
+    old = getattr(instance, '_old_sacco_id', None)
+    if not created and old != instance.sacco_id:
+        rollups.route_moved(instance.id, old, instance.sacco_id)
+
+
+for model in ROLLUP_MODELS:
+    post_init.connect(rollup_loaded, sender=model)
+    pre_save.connect(rollup_saving, sender=model)
+    post_save.connect(rollup_saved, sender=model)
+    post_delete.connect(rollup_deleted, sender=model)
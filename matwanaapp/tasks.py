@@ -0,0 +1,52 @@
+# tasks.py
+"""Background job tasks, run by manage.py run_jobs (see jobs.py)."""
+import logging
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.utils.text import slugify
+
+from . import payments
+from .jobs import task
+from .models import Matatu, Notification
+from .notifications import fan_out
+
+logger = logging.getLogger(__name__)
+
+
+@task(queue='payments', max_attempts=5)
+def complete_topup(payment_id, phone=None):
+    """
+    Take a pending wallet top-up to its payment provider (see payments.py).
+    Instant top-ups are credited here; M-Pesa ones when the callback arrives.
+    Does nothing if it was already done, and only fails (to be retried) when
+    the push never reached M-Pesa.
+    """
+    payments.request_topup(payment_id, phone)
+
+
+@task(queue='notifications')
+def fan_out_notification(notification_id):
+    try:
+        notification = Notification.objects.get(id=notification_id)
+    except Notification.DoesNotExist:
+        return  # deleted before the worker got to it
+    fan_out(notification)
+
+
+@task()
+def render_matatu_qr(matatu_id):
+    """Render the QR image for a matatu's ``qr_code_data``."""
+    try:
+        import qrcode
+    except ImportError:
+        logger.warning('qrcode is not installed; skipping the QR image for matatu %s', matatu_id)
+        return
+
+    matatu = Matatu.objects.filter(id=matatu_id).first()
+    if matatu is None:
+        return
+    buffer = BytesIO()
+    qrcode.make(matatu.qr_code_data).save(buffer, format='PNG')
+    matatu.qr_code.save(f'{slugify(matatu.plate_number)}.png', ContentFile(buffer.getvalue()), save=False)
+    matatu.save(update_fields=['qr_code'])
@@ -1,3 +1,1693 @@
-from django.test import TestCase
+import asyncio
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time as time_module
+import unittest
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib import admin
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.db.models import QuerySet
+from django.http import HttpResponse, JsonResponse
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import eta, exports, fares, ids, jobs, lifecycle, nearby, payments, planner, profiling, rollups, scheduling, search, tracking, wallet
+from .booking import book_trip, cancel_booking, BookingError
+from .events import InProcessBroker, get_broker
+from .mpesa_simulator import DarajaSimulator
+from .admin import UserAdmin
+from .forms import login_lookups, normalize_phone
+from .notifications import notifications_for, deliver, fan_out, mark_read
+from .pagination import paginate_keyset
+from .tasks import complete_topup
+from .principal import role_required
+from .models import User, Sacco, Matatu, Route, Trip, PassengerTrip, Payment, Notification, UserNotification, Job, TripLocation
+from .models import CreditEntry, Headway, ProviderCallback, TripSegment
+from .models import PaymentDailyRollup, RegistrationDailyRollup, TripDailyRollup
+
+
+def make_passenger(n, credits=0, user_type='passenger'):
+    return User.objects.create(
+        email=f'user{n}@example.com',
+        id_number=f'{10000000 + n}',
+        phone_number=f'+254700{n:06d}',
+        first_name='Test',
+        last_name=f'User{n}',
+        user_type=user_type,
+        credits=credits,
+    )
+
+
+def login_as(client, user):
+    session = client.session
+    session['user_id'] = user.id
+    session['user_type'] = user.user_type
+    session.save()
+
+
+def evaluate_context(request, template_name, context=None, *args, **kwargs):
+    """Stand-in for render() that only evaluates the querysets a template would."""
+    for value in (context or {}).values():
+        if isinstance(value, QuerySet):
+            list(value)
+    return HttpResponse(template_name)
+
+
+class QueryBudgetMixin:
+
+    def assertQueryBudget(self, path, budget, add_rows, data=None):
+        """
+        Assert a view runs at most ``budget`` queries and that the count does
+        not change after ``add_rows()`` inserts more data. Templates are not
+        rendered, so only the view's own queries are measured.
+        """
+        counts = []
+        with mock.patch('matwanaapp.views.render', evaluate_context):
+            self.client.get(path, data)  # warm the session principal
+            for _ in range(2):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(path, data)
+                self.assertEqual(response.status_code, 200)
+                counts.append(len(queries))
+                add_rows()
+        self.assertEqual(counts[0], counts[1], f'{path} runs more queries as rows are added')
+        self.assertLessEqual(counts[0], budget)
+
+
+class MatwanaTestCase(TestCase):
+    """Shared sacco / route / matatu / trip fixture."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sacco = Sacco.objects.create(
+            name='Super Metro',
+            registration_number='SM-001',
+            contact_person='Jane',
+            contact_phone='+254700000001',
+            contact_email='info@supermetro.co.ke',
+            address='Nairobi'
+        )
+        cls.route = Route.objects.create(
+            name='Route 105',
+            start_point='Town',
+            end_point='Kikuyu',
+            distance_km=25,
+            estimated_duration_minutes=60,
+            standard_fare=Decimal('100.00'),
+            sacco=cls.sacco
+        )
+        cls.matatu = Matatu.objects.create(
+            plate_number='KCA 123A',
+            fleet_number='SM01',
+            sacco=cls.sacco,
+            capacity=2,
+            qr_code_data='MATATU:KCA123A'
+        )
+        departure = timezone.now() + timedelta(hours=2)
+        cls.trip = Trip.objects.create(
+            matatu=cls.matatu,
+            route=cls.route,
+            scheduled_departure=departure,
+            scheduled_arrival=departure + timedelta(hours=1)
+        )
+
+
+class BookTripTests(MatwanaTestCase):
+
+    def test_booking_debits_wallet_and_records_payment(self):
+        passenger = make_passenger(1, credits=Decimal('250.00'))
+        booking = book_trip(passenger, self.trip.id, route_id=self.route.id)
+
+        passenger.refresh_from_db()
+        self.trip.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('150.00'))
+        self.assertEqual(self.trip.seats_booked, 1)
+        self.assertEqual(booking.fare_paid, Decimal('100.00'))
+        payment = CreditEntry.objects.get(idempotency_key=f'trip:{booking.id}').payment
+        self.assertEqual((payment.payment_type, payment.amount), ('trip', Decimal('100.00')))
+        self.assertRegex(payment.transaction_id, r'^TRIP[0-9A-Z]{26}$')
+
+    def test_full_trip_is_not_oversold(self):
+        for n in range(3):
+            passenger = make_passenger(n, credits=Decimal('100.00'))
+            if n < 2:
+                book_trip(passenger, self.trip.id)
+            else:
+                with self.assertRaisesMessage(BookingError, 'fully booked'):
+                    book_trip(passenger, self.trip.id)
+                passenger.refresh_from_db()
+                self.assertEqual(passenger.credits, Decimal('100.00'))
+
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 2)
+        self.assertEqual(PassengerTrip.objects.filter(trip=self.trip).count(), 2)
+
+    def test_insufficient_balance_releases_seat(self):
+        passenger = make_passenger(1, credits=Decimal('50.00'))
+        with self.assertRaisesMessage(BookingError, 'Insufficient wallet balance'):
+            book_trip(passenger, self.trip.id)
+
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 0)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_duplicate_booking_rejected(self):
+        passenger = make_passenger(1, credits=Decimal('500.00'))
+        book_trip(passenger, self.trip.id)
+        with self.assertRaisesMessage(BookingError, 'already booked'):
+            book_trip(passenger, self.trip.id)
+
+        passenger.refresh_from_db()
+        self.trip.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('400.00'))
+        self.assertEqual(self.trip.seats_booked, 1)
+
+
+class SeatCounterTests(MatwanaTestCase):
+
+    def test_cancel_frees_seat_and_refunds(self):
+        passenger = make_passenger(1, credits=Decimal('100.00'))
+        booking = book_trip(passenger, self.trip.id)
+        cancel_booking(booking)
+
+        passenger.refresh_from_db()
+        self.trip.refresh_from_db()
+        self.assertEqual(passenger.credits, Decimal('100.00'))
+        self.assertEqual(self.trip.seats_booked, 0)
+        self.assertEqual(self.trip.seats_available, 2)
+        self.assertTrue(Payment.objects.filter(payment_type='refund', amount=Decimal('100.00')).exists())
+
+        with self.assertRaisesMessage(BookingError, 'already been cancelled'):
+            cancel_booking(booking)
+
+    def test_reconcile_seats_fixes_drift(self):
+        passenger = make_passenger(1, credits=Decimal('100.00'))
+        book_trip(passenger, self.trip.id)
+        Trip.objects.filter(id=self.trip.id).update(seats_booked=2)
+
+        call_command('reconcile_seats', stdout=StringIO())
+
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 1)
+
+    def test_active_bookings_does_not_count_per_booking(self):
+        passenger = make_passenger(1, credits=Decimal('500.00'))
+        book_trip(passenger, self.trip.id)
+        login_as(self.client, passenger)
+        self.client.get('/api/active-bookings/')
+
+        # Session and principal come from the cache; only the bookings join remains
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/active-bookings/')
+        self.assertEqual(response.json()['bookings'][0]['seats_available'], 1)
+
+
+class EventBrokerTests(MatwanaTestCase):
+
+    def test_publish_fans_out_to_subscribed_channels(self):
+        async def scenario():
+            broker = InProcessBroker()
+            passenger_stream = broker.subscribe(['user:1', 'broadcast'])
+            admin_stream = broker.subscribe(['admin', 'broadcast'])
+
+            broker.publish('broadcast', {'type': 'notification'})
+            broker.publish('user:1', {'type': 'booking'})
+            await asyncio.sleep(0)
+
+            received = (
+                [(await passenger_stream.get(1))['type'], (await passenger_stream.get(1))['type']],
+                [(await admin_stream.get(1))['type']],
+            )
+            admin_stream.close()
+            passenger_stream.close()
+            self.assertEqual(broker._channels, {})
+            return received
+
+        self.assertEqual(asyncio.run(scenario()), (['notification', 'booking'], ['notification']))
+
+    def test_booking_publishes_after_commit(self):
+        passenger = make_passenger(1, credits=Decimal('100.00'))
+        loop = asyncio.new_event_loop()
+        subscription = get_broker().subscribe([f'user:{passenger.id}'], loop=loop)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            book_trip(passenger, self.trip.id)
+            loop.run_until_complete(asyncio.sleep(0))
+            self.assertTrue(subscription.queue.empty())
+
+        loop.run_until_complete(asyncio.sleep(0))
+        types = set()
+        while not subscription.queue.empty():
+            types.add(subscription.queue.get_nowait()['type'])
+        subscription.close()
+        loop.close()
+        self.assertEqual(types, {'booking', 'payment'})
+
+
+class AdminDashboardQueryTests(MatwanaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.admin = make_passenger(900, user_type='super_admin')
+        for n in range(5):
+            passenger = make_passenger(n, credits=Decimal('500.00'))
+            Payment.objects.create(
+                passenger=passenger,
+                payment_type='credit_topup',
+                amount=Decimal('500.00'),
+                transaction_id=f'TOPUP{n}',
+                payment_method='mpesa',
+                status='completed' if n % 2 else 'pending',
+            )
+        rollups.rebuild()
+
+    def setUp(self):
+        login_as(self.client, self.admin)
+
+    def test_admin_dashboard_query_count(self):
+        self.client.get('/superadmin/')
+        # User and payment aggregates, four table counts, users by month,
+        # recent users and recent saccos
+        with self.assertNumQueries(9):
+            response = self.client.get('/superadmin/')
+        self.assertEqual(response.context['total_passengers'], 5)
+        self.assertEqual(response.context['payment_stats']['total_transactions'], 2)
+        self.assertEqual(response.context['payment_stats']['pending_payments'], 3)
+
+    def test_admin_dashboard_stats_query_count(self):
+        self.client.get('/superadmin/api/dashboard-stats/')
+        # Registrations, payments and trips grouped queries, then the three
+        # recent activity lists
+        with self.assertNumQueries(6):
+            response = self.client.get('/superadmin/api/dashboard-stats/')
+        data = response.json()
+        self.assertEqual(len(data['user_registrations']), 7)
+        self.assertEqual(len(data['payment_stats']), 7)
+        self.assertEqual(data['trip_stats'], {'active': 0, 'scheduled': 1, 'completed': 0})
+
+
+class RollupTests(MatwanaTestCase):
+
+    def rollup_rows(self):
+        return (
+            list(PaymentDailyRollup.objects.filter(payment_count__gt=0).order_by(
+                'day', 'status', 'payment_type', 'sacco_id'
+            ).values_list('day', 'sacco_id', 'status', 'payment_type', 'total_amount', 'payment_count')),
+            list(RegistrationDailyRollup.objects.filter(user_count__gt=0).order_by(
+                'day', 'user_type'
+            ).values_list('day', 'user_type', 'user_count')),
+            list(TripDailyRollup.objects.filter(trip_count__gt=0).order_by(
+                'day', 'status', 'sacco_id'
+            ).values_list('day', 'sacco_id', 'status', 'trip_count')),
+        )
+
+    def test_incremental_rollups_match_rebuild(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            passenger = make_passenger(1, credits=Decimal('300.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            book_trip(passenger, self.trip.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            topup = Payment.objects.create(
+                passenger=passenger,
+                payment_type='credit_topup',
+                amount=Decimal('200.00'),
+                transaction_id='TOPUP1',
+                payment_method='mpesa',
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            topup.status = 'completed'
+            topup.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            trip = Trip.objects.only('id', 'status').get(id=self.trip.id)
+            trip.status = 'active'
+            trip.save()
+
+        # The fixture trip was created outside a captured commit, so its
+        # 'scheduled' bucket went to -1 instead of 0; rows <= 0 are ignored
+        incremental = self.rollup_rows()
+        rollups.rebuild()
+        rebuilt = self.rollup_rows()
+        self.assertEqual(incremental, rebuilt)
+
+        payments, registrations, trips = rebuilt
+        self.assertIn((timezone.localdate(), self.sacco.id, 'completed', 'trip', Decimal('100.00'), 1), payments)
+        self.assertIn((timezone.localdate(), None, 'completed', 'credit_topup', Decimal('200.00'), 1), payments)
+        self.assertEqual(registrations, [(timezone.localdate(), 'passenger', 1)])
+        self.assertEqual([row[2:] for row in trips], [('active', 1)])
+
+    def test_route_moving_to_another_sacco_takes_its_trip_counts(self):
+        other = Sacco.objects.create(
+            name='Forward Travelers', registration_number='FT-001', contact_person='John',
+            contact_phone='+254700000002', contact_email='info@forward.co.ke', address='Nairobi'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            trip = Trip.objects.create(
+                matatu=self.matatu, route=self.route, scheduled_departure=self.trip.scheduled_departure,
+                scheduled_arrival=self.trip.scheduled_arrival
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.route.sacco = other
+            self.route.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            trip.status = 'cancelled'
+            trip.save()
+
+        incremental = self.rollup_rows()[2]
+        rollups.rebuild()
+        self.assertEqual(incremental, self.rollup_rows()[2])
+        self.assertEqual({row[1] for row in incremental}, {other.id})
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for n in range(7):
+            make_passenger(n)
+        # Ties on the sort key must still page deterministically
+        User.objects.filter(id__in=User.objects.order_by('id').values('id')[:4]).update(
+            date_joined=timezone.now() - timedelta(days=1)
+        )
+
+    def page(self, **params):
+        request = RequestFactory().get('/superadmin/users/', params)
+        return paginate_keyset(request, User.objects.all(), '-date_joined', per_page=3)
+
+    def test_pages_cover_every_row_once_in_order(self):
+        expected = list(User.objects.order_by('-date_joined', '-id').values_list('id', flat=True))
+        seen = []
+        page = self.page(user_type='passenger')
+        self.assertFalse(page.has_previous)
+        while True:
+            seen += [user.id for user in page]
+            if not page.has_next:
+                break
+            self.assertIn('user_type=passenger', page.next_query)
+            page = self.page(user_type='passenger', after=page.next_cursor)
+        self.assertEqual(seen, expected)
+
+    def test_previous_returns_to_the_same_page(self):
+        first = self.page()
+        second = self.page(after=first.next_cursor)
+        back = self.page(before=second.previous_cursor)
+        self.assertEqual([u.id for u in back], [u.id for u in first])
+        self.assertFalse(back.has_previous)
+        self.assertTrue(back.has_next)
+
+    def test_malformed_cursor_falls_back_to_first_page(self):
+        self.assertEqual([u.id for u in self.page(after='garbage')], [u.id for u in self.page()])
+
+
+class ListViewQueryBudgetTests(QueryBudgetMixin, MatwanaTestCase):
+
+    def setUp(self):
+        self.rows = 0
+
+    def add_sacco_with_fleet(self):
+        self.rows += 1
+        n = self.rows
+        sacco = Sacco.objects.create(
+            name=f'Sacco {n}', registration_number=f'REG{n}', contact_person='X',
+            contact_phone='+254700000002', contact_email='x@example.com', address='Nairobi'
+        )
+        driver = make_passenger(500 + n, user_type='driver')
+        route = Route.objects.create(
+            name=f'Route {n}', start_point='Town', end_point=f'Stage {n}', distance_km=10,
+            estimated_duration_minutes=30, standard_fare=Decimal('80.00'), sacco=sacco
+        )
+        matatu = Matatu.objects.create(
+            plate_number=f'KDA {n}', fleet_number=f'F{n}', sacco=sacco, capacity=14,
+            qr_code_data=f'MATATU:KDA{n}', current_driver=driver
+        )
+        departure = timezone.now() + timedelta(hours=n)
+        Trip.objects.create(
+            matatu=matatu, route=route, scheduled_departure=departure,
+            scheduled_arrival=departure + timedelta(minutes=30)
+        )
+
+    def test_manage_saccos_budget(self):
+        login_as(self.client, make_passenger(900, user_type='super_admin'))
+        self.assertQueryBudget('/superadmin/saccos/', 3, self.add_sacco_with_fleet)
+
+    def test_manage_saccos_counts(self):
+        self.add_sacco_with_fleet()
+        login_as(self.client, make_passenger(900, user_type='super_admin'))
+        with mock.patch('matwanaapp.views.render') as render:
+            render.return_value = HttpResponse()
+            self.client.get('/superadmin/saccos/', {'search': 'Sacco 1'})
+        row = list(render.call_args.args[2]['saccos'])[0]
+        self.assertEqual((row.matatu_count, row.route_count, row.driver_count), (1, 1, 1))
+
+    def test_manage_routes_budget(self):
+        login_as(self.client, make_passenger(900, user_type='super_admin'))
+        self.assertQueryBudget('/superadmin/routes/', 4, self.add_sacco_with_fleet)
+
+    def test_routes_list_budget(self):
+        login_as(self.client, make_passenger(1, credits=Decimal('100.00')))
+        self.assertQueryBudget('/routes_list/', 7, self.add_sacco_with_fleet)
+
+
+class PrincipalTests(TestCase):
+
+    def setUp(self):
+        self.passenger = make_passenger(1)
+        self.admin = make_passenger(2, user_type='super_admin')
+
+        @role_required('passenger', api=True)
+        def view(request):
+            return JsonResponse({'success': True, 'name': request.principal.get_full_name()})
+        self.view = view
+
+    def call(self, user):
+        request = RequestFactory().get('/')
+        request.session = {'user_id': user.id}
+        return json.loads(self.view(request).content)
+
+    def test_warm_role_check_runs_no_queries(self):
+        self.call(self.passenger)
+        self.call(self.admin)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.call(self.passenger)['success'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.call(self.admin)['message'], 'Access denied')
+
+    def test_not_logged_in(self):
+        request = RequestFactory().get('/')
+        request.session = {}
+        self.assertEqual(json.loads(self.view(request).content)['message'], 'Not authenticated')
+
+    def test_admin_edit_user_invalidates_cached_role(self):
+        self.assertTrue(self.call(self.passenger)['success'])
+
+        login_as(self.client, self.admin)
+        self.client.post(f'/superadmin/users/edit/{self.passenger.id}/', {
+            'user_type': 'driver',
+            'first_name': 'Jane',
+            'last_name': 'Doe',
+            'email': self.passenger.email,
+            'phone_number': self.passenger.phone_number,
+            'is_active': 'on',
+        })
+
+        self.assertEqual(self.call(self.passenger)['message'], 'Access denied')
+
+
+class LoginLookupTests(TestCase):
+
+    def test_identifiers_are_classified(self):
+        self.assertEqual(login_lookups('12345678'), [{'id_number': '12345678'}])
+        self.assertEqual(login_lookups('0712 345 678'), [{'phone_number': '+254712345678'}])
+        self.assertEqual(login_lookups('+254712345678'), [{'phone_number': '+254712345678'}])
+        self.assertEqual(login_lookups('John@Example.com'), [{'email__in': {'John@Example.com', 'john@example.com'}}])
+        # Could be an ID number or a phone number without the leading 0
+        self.assertEqual(login_lookups('712345678'), [
+            {'id_number': '712345678'}, {'phone_number': '+254712345678'}
+        ])
+
+    def test_login_with_local_phone_number(self):
+        user = make_passenger(1)
+        user.set_password('secret-pass')
+        user.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/login/', {'username': '0700 000 001', 'password': 'secret-pass'})
+        self.assertRedirects(response, '/dashboard/', fetch_redirect_response=False)
+        self.assertEqual(self.client.session['user_id'], user.id)
+
+        user.refresh_from_db()
+        self.assertIsNotNone(user.last_login)
+        update = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "matwanaapp_user"')]
+        self.assertEqual(len(update), 1)
+        self.assertNotIn('"credits"', update[0])
+
+    def test_accounts_added_by_admins_log_in_by_phone(self):
+        login_as(self.client, make_passenger(1, user_type='super_admin'))
+        self.client.post('/superadmin/users/add/', {
+            'user_type': 'driver', 'first_name': 'Jo', 'last_name': 'Dereva', 'email': 'jo@example.com',
+            'phone_number': '0712 345 678', 'id_number': '23456789', 'password': 'secret-pass',
+        })
+        user = User.objects.get(email='jo@example.com')
+        self.assertEqual(user.phone_number, '+254712345678')
+        self.client.post(f'/superadmin/users/edit/{user.id}/', {
+            'user_type': 'driver', 'first_name': 'Jo', 'last_name': 'Dereva', 'email': 'jo@example.com',
+            'phone_number': '0722 000 111', 'is_active': 'on',
+        })
+        user.refresh_from_db()
+        self.assertEqual(user.phone_number, '+254722000111')
+
+        self.client.logout()
+        self.client.post('/login/', {'username': '0722000111', 'password': 'secret-pass'})
+        self.assertEqual(self.client.session['user_id'], user.id)
+
+    def test_migration_normalizes_stored_phone_numbers(self):
+        migration = importlib.import_module('matwanaapp.migrations.0016_normalize_phone_numbers')
+        typed = make_passenger(1)
+        clash = make_passenger(2)
+        User.objects.filter(id=typed.id).update(phone_number='0733 111 222')
+        User.objects.filter(id=clash.id).update(phone_number='0700000003')
+        make_passenger(3)  # already has +254700000003
+
+        migration.normalize_phone_numbers(django_apps, None)
+        self.assertEqual(User.objects.get(id=typed.id).phone_number, '+254733111222')
+        self.assertEqual(User.objects.get(id=clash.id).phone_number, '0700000003')
+
+
+class RouteSearchTests(MatwanaTestCase):
+
+    def add_route(self, name, start, end):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Route.objects.create(
+                name=name, start_point=start, end_point=end, distance_km=10,
+                estimated_duration_minutes=30, standard_fare=Decimal('80.00'), sacco=self.sacco
+            )
+
+    def setUp(self):
+        search.invalidate()
+        self.westlands = self.add_route('Route 23', 'Town', 'Westlands')
+        self.west = self.add_route('Route 24', 'Town', 'West')
+        self.rongai = self.add_route('Route 125', 'Town', 'Rongai')
+
+    def test_typos_and_prefixes_match(self):
+        self.assertEqual(search.search_route_ids('westlnds'), [self.westlands.id])
+        self.assertEqual(search.search_route_ids('rong'), [self.rongai.id])
+        self.assertEqual(search.search_route_ids('super metro rongai'), [self.rongai.id])
+
+    def test_exact_word_ranks_first(self):
+        self.assertEqual(search.search_route_ids('west'), [self.west.id, self.westlands.id])
+
+    def test_field_restricted_search(self):
+        self.assertEqual(search.search_route_ids('town', fields=['end_point']), [])
+        self.assertEqual(len(search.search_route_ids('town', fields=['start_point'])), 4)
+
+    def test_saving_a_route_refreshes_the_index(self):
+        self.assertEqual(search.search_route_ids('kitengela'), [])
+        route = self.add_route('Route 110', 'Town', 'Kitengela')
+        self.assertEqual(search.search_route_ids('kitengela'), [route.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            route.is_active = False
+            route.save()
+        self.assertEqual(search.search_route_ids('kitengela'), [])
+
+    def test_search_api_returns_ranked_routes(self):
+        response = self.client.get('/api/routes/search/', {'q': 'westlands'})
+        self.assertEqual([r['id'] for r in response.json()['routes']], [self.westlands.id])
+
+
+class NotificationAudienceTests(MatwanaTestCase):
+
+    def setUp(self):
+        self.admin = make_passenger(900, user_type='super_admin')
+        self.passenger = make_passenger(1, credits=Decimal('500.00'))
+        self.driver = make_passenger(2, user_type='driver')
+        self.outsider = make_passenger(3)
+        self.matatu.current_driver = self.driver
+        self.matatu.save()
+        book_trip(self.passenger, self.trip.id)
+
+    def notify(self, audience, saccos=(), recipients=()):
+        notification = Notification.objects.create(
+            title=audience, message='Hello', notification_type='system',
+            audience=audience, created_by=self.admin
+        )
+        notification.saccos.set(saccos)
+        notification.recipients.set(recipients)
+        return notification
+
+    def visible(self, user):
+        return set(notifications_for(user).values_list('title', flat=True))
+
+    def test_audience_is_resolved_per_reader(self):
+        self.notify('all')
+        self.notify('saccos', saccos=[self.sacco])
+        self.notify('specific', recipients=[self.outsider])
+
+        self.assertEqual(self.visible(self.passenger), {'all', 'saccos'})
+        self.assertEqual(self.visible(self.driver), {'all', 'saccos'})
+        self.assertEqual(self.visible(self.outsider), {'all', 'specific'})
+
+    def test_broadcast_writes_no_per_user_rows(self):
+        login_as(self.client, self.admin)
+        self.client.get('/superadmin/api/dashboard-stats/')  # warm the session principal
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/superadmin/notifications/add/', {
+                'title': 'Fare change', 'message': 'Fares drop on Sunday',
+                'notification_type': 'price_change', 'recipient_type': 'all',
+            })
+        notification = Notification.objects.get(title='Fare change')
+        self.assertEqual(notification.audience, 'all')
+        self.assertEqual(notification.recipients.count(), 0)
+        self.assertFalse(any('matwanaapp_user' in q['sql'] for q in queries))
+        self.assertFalse(Job.objects.filter(task='matwanaapp.tasks.fan_out_notification').exists())
+
+        self.client.post('/superadmin/notifications/add/', {
+            'title': 'Route change', 'message': 'Stage moved', 'notification_type': 'system',
+            'recipient_type': 'saccos', 'saccos': [self.sacco.id],
+        })
+        job = Job.objects.get(task='matwanaapp.tasks.fan_out_notification')
+        self.assertEqual(job.payload, {'notification_id': Notification.objects.get(title='Route change').id})
+
+    def test_fan_out_in_batches_is_idempotent(self):
+        notification = self.notify('saccos', saccos=[self.sacco])
+        self.assertEqual(fan_out(notification, batch_size=1), 2)
+        fan_out(notification, batch_size=1)
+        self.assertEqual(
+            set(UserNotification.objects.values_list('user_id', flat=True)),
+            {self.passenger.id, self.driver.id}
+        )
+
+    def test_deliver_writes_rows_lazily(self):
+        self.notify('all')
+        self.assertFalse(UserNotification.objects.exists())
+        deliver(self.outsider)
+        deliver(self.outsider)
+        self.assertEqual(UserNotification.objects.filter(user=self.outsider).count(), 1)
+
+
+class NotificationInboxTests(NotificationAudienceTests):
+
+    def unread(self, user):
+        return User.objects.get(id=user.id).unread_notifications
+
+    def test_unread_count_follows_inbox(self):
+        first = self.notify('all')
+        self.notify('specific', recipients=[self.outsider])
+        deliver(self.outsider)
+        self.assertEqual(self.unread(self.outsider), 2)
+
+        mark_read(self.outsider, [first.id])
+        self.assertEqual(self.unread(self.outsider), 1)
+        mark_read(self.outsider)
+        self.assertEqual(self.unread(self.outsider), 0)
+        self.assertFalse(UserNotification.objects.filter(is_read=False).exists())
+
+    def test_fan_out_and_delete_adjust_counts(self):
+        notification = self.notify('saccos', saccos=[self.sacco])
+        fan_out(notification)
+        fan_out(notification)
+        self.assertEqual(self.unread(self.driver), 1)
+
+        notification.delete()
+        self.assertEqual(self.unread(self.driver), 0)
+
+    def test_admin_edit_keeps_an_inbox_change_made_meanwhile(self):
+        notification = self.notify('specific', recipients=[self.outsider])
+        login_as(self.client, self.admin)
+
+        def deliver_meanwhile(phone_number):
+            # Lands after the view read the user and before it saves
+            fan_out(notification)
+            return normalize_phone(phone_number)
+
+        with mock.patch('matwanaapp.views.normalize_phone', side_effect=deliver_meanwhile):
+            self.client.post(f'/superadmin/users/edit/{self.outsider.id}/', {
+                'user_type': 'passenger', 'first_name': 'Out', 'last_name': 'Sider',
+                'email': self.outsider.email, 'phone_number': self.outsider.phone_number, 'is_active': 'on',
+            })
+        self.assertEqual(User.objects.get(id=self.outsider.id).first_name, 'Out')
+        self.assertEqual(self.unread(self.outsider), 1)
+
+    def test_inbox_page_and_mark_read_api(self):
+        for i in range(3):
+            self.notify('all')
+        login_as(self.client, self.outsider)
+
+        response = self.client.get('/notifications/')
+        self.assertEqual(response.context['unread_count'], 3)
+        self.assertEqual(len(response.context['notifications']), 3)
+
+        response = self.client.post('/api/notifications/mark-read/', '{}', content_type='application/json')
+        self.assertEqual(response.json()['marked'], 3)
+        self.assertEqual(response.json()['unread_notifications'], 0)
+
+    def test_badge_is_read_from_the_user_row(self):
+        self.notify('all')
+        deliver(self.outsider)
+        login_as(self.client, self.outsider)
+        self.client.get('/api/dashboard-data/')
+        with self.assertNumQueries(3):
+            stats = self.client.get('/api/dashboard-data/').json()['stats']
+        self.assertEqual(stats['unread_notifications'], 1)
+
+
+calls = []
+
+
+@jobs.task(max_attempts=2)
+def flaky_task(fail):
+    calls.append(fail)
+    if fail:
+        raise RuntimeError('boom')
+
+
+class JobQueueTests(MatwanaTestCase):
+
+    def setUp(self):
+        calls.clear()
+        self.passenger = make_passenger(1, credits=Decimal('50.00'))
+
+    def test_idempotency_key_enqueues_once(self):
+        first = jobs.enqueue(flaky_task, key='once', fail=False)
+        second = jobs.enqueue(flaky_task, key='once', fail=False)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [False])
+        self.assertEqual(Job.objects.get(id=first.id).status, 'done')
+
+    def test_claimed_job_is_not_handed_out_twice(self):
+        jobs.enqueue(flaky_task, fail=False)
+        self.assertEqual(len(jobs.claim(worker='a')), 1)
+        self.assertEqual(jobs.claim(worker='b'), [])
+
+    def test_failures_are_retried_then_marked_failed(self):
+        job = jobs.enqueue(flaky_task, fail=True)
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIn('boom', job.last_error)
+
+        Job.objects.filter(id=job.id).update(run_at=timezone.now())
+        jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_stale_running_jobs_are_put_back(self):
+        job = jobs.enqueue(flaky_task, fail=False)
+        jobs.claim(worker='crashed')
+        Job.objects.filter(id=job.id).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.release_stale(timeout=60), 1)
+        self.assertEqual(jobs.run_pending(), 1)
+
+    def test_top_up_is_credited_by_the_worker(self):
+        login_as(self.client, self.passenger)
+        response = self.client.post('/process-payment/', json.dumps({'amount': 200, 'payment_method': 'mpesa'}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['status'], 'pending')
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('50.00'))
+
+        self.assertEqual(jobs.run_pending(queue='payments'), 1)
+        payment = Payment.objects.get(id=response.json()['payment_id'])
+        self.passenger.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual(self.passenger.credits, Decimal('250.00'))
+
+        # Running the task again does not credit twice
+        complete_topup(payment.id)
+        self.passenger.refresh_from_db()
+        self.assertEqual(self.passenger.credits, Decimal('250.00'))
+
+
+# Positions are flushed by the tests themselves, not by ingest or the background thread
+@override_settings(MATWANA_LOCATION_FLUSH_INTERVAL=3600)
+class LocationIngestTests(MatwanaTestCase):
+
+    def setUp(self):
+        tracking.flush()
+        self.addCleanup(tracking.flush)
+        self.driver = make_passenger(1, user_type='driver')
+        Trip.objects.filter(id=self.trip.id).update(driver=self.driver, status='active')
+        login_as(self.client, self.driver)
+
+    def post(self, pings, trip_id=None):
+        body = {'trip_id': trip_id or self.trip.id, 'pings': pings}
+        return self.client.post('/api/driver/locations/', json.dumps(body), content_type='application/json').json()
+
+    def ping(self, seconds_ago, lat=-1.28):
+        return {'lat': lat, 'lng': 36.82, 'ts': (timezone.now() - timedelta(seconds=seconds_ago)).timestamp()}
+
+    def test_batch_is_appended_and_position_written_on_flush(self):
+        response = self.post([self.ping(3, lat=-1.1), self.ping(1, lat=-1.3), self.ping(2, lat=-1.2)])
+        self.assertEqual(response['accepted'], 3)
+        self.assertEqual(TripLocation.objects.filter(trip=self.trip).count(), 3)
+
+        # Trip is only written when the buffer is flushed
+        self.trip.refresh_from_db()
+        self.assertIsNone(self.trip.current_location_lat)
+        self.assertEqual(tracking.flush(), 1)
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_location_lat, Decimal('-1.300000'))
+
+    def test_flush_never_moves_a_trip_back_in_time(self):
+        Trip.objects.filter(id=self.trip.id).update(
+            current_location_lat=Decimal('-1.5'), location_updated_at=timezone.now()
+        )
+        tracking.record(self.trip.id, [tracking.parse_ping(self.ping(30, lat=-1.1))])
+        tracking.flush()
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.current_location_lat, Decimal('-1.500000'))
+
+    def test_flush_writes_in_batches_and_keeps_positions_it_could_not_write(self):
+        other = Trip.objects.create(
+            matatu=self.matatu, route=self.route, driver=self.driver, status='active',
+            scheduled_departure=timezone.now(), scheduled_arrival=timezone.now() + timedelta(hours=1)
+        )
+        for trip in (self.trip, other):
+            tracking.record(trip.id, [tracking.parse_ping(self.ping(5, lat=-1.2))])
+
+        with mock.patch.object(tracking, '_write', side_effect=DatabaseError('locked')):
+            with self.assertRaises(DatabaseError):
+                tracking.flush()
+        with mock.patch.object(tracking, 'FLUSH_BATCH', 1), self.assertNumQueries(2):
+            self.assertEqual(tracking.flush(), 2)
+        self.assertEqual(
+            Trip.objects.filter(id__in=[self.trip.id, other.id], current_location_lat=Decimal('-1.2')).count(), 2
+        )
+
+    def test_rejects_other_drivers_and_bad_pings(self):
+        other = make_passenger(2, user_type='driver')
+        login_as(self.client, other)
+        self.assertFalse(self.post([self.ping(1)])['success'])
+
+        login_as(self.client, self.driver)
+        self.assertFalse(self.post([{'lat': 95, 'lng': 36.8, 'ts': timezone.now().timestamp()}])['success'])
+        self.assertFalse(self.post([self.ping(60 * 60 * 24)])['success'])
+        self.assertFalse(self.post([])['success'])
+        self.assertFalse(TripLocation.objects.exists())
+
+    def test_prune_drops_old_history(self):
+        TripLocation.objects.create(trip=self.trip, latitude=0, longitude=0,
+                                    recorded_at=timezone.now() - timedelta(days=40))
+        TripLocation.objects.create(trip=self.trip, latitude=0, longitude=0, recorded_at=timezone.now())
+        tracking.prune(keep_days=30)
+        self.assertEqual(TripLocation.objects.count(), 1)
+
+
+class NearbyTripsTests(MatwanaTestCase):
+
+    def setUp(self):
+        nearby.invalidate()
+        self.passenger = make_passenger(1, credits=Decimal('500.00'))
+        now = timezone.now()
+        Trip.objects.filter(id=self.trip.id).update(
+            status='active', current_location_lat=Decimal('-1.2860'),
+            current_location_lng=Decimal('36.8170'), location_updated_at=now
+        )
+        self.addCleanup(nearby.invalidate)
+        self.addCleanup(tracking.flush)
+
+    def ids(self, **kwargs):
+        return [trip['trip_id'] for trip in nearby.nearby(-1.2864, 36.8172, **kwargs)]
+
+    def test_radius_and_nearest_queries(self):
+        far_matatu = Matatu.objects.create(plate_number='KDA 1', fleet_number='2', sacco=self.sacco,
+                                           capacity=14, qr_code_data='MATATU:KDA1')
+        far = Trip.objects.create(
+            matatu=far_matatu, route=self.route, status='active',
+            scheduled_departure=timezone.now(), scheduled_arrival=timezone.now() + timedelta(hours=1),
+            current_location_lat=Decimal('-1.3500'), current_location_lng=Decimal('36.9000'),
+            location_updated_at=timezone.now()
+        )
+        self.assertEqual(self.ids(radius_km=1), [self.trip.id])
+        self.assertEqual(self.ids(k=2), [self.trip.id, far.id])
+        self.assertEqual(self.ids(k=1, route_id=self.route.id + 1), [])
+
+    def test_index_follows_pings_bookings_and_status(self):
+        self.assertEqual(self.ids(radius_km=1), [self.trip.id])
+
+        # A ping moves the trip out of range
+        tracking.record(self.trip.id, [TripLocation(latitude=Decimal('-1.5'), longitude=Decimal('36.8'),
+                                                    recorded_at=timezone.now())])
+        self.assertEqual(self.ids(radius_km=1), [])
+        tracking.record(self.trip.id, [TripLocation(latitude=Decimal('-1.2861'), longitude=Decimal('36.8171'),
+                                                    recorded_at=timezone.now())])
+
+        # Two bookings fill the two seats
+        for n in (2, 3):
+            with self.captureOnCommitCallbacks(execute=True):
+                book_trip(make_passenger(n, credits=Decimal('500.00')), self.trip.id)
+        self.assertEqual(self.ids(radius_km=1, min_seats=1), [])
+        self.assertEqual(self.ids(radius_km=1), [self.trip.id])
+
+        # Completed trips leave the grid
+        self.trip.refresh_from_db()
+        self.trip.status = 'completed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trip.save()
+        self.assertEqual(self.ids(radius_km=1), [])
+
+    def test_api_runs_no_queries_once_warm(self):
+        login_as(self.client, self.passenger)
+        url = '/api/trips/nearby/?lat=-1.2864&lng=36.8172&radius=2'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            trips = self.client.get(url).json()['trips']
+        self.assertEqual(trips[0]['trip_id'], self.trip.id)
+        self.assertEqual(trips[0]['seats_available'], 2)
+
+
+class EtaTests(MatwanaTestCase):
+
+    def setUp(self):
+        eta.invalidate()
+        self.addCleanup(eta.invalidate)
+
+    def completed_trip(self, hour, minutes, days_ago=1):
+        departure = timezone.localtime().replace(hour=hour, minute=0, second=0, microsecond=0) - timedelta(days=days_ago)
+        return Trip.objects.create(
+            matatu=self.matatu, route=self.route, status='completed',
+            scheduled_departure=departure, scheduled_arrival=departure + timedelta(hours=1),
+            actual_departure=departure, actual_arrival=departure + timedelta(minutes=minutes)
+        )
+
+    def test_learns_travel_time_by_hour(self):
+        for day in range(1, 7):
+            self.completed_trip(8, 50, days_ago=day)
+            self.completed_trip(17, 90, days_ago=day)
+
+        morning, evening, night = [
+            eta.estimate(self.route, timezone.localtime().replace(hour=hour))
+            for hour in (8, 17, 3)
+        ]
+        self.assertEqual((morning['minutes'], morning['source']), (50, 'history'))
+        self.assertEqual(evening['minutes'], 90)
+        # No trips at 3am: the route's figures over all hours
+        self.assertEqual(night['p90_minutes'], 90)
+
+    def test_routes_without_history_use_the_static_estimate(self):
+        self.completed_trip(8, 50)
+        result = eta.estimate(self.route, timezone.now())
+        self.assertEqual((result['minutes'], result['source']), (60, 'route'))
+
+    def test_without_numpy_every_estimate_is_static(self):
+        for day in range(1, 7):
+            self.completed_trip(8, 50, days_ago=day)
+        with mock.patch.object(eta, 'np', None):
+            result = eta.estimate(self.route, timezone.localtime().replace(hour=8))
+            self.assertEqual((result['minutes'], result['p90_minutes'], result['source']), (60, 60, 'route'))
+            self.assertEqual(eta.route_profile(self.route), [None] * eta.HOURS)
+
+    def test_refresh_only_reads_new_trips(self):
+        for day in range(1, 6):
+            self.completed_trip(8, 40, days_ago=day)
+        model = eta.get_model()
+        self.assertEqual(model.refresh(), 0)
+        departure = timezone.now() - timedelta(hours=1)
+        Trip.objects.create(
+            matatu=self.matatu, route=self.route, status='completed',
+            scheduled_departure=departure, scheduled_arrival=departure + timedelta(hours=1),
+            actual_departure=departure, actual_arrival=departure + timedelta(minutes=40)
+        )
+        self.assertEqual(model.refresh(), 1)
+        self.assertEqual(len(model.minutes), 6)
+
+    def test_active_bookings_include_arrival_estimate(self):
+        passenger = make_passenger(1, credits=Decimal('500.00'))
+        book_trip(passenger, self.trip.id)
+        login_as(self.client, passenger)
+        booking = self.client.get('/api/active-bookings/').json()['bookings'][0]
+        arrival = timezone.localtime(self.trip.scheduled_departure + timedelta(minutes=60))
+        self.assertEqual(booking['estimated_arrival'], arrival.strftime('%I:%M %p'))
+
+
+class StopFareTests(MatwanaTestCase):
+
+    def setUp(self):
+        fares.invalidate()
+        self.addCleanup(fares.invalidate)
+        # Town 0 km, Westlands 5 km, Kangemi spread to 15 km, Kikuyu 25 km
+        with self.captureOnCommitCallbacks(execute=True):
+            fares.set_stops(self.route, fares.parse_stops('Westlands, 5\nKangemi'))
+
+    def test_fares_are_prorated_by_distance(self):
+        table = fares.get_table(self.route)
+        self.assertEqual([stop['name'] for stop in table.stops], ['Town', 'Westlands', 'Kangemi', 'Kikuyu'])
+        self.assertEqual(table.stops[2]['distance_km'], Decimal('15.00'))
+        self.assertEqual(table.fare('Town', 'Westlands'), Decimal('20'))
+        self.assertEqual(table.fare('westlands', 'Kangemi'), Decimal('40'))
+        self.assertEqual(table.fare('Town', 'Kikuyu'), Decimal('100.00'))
+        with self.assertRaises(fares.FareError):
+            table.fare('Kikuyu', 'Town')
+        with self.assertRaises(fares.FareError):
+            table.fare('Town', 'Nowhere')
+
+    def test_reconcile_seats_counts_part_route_bookings_per_segment(self):
+        riders = [make_passenger(n, credits=Decimal('500.00')) for n in range(1, 4)]
+        book_trip(riders[0], self.trip.id, boarding='Town', alighting='Westlands')
+        book_trip(riders[1], self.trip.id, boarding='Westlands', alighting='Kikuyu')
+        call_command('reconcile_seats', stdout=StringIO())
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 1)  # nobody shares a segment
+
+        TripSegment.objects.filter(trip=self.trip, index=2).update(seats_booked=2)
+        Trip.objects.filter(id=self.trip.id).update(seats_booked=2)
+        out = StringIO()
+        call_command('reconcile_seats', stdout=out)
+        self.assertIn('segment 2 says 2, 1 bookings', out.getvalue())
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 1)
+        self.assertEqual(list(TripSegment.objects.filter(trip=self.trip).order_by('index').values_list('seats_booked', flat=True)),
+                         [1, 1, 1])
+        book_trip(riders[2], self.trip.id, boarding='Town', alighting='Kangemi')
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 2)
+
+    def test_route_edits_rebuild_the_table(self):
+        self.assertEqual(fares.get_table(self.route).segments, 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            fares.set_stops(self.route, [])
+        table = fares.get_table(self.route)
+        self.assertFalse(table.has_stops)
+        self.assertEqual(table.fare(None, None), Decimal('100.00'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Route.objects.filter(id=self.route.id).update(standard_fare=Decimal('120.00'))
+            self.route.refresh_from_db()
+            self.route.save()
+        self.assertEqual(fares.get_table(self.route).fare(None, None), Decimal('120.00'))
+
+    def test_seat_freed_mid_route_is_resold(self):
+        riders = [make_passenger(n, credits=Decimal('500.00')) for n in range(1, 6)]
+        booking = book_trip(riders[0], self.trip.id, boarding='Town', alighting='Westlands')
+        book_trip(riders[1], self.trip.id, boarding='Town', alighting='Westlands')
+        self.assertEqual(booking.fare_paid, Decimal('20'))
+        self.assertEqual((booking.boarding_index, booking.alighting_index), (0, 1))
+
+        # Both seats are free again after Westlands
+        later = book_trip(riders[2], self.trip.id, boarding='Westlands', alighting='Kikuyu')
+        book_trip(riders[3], self.trip.id, boarding=self.route.stops.get(name='Kangemi').id)
+        with self.assertRaisesMessage(BookingError, 'No seat is free'):
+            book_trip(riders[4], self.trip.id)
+        self.trip.refresh_from_db()
+        self.assertEqual(self.trip.seats_booked, 2)
+
+        cancel_booking(later)
+        response = self.client.get(f'/api/trips/{self.trip.id}/seats/', {'from': 'Town', 'to': 'Kikuyu'})
+        self.assertEqual(response.json()['seats_available'], 0)
+        self.assertEqual([segment['seats_available'] for segment in response.json()['segments']], [0, 2, 1])
+
+        cancel_booking(booking)
+        book_trip(riders[4], self.trip.id)
+        self.assertEqual(
+            list(TripSegment.objects.filter(trip=self.trip).order_by('index').values_list('seats_booked', flat=True)),
+            [2, 1, 2]
+        )
+
+    def test_stops_cannot_change_under_bookings(self):
+        book_trip(make_passenger(1, credits=Decimal('500.00')), self.trip.id, alighting='Kangemi')
+        with self.assertRaises(fares.FareError):
+            fares.set_stops(self.route, fares.parse_stops('Westlands, 6'))
+        # Saving the same stops is fine
+        self.assertFalse(fares.set_stops(self.route, fares.parse_stops('Westlands, 5\nKangemi, 15')))
+
+
+class JourneyPlannerTests(MatwanaTestCase):
+
+    def setUp(self):
+        fares.invalidate()
+        planner.invalidate()
+        self.addCleanup(fares.invalidate)
+        self.addCleanup(planner.invalidate)
+        # Route 105 reaches Kangemi 60% of the way, at departure + 36 minutes
+        fares.set_stops(self.route, fares.parse_stops('Westlands, 5\nKangemi, 15'))
+        other = Sacco.objects.create(name='Forward', registration_number='FW-001', contact_person='Ann',
+                                     contact_phone='+254700000002', contact_email='fw@example.com', address='Nairobi')
+        self.feeder = Route.objects.create(name='Route 33', start_point='Kangemi', end_point='Limuru', distance_km=20,
+                                           estimated_duration_minutes=40, standard_fare=Decimal('80.00'), sacco=other)
+        self.departure = self.trip.scheduled_departure
+        self.too_soon = self.feeder_trip(38)
+        self.connection = self.feeder_trip(45)
+
+    def feeder_trip(self, minutes):
+        departure = self.departure + timedelta(minutes=minutes)
+        return Trip.objects.create(matatu=self.matatu, route=self.feeder, scheduled_departure=departure,
+                                   scheduled_arrival=departure + timedelta(minutes=40))
+
+    def test_plans_a_change_with_time_to_transfer(self):
+        legs = planner.plan('town', 'Limuru', self.departure - timedelta(minutes=30))
+        self.assertEqual([(leg['from'], leg['to'], leg['trip_id']) for leg in legs], [
+            ('Town', 'Kangemi', self.trip.id),
+            ('Kangemi', 'Limuru', self.connection.id),
+        ])
+        self.assertEqual(legs[0]['arrive'], self.departure + timedelta(minutes=36))
+        self.assertIsNone(planner.plan('Limuru', 'Town', self.departure))
+        # The first trip has already left
+        self.assertIsNone(planner.plan('Town', 'Limuru', self.departure + timedelta(minutes=1)))
+
+    def test_trip_changes_update_the_graph_in_place(self):
+        graph = planner.get_graph()
+        with self.captureOnCommitCallbacks(execute=True):
+            quicker = self.feeder_trip(42)
+            self.connection.status = 'cancelled'
+            self.connection.save()
+        self.assertIs(planner.get_graph(), graph)
+        legs = planner.plan('Town', 'Limuru', self.departure)
+        self.assertEqual(legs[-1]['trip_id'], quicker.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.feeder.is_active = False
+            self.feeder.save()
+        self.assertIsNone(planner.plan('Town', 'Limuru', self.departure))
+
+    def test_plan_journey_api(self):
+        response = self.client.get('/api/journeys/plan/', {
+            'from': 'Town', 'to': 'Limuru', 'depart': timezone.localtime(self.departure).isoformat()
+        })
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['transfers'], 1)
+        self.assertEqual([leg['fare'] for leg in data['legs']], [60.0, 80.0])
+
+
+class ScheduleGeneratorTests(MatwanaTestCase):
+
+    def setUp(self):
+        # Three matatus, two of them sharing a driver
+        self.driver = make_passenger(50, user_type='driver')
+        self.matatus = [self.matatu] + [
+            Matatu.objects.create(plate_number=f'KCB {n}', fleet_number=f'SM0{n}', sacco=self.sacco, capacity=14,
+                                  qr_code_data=f'MATATU:KCB{n}', current_driver=self.driver)
+            for n in (2, 3)
+        ]
+        # 06:00, 06:20 and 06:40 on an hour-long route
+        Headway.objects.create(route=self.route, start_time='06:00', end_time='07:00', minutes=20)
+        self.tomorrow = timezone.localdate() + timedelta(days=1)
+
+    def generated(self):
+        return list(Trip.objects.filter(generated=True).order_by('scheduled_departure'))
+
+    def assertNoDoubleBooking(self, trips, key):
+        by_owner = {}
+        for trip in trips:
+            if getattr(trip, key) is None:
+                continue
+            previous = by_owner.get(getattr(trip, key))
+            if previous is not None:
+                self.assertGreaterEqual(trip.scheduled_departure,
+                                        previous.scheduled_arrival + timedelta(minutes=scheduling.TURNAROUND_MINUTES))
+            by_owner[getattr(trip, key)] = trip
+
+    def test_generates_trips_without_double_booking(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            result = scheduling.generate(self.sacco, self.tomorrow, 2)
+        self.assertEqual(result, {'created': 6, 'existing': 0, 'unassigned': 0})
+        trips = self.generated()
+        self.assertEqual(len({trip.matatu_id for trip in trips}), 3)
+        self.assertNoDoubleBooking(trips, 'matatu_id')
+        self.assertNoDoubleBooking(trips, 'driver_id')
+        self.assertEqual(sum(trip.driver_id == self.driver.id for trip in trips), 2)
+        self.assertEqual(
+            TripDailyRollup.objects.get(day=self.tomorrow, sacco=self.sacco, status='scheduled').trip_count, 3
+        )
+
+    def test_rerun_only_fills_gaps(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            scheduling.generate(self.sacco, self.tomorrow, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Trip.objects.filter(generated=True).first().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            result = scheduling.generate(self.sacco, self.tomorrow, 2)
+        self.assertEqual(result, {'created': 4, 'existing': 2, 'unassigned': 0})
+        self.assertEqual(len(self.generated()), 6)
+
+        # The rollups count each trip once, without being rebuilt
+        counts = dict(TripDailyRollup.objects.filter(status='scheduled').values_list('day', 'trip_count'))
+        self.assertEqual(counts, {self.tomorrow: 3, self.tomorrow + timedelta(days=1): 3})
+
+    def test_hand_made_trips_keep_their_matatu(self):
+        departure = timezone.make_aware(datetime.combine(self.tomorrow, time(5, 40)))
+        Trip.objects.create(matatu=self.matatu, route=self.route, scheduled_departure=departure,
+                            scheduled_arrival=departure + timedelta(minutes=65))
+        result = scheduling.generate(self.sacco, self.tomorrow, 1)
+        self.assertEqual(result['unassigned'], 1)
+        self.assertNotIn(self.matatu.id, [trip.matatu_id for trip in self.generated()])
+
+
+class TripLifecycleTests(MatwanaTestCase):
+
+    def setUp(self):
+        self.driver = make_passenger(60, user_type='driver')
+        self.now = timezone.now()
+
+    def add_trip(self, departed_minutes_ago, **fields):
+        departure = self.now - timedelta(minutes=departed_minutes_ago)
+        return Trip.objects.create(matatu=self.matatu, route=self.route, scheduled_departure=departure,
+                                   scheduled_arrival=departure + timedelta(hours=1), **fields)
+
+    def test_sweep_departs_expires_and_completes(self):
+        departing = self.add_trip(5, driver=self.driver)
+        unused = self.add_trip(45)
+        booked = self.add_trip(45, seats_booked=1)
+        quiet = self.add_trip(90, driver=self.driver, status='active', actual_departure=self.now - timedelta(minutes=88),
+                              location_updated_at=self.now - timedelta(minutes=20))
+        moving = self.add_trip(90, driver=self.driver, status='active',
+                               location_updated_at=self.now - timedelta(minutes=1))
+
+        with mock.patch('matwanaapp.lifecycle.publish') as publish:
+            moved = lifecycle.sweep(self.now)
+        self.assertEqual(moved, {'depart': 1, 'abandon': 1, 'expire': 1, 'arrive': 1})
+
+        statuses = dict(Trip.objects.values_list('id', 'status'))
+        self.assertEqual(statuses[departing.id], 'active')
+        self.assertEqual(statuses[unused.id], 'cancelled')
+        self.assertEqual(statuses[booked.id], 'cancelled')  # booked, but nobody will drive it
+        self.assertEqual(statuses[quiet.id], 'completed')
+        self.assertEqual(statuses[moving.id], 'active')  # still reporting positions
+        self.assertEqual(statuses[self.trip.id], 'scheduled')
+
+        departing.refresh_from_db()
+        quiet.refresh_from_db()
+        self.assertEqual(departing.actual_departure, departing.scheduled_departure)
+        self.assertEqual(quiet.actual_arrival, quiet.location_updated_at)
+        publish.assert_any_call(f'trip:{quiet.id}', 'trip', trip_id=quiet.id, status='completed')
+        publish.assert_any_call('admin', 'trips', transition='expire', status='cancelled', count=1)
+
+        self.assertEqual(lifecycle.sweep(self.now), {'depart': 0, 'abandon': 0, 'expire': 0, 'arrive': 0})
+
+    def test_driverless_booked_trip_is_cancelled_and_refunded(self):
+        passenger = make_passenger(1, credits=500)
+        with self.captureOnCommitCallbacks(execute=True):
+            book_trip(passenger, self.trip.id)
+        self.assertEqual(wallet.balance(passenger.id), Decimal('400.00'))
+        Trip.objects.filter(id=self.trip.id).update(scheduled_departure=self.now - timedelta(minutes=20))
+        self.assertEqual(lifecycle.sweep(self.now)['abandon'], 0)  # the driver may still turn up
+
+        Trip.objects.filter(id=self.trip.id).update(scheduled_departure=self.now - timedelta(minutes=45))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(lifecycle.sweep(self.now)['abandon'], 1)
+        self.trip.refresh_from_db()
+        self.assertEqual((self.trip.status, self.trip.seats_booked), ('cancelled', 0))
+        self.assertFalse(PassengerTrip.objects.filter(trip=self.trip).exists())
+        self.assertEqual(wallet.balance(passenger.id), Decimal('500.00'))
+        self.assertTrue(Payment.objects.filter(passenger=passenger, payment_type='refund', status='completed').exists())
+
+    def test_sweep_moves_rollups(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_trip(45)
+        with self.captureOnCommitCallbacks(execute=True):
+            lifecycle.sweep(self.now)
+        counts = dict(TripDailyRollup.objects.filter(
+            day=timezone.localdate(self.now - timedelta(minutes=45))
+        ).values_list('status', 'trip_count'))
+        self.assertEqual(counts.get('scheduled'), 0)
+        self.assertEqual(counts.get('cancelled'), 1)
+
+    def test_driver_starts_and_finishes_own_trip(self):
+        Trip.objects.filter(id=self.trip.id).update(driver=self.driver)
+        login_as(self.client, self.driver)
+        url = f'/api/driver/trips/{self.trip.id}/status/'
+
+        response = self.client.post(url, json.dumps({'status': 'completed'}), content_type='application/json').json()
+        self.assertEqual(response['message'], 'A scheduled trip cannot become completed')
+        response = self.client.post(url, json.dumps({'status': 'active'}), content_type='application/json').json()
+        self.assertTrue(response['success'])
+        self.assertIsNotNone(response['actual_departure'])
+        response = self.client.post(url, json.dumps({'status': 'completed'}), content_type='application/json').json()
+        self.assertTrue(response['success'])
+
+        other = make_passenger(61, user_type='driver')
+        login_as(self.client, other)
+        response = self.client.post(url, json.dumps({'status': 'active'}), content_type='application/json').json()
+        self.assertFalse(response['success'])
+        with self.assertRaises(lifecycle.LifecycleError):
+            lifecycle.transition(self.trip.id, 'active')
+
+
+class WalletLedgerTests(MatwanaTestCase):
+
+    def setUp(self):
+        self.passenger = make_passenger(1)
+        wallet.post(self.passenger.id, Decimal('300.00'), 'opening')
+
+    def test_posts_are_idempotent_and_never_overdraw(self):
+        entry, created = wallet.post(self.passenger.id, Decimal('-120.00'), 'adjustment', key='fine:1')
+        self.assertTrue(created)
+        self.assertEqual(entry.balance_after, Decimal('180.00'))
+        again, created = wallet.post(self.passenger.id, Decimal('-120.00'), 'adjustment', key='fine:1')
+        self.assertFalse(created)
+        self.assertEqual(again.id, entry.id)
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('180.00'))
+
+        with self.assertRaisesMessage(wallet.WalletError, 'Insufficient wallet balance'):
+            wallet.post(self.passenger.id, Decimal('-500.00'), 'adjustment')
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('180.00'))
+
+    def test_booking_and_refund_are_ledger_entries(self):
+        booking = book_trip(self.passenger, self.trip.id)
+        cancel_booking(booking)
+        entries = list(CreditEntry.objects.filter(user=self.passenger).order_by('id').values_list(
+            'kind', 'amount', 'balance_after', 'payment__payment_type'
+        ))
+        self.assertEqual(entries, [
+            ('opening', Decimal('300.00'), Decimal('300.00'), None),
+            ('trip', Decimal('-100.00'), Decimal('200.00'), 'trip'),
+            ('refund', Decimal('100.00'), Decimal('300.00'), 'refund'),
+        ])
+        self.assertEqual(list(wallet.drifted([self.passenger.id])), [])
+
+    def test_admin_edit_keeps_a_posting_made_meanwhile(self):
+        login_as(self.client, make_passenger(90, user_type='super_admin'))
+
+        def top_up_meanwhile(phone_number):
+            # Commits after the view read the user and before it saves
+            wallet.post(self.passenger.id, Decimal('50.00'), 'topup', key='topup:meanwhile')
+            return normalize_phone(phone_number)
+
+        with mock.patch('matwanaapp.views.normalize_phone', side_effect=top_up_meanwhile):
+            self.client.post(f'/superadmin/users/edit/{self.passenger.id}/', {
+                'user_type': 'passenger', 'first_name': 'Jane', 'last_name': 'Doe',
+                'email': self.passenger.email, 'phone_number': self.passenger.phone_number, 'is_active': 'on',
+            })
+        self.passenger.refresh_from_db()
+        self.assertEqual((self.passenger.first_name, self.passenger.credits), ('Jane', Decimal('350.00')))
+        self.assertEqual(list(wallet.drifted([self.passenger.id])), [])
+
+    def test_django_admin_adjusts_balances_through_the_ledger(self):
+        superuser = make_passenger(90, user_type='super_admin')
+        User.objects.filter(id=superuser.id).update(is_superuser=True)
+        request = RequestFactory().post('/')
+        request.user = User.objects.get(id=superuser.id)
+        model_admin = UserAdmin(User, admin.site)
+        self.assertIn('credits', model_admin.get_readonly_fields(request, self.passenger))
+
+        stale = User.objects.get(id=self.passenger.id)
+        form_class = model_admin.get_form(request, stale, change=True)
+        self.assertNotIn('credits', form_class.base_fields)
+        data = {name: value for name, value in form_class(instance=stale).initial.items() if value is not None}
+        data.update(first_name='Jane', password='!', credit_adjustment='-20.00', adjustment_key='abc')
+        wallet.post(self.passenger.id, Decimal('50.00'), 'topup', key='topup:meanwhile')
+
+        # The form was loaded before the top-up, then submitted twice
+        for instance in (stale, User.objects.get(id=self.passenger.id)):
+            form = form_class(data, instance=instance)
+            self.assertTrue(form.is_valid(), form.errors)
+            model_admin.save_model(request, form.save(commit=False), form, change=True)
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('330.00'))
+        self.assertEqual(User.objects.get(id=self.passenger.id).first_name, 'Jane')
+        self.assertEqual(CreditEntry.objects.filter(user=self.passenger, kind='adjustment').count(), 1)
+        self.assertEqual(list(wallet.drifted([self.passenger.id])), [])
+
+    def test_reconcile_resets_drifted_balances(self):
+        User.objects.filter(id=self.passenger.id).update(credits=Decimal('999.00'))
+        out = StringIO()
+        call_command('reconcile_wallets', '--dry-run', stdout=out)
+        self.assertIn('balance says 999.00, ledger adds up to 300', out.getvalue())
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('999.00'))
+
+        call_command('reconcile_wallets', stdout=StringIO())
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('300.00'))
+
+
+def _make_ids(count):
+    return [ids.ulid() for _ in range(count)]
+
+
+class TransactionIdTests(TestCase):
+
+    def test_ids_increase_within_a_millisecond(self):
+        made = [ids.transaction_id('PAY') for _ in range(5000)]
+        self.assertEqual(made, sorted(set(made)))
+        self.assertAlmostEqual(ids.timestamp(made[0]), time_module.time(), delta=5)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_forked_workers_do_not_repeat_ids(self):
+        # As if the parent's last id were ahead of the clock: children that kept
+        # its state would all count up from the same value
+        ahead = (time_module.time_ns() // 1_000_000 + 60_000) << ids.RANDOM_BITS
+        with mock.patch.object(ids, '_last', ahead):
+            with multiprocessing.get_context('fork').Pool(4) as pool:
+                batches = pool.map(_make_ids, [20000] * 4)
+        made = [ulid for batch in batches for ulid in batch]
+        self.assertEqual(len(set(made)), len(made))
+
+
+class MpesaTopUpTests(MatwanaTestCase):
+
+    def setUp(self):
+        self.passenger = make_passenger(1)
+        self.simulator = DarajaSimulator(consumer_key='key', consumer_secret='secret', passkey='pass', delay=0,
+                                          fail_rate=0, drop_rate=1, duplicate_rate=0, seed=0)
+        self.config = {
+            'BASE_URL': self.simulator.start(),
+            'CONSUMER_KEY': 'key',
+            'CONSUMER_SECRET': 'secret',
+            'SHORTCODE': '174379',
+            'PASSKEY': 'pass',
+            'CALLBACK_URL': 'http://127.0.0.1/api/payments/mpesa/callback/secret-token/',
+            'CALLBACK_TOKEN': 'secret-token',
+        }
+        self.addCleanup(self.simulator.stop)
+
+    def top_up(self, amount=200):
+        with self.settings(MATWANA_MPESA=self.config):
+            login_as(self.client, self.passenger)
+            response = self.client.post('/process-payment/', json.dumps({'amount': amount, 'payment_method': 'mpesa'}),
+                                        content_type='application/json').json()
+            jobs.run_pending(queue='payments')
+        return Payment.objects.get(id=response['payment_id'])
+
+    def callback(self, payment, code=0, token='secret-token'):
+        body = self.simulator.callback_body(payment.provider_reference)
+        body['Body']['stkCallback']['ResultCode'] = code
+        return self.client.post(f'/api/payments/mpesa/callback/{token}/', json.dumps(body),
+                                content_type='application/json')
+
+    def test_stk_push_stays_pending_until_the_callback(self):
+        payment = self.top_up()
+        self.assertEqual(payment.status, 'pending')
+        self.assertTrue(payment.provider_reference.startswith('ws_CO_'))
+        self.assertEqual(self.simulator.pushes[payment.provider_reference]['phone'], '254700000001')
+
+        with self.settings(MATWANA_MPESA=self.config):
+            self.assertEqual(self.callback(payment, token='wrong').status_code, 404)
+            for _ in range(2):  # M-Pesa may send the same result twice
+                self.assertEqual(self.callback(payment).json()['ResultCode'], 0)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual(payment.receipt_number, self.simulator.pushes[payment.provider_reference]['receipt'])
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('200.00'))
+        self.assertEqual(CreditEntry.objects.filter(payment=payment).count(), 1)
+
+    def test_cancelled_push_credits_nothing(self):
+        payment = self.top_up()
+        with self.settings(MATWANA_MPESA=self.config):
+            self.callback(payment, code=1032)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'failed')
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('0.00'))
+
+    def test_reconcile_queries_lost_callbacks_and_expires_the_rest(self):
+        answered = self.top_up()
+        forgotten = Payment.objects.create(passenger=self.passenger, payment_type='credit_topup', amount=100,
+                                           transaction_id='TOPUP-OLD', payment_method='mpesa')
+        Payment.objects.filter(id=forgotten.id).update(created_at=timezone.now() - timedelta(hours=2))
+
+        with self.settings(MATWANA_MPESA=self.config), self.captureOnCommitCallbacks(execute=True):
+            counts = payments.reconcile(timezone.now() + payments.RECONCILE_AFTER)
+        self.assertEqual(counts, {'settled': 1, 'expired': 1, 'pending': 0})
+        self.assertEqual(Payment.objects.get(id=answered.id).status, 'completed')
+        self.assertEqual(Payment.objects.get(id=forgotten.id).status, 'failed')
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('200.00'))
+
+    def test_m_pesa_amounts_are_whole_shillings(self):
+        login_as(self.client, self.passenger)
+        response = self.client.post('/process-payment/', json.dumps({'amount': 150.5, 'payment_method': 'mpesa'}),
+                                    content_type='application/json').json()
+        self.assertFalse(response['success'])
+
+    def test_refused_push_fails_the_payment_at_once(self):
+        self.config['PASSKEY'] = 'wrong'
+        payment = self.top_up()
+        self.assertEqual(payment.status, 'failed')
+        self.assertIn('Invalid Password', payment.description)
+        self.assertEqual(Job.objects.get(task='matwanaapp.tasks.complete_topup').status, 'done')
+        self.assertEqual(self.simulator.stats['pushes'], 0)
+
+    def test_push_that_never_left_is_retried(self):
+        self.config['BASE_URL'] = 'http://127.0.0.1:1'  # nothing listens there
+        payment = self.top_up()
+        self.assertEqual(payment.status, 'pending')
+        self.assertIsNone(payment.provider_requested_at)
+        job = Job.objects.get(task='matwanaapp.tasks.complete_topup')
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+
+    def test_push_whose_answer_is_lost_is_not_sent_again(self):
+        send = payments.DarajaProvider.request
+
+        def lose_answer(provider, payment, phone):
+            send(provider, payment, phone)
+            raise payments.PaymentError('No answer from M-Pesa: timed out')
+
+        with mock.patch.object(payments.DarajaProvider, 'request', lose_answer), \
+                self.assertLogs('matwanaapp.payments', 'WARNING'):
+            payment = self.top_up()
+        self.assertEqual(Job.objects.get(task='matwanaapp.tasks.complete_topup').status, 'done')
+        with self.settings(MATWANA_MPESA=self.config):
+            complete_topup(payment.id)  # run again, as a retry would
+        self.assertEqual(self.simulator.stats['pushes'], 1)
+        self.assertIsNone(payment.provider_reference)
+        self.assertIsNotNone(payment.provider_requested_at)
+
+        # The callback is matched to the push by phone and amount
+        reference, = self.simulator.pushes
+        body = self.simulator.callback_body(reference)
+        with self.settings(MATWANA_MPESA=self.config), self.assertLogs('matwanaapp.payments', 'WARNING'):
+            self.client.post('/api/payments/mpesa/callback/secret-token/', json.dumps(body),
+                             content_type='application/json')
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.provider_reference), ('completed', reference))
+        self.assertEqual(wallet.balance(self.passenger.id), Decimal('200.00'))
+        self.assertEqual(ProviderCallback.objects.get().payment_id, payment.id)
+
+    def test_unknown_callbacks_are_kept_for_reconcile(self):
+        payment = self.top_up()
+        reference = payment.provider_reference
+        body = self.simulator.callback_body(reference)
+        # As if the callback beat the reference being saved
+        Payment.objects.filter(id=payment.id).update(provider_reference=None, provider_phone='254711111111')
+        with self.settings(MATWANA_MPESA=self.config), self.assertLogs('matwanaapp.payments', 'WARNING'):
+            response = self.client.post('/api/payments/mpesa/callback/secret-token/', json.dumps(body),
+                                        content_type='application/json')
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertIsNone(ProviderCallback.objects.get(reference=reference).payment_id)
+
+        Payment.objects.filter(id=payment.id).update(provider_reference=reference)
+        with self.settings(MATWANA_MPESA=self.config), self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(payments.reconcile()['settled'], 1)
+        self.assertEqual(Payment.objects.get(id=payment.id).status, 'completed')
+        self.assertEqual(ProviderCallback.objects.get(reference=reference).payment_id, payment.id)
+
+
+class ExportTests(MatwanaTestCase):
+
+    def setUp(self):
+        self.passenger = make_passenger(1)
+        for n in range(7):
+            Payment.objects.create(passenger=self.passenger, payment_type='credit_topup', amount=Decimal('50.00') + n,
+                                   transaction_id=f'PAY-{n}', payment_method='mpesa',
+                                   status='completed' if n % 2 else 'failed')
+
+    def read(self, chunks):
+        return list(csv.reader(StringIO(b''.join(chunks).decode())))
+
+    def test_csv_reads_every_row_once_in_keyset_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            chunks = list(exports.export('payments', batch_size=3))
+        self.assertEqual(len(chunks), 4)  # header, then 3 + 3 + 1 rows
+        self.assertEqual(len(queries), 3)
+        self.assertIn('LIMIT 3', queries[1]['sql'])
+
+        header, *rows = self.read(chunks)
+        self.assertEqual(header, list(exports.DATASETS['payments'][1]))
+        ids = [int(row[0]) for row in rows]
+        self.assertEqual(ids, sorted(Payment.objects.values_list('id', flat=True)))
+        self.assertEqual(rows[0][header.index('passenger__phone_number')], '+254700000001')
+        self.assertEqual(rows[0][header.index('amount')], '50.00')
+
+    def test_export_view_streams_filtered_rows_to_superadmins(self):
+        admin = make_passenger(2, user_type='super_admin')
+        login_as(self.client, self.passenger)
+        self.assertEqual(self.client.get('/superadmin/export/payments/').status_code, 302)
+
+        login_as(self.client, admin)
+        response = self.client.get('/superadmin/export/payments/', {'status': 'completed'})
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="matwana-payments-', response['Content-Disposition'])
+        header, *rows = self.read(response.streaming_content)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual({row[header.index('status')] for row in rows}, {'completed'})
+
+        header, *rows = self.read(self.client.get('/superadmin/export/users/', {'user_type': 'super_admin'}).streaming_content)
+        self.assertEqual([row[header.index('email')] for row in rows], ['user2@example.com'])
+        self.assertNotIn('password', header)
+
+        self.assertEqual(self.client.get('/superadmin/export/bookings/').status_code, 400)
+        self.assertEqual(self.client.get('/superadmin/export/trips/', {'date_from': 'soon'}).status_code, 400)
+
+    def test_parquet_needs_pyarrow(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            with self.assertRaisesMessage(exports.ExportError, 'pyarrow'):
+                exports.export('payments', fmt='parquet')
+            return
+        table = pq.read_table(BytesIO(b''.join(exports.export('payments', fmt='parquet', batch_size=3))))
+        self.assertEqual(table.num_rows, 7)
+        self.assertEqual(table.column('amount')[0].as_py(), Decimal('50.00'))
+
+    def test_export_command_writes_a_file(self):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'trips.csv')
+        call_command('export_data', 'trips', '--output', path, stderr=StringIO())
+        with open(path, newline='') as f:
+            header, *rows = list(csv.reader(f))
+        self.assertEqual([int(row[0]) for row in rows], [self.trip.id])
+        self.assertEqual(rows[0][header.index('matatu__plate_number')], 'KCA 123A')
+
+
+class ProfileMiddlewareTests(MatwanaTestCase):
+
+    def setUp(self):
+        profiling.clear()
+        self.addCleanup(profiling.clear)
+
+    def profile(self, view):
+        with self.settings(MATWANA_PROFILE_SAMPLE_RATE=1):
+            middleware = profiling.ProfileMiddleware(view)
+        request = RequestFactory().get('/somewhere/')
+        request.resolver_match = None
+        middleware(request)
+        return profiling.recent()[0]
+
+    def test_repeated_statements_are_reported_as_n_plus_one(self):
+        def view(request):
+            for trip_id in range(profiling.REPEATED):
+                Trip.objects.filter(id=trip_id).exists()
+            Route.objects.filter(id=self.route.id).exists()
+            Route.objects.filter(id=self.route.id).exists()
+            return HttpResponse('ok')
+
+        with self.assertLogs('matwanaapp.profiling', 'WARNING') as logs:
+            profile = self.profile(view)
+        self.assertEqual(profile['queries'], profiling.REPEATED + 2)
+        self.assertEqual(profile['duplicates'], 1)
+        self.assertEqual([entry['runs'] for entry in profile['repeated']], [profiling.REPEATED])
+        self.assertIn('matwanaapp_trip', profile['repeated'][0]['sql'])
+        self.assertEqual(profile['bytes'], 2)
+        self.assertEqual(json.loads(logs.records[0].getMessage().split(' ', 2)[2])['queries'], profile['queries'])
+
+    def test_in_lists_of_any_length_are_one_statement(self):
+        def view(request):
+            for n in range(profiling.REPEATED):
+                list(User.objects.filter(id__in=range(n + 1)))
+            return HttpResponse()
+
+        with self.assertLogs('matwanaapp.profiling', 'WARNING'):
+            profile = self.profile(view)
+        self.assertEqual(profile['repeated'][0]['runs'], profiling.REPEATED)
+        self.assertTrue(profile['repeated'][0]['sql'].startswith('SELECT ... FROM "matwanaapp_user" WHERE'))
+
+    def test_sampled_pages_reach_the_superadmin_endpoint(self):
+        admin = make_passenger(1, user_type='super_admin')
+        login_as(self.client, admin)
+        with self.settings(MATWANA_PROFILE_SAMPLE_RATE=1):
+            page = self.client.get('/superadmin/users/')
+            response = self.client.get('/superadmin/api/profiles/', {'view': 'admin_manage_users'}).json()
+
+        profile, = response['profiles']
+        self.assertEqual(profile['status'], 200)
+        self.assertEqual(profile['bytes'], len(page.content))
+        self.assertGreater(profile['queries'], 0)
+        self.assertGreater(profile['template_ms'], 0)
+        self.assertEqual(response['summary'][0]['view'], 'admin_manage_users')
+        self.assertEqual(response['summary'][0]['requests'], 1)
+
+        login_as(self.client, make_passenger(2))
+        self.assertFalse(self.client.get('/superadmin/api/profiles/').json()['success'])
+
+    def test_off_by_default(self):
+        login_as(self.client, make_passenger(1))
+        self.client.get('/dashboard/')
+        self.assertEqual(profiling.recent(), [])
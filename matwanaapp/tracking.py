@@ -0,0 +1,296 @@
+# tracking.py
+"""
+GPS ingest for trips on the road.
+
+Driver devices post their pings in batches. Each batch is appended to the
+TripLocation history with one bulk INSERT and moves the trip in the live
+grid (nearby.py); Trip rows are never written per ping. The newest position
+of every trip is buffered in process memory and copied onto
+``Trip.current_location_*`` every ``MATWANA_LOCATION_FLUSH_INTERVAL``
+seconds, by the next ingest or else by a background thread, and once more
+when the process exits. Each flush joins the trips against a VALUES list,
+``FLUSH_BATCH`` trips per UPDATE. A flush only replaces a position with a
+newer one, so processes flushing their own buffers in any order never move a
+matatu backwards, and positions a failed flush could not write go back into
+the buffer.
+
+On Postgres the history is partitioned by (UTC) day (migration 0009).
+``ensure_partitions`` creates the coming days' partitions and ``prune`` drops
+whole partitions once they fall out of the retention window; elsewhere old
+rows are deleted. Both run from ``manage.py maintain_locations``.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import nearby
+from .events import publish
+from .models import Trip, TripLocation
+
+logger = logging.getLogger(__name__)
+
+TABLE = TripLocation._meta.db_table
+MAX_BATCH = 500
+INGEST_STATUSES = ('scheduled', 'active')
+# Devices buffer pings while offline, but not for longer than this
+MAX_PING_AGE = timedelta(hours=6)
+MAX_CLOCK_SKEW = timedelta(minutes=2)
+DEFAULT_FLUSH_INTERVAL = 5
+# Trips written per UPDATE (4 parameters each, well under SQLite's limit)
+FLUSH_BATCH = 500
+DEFAULT_RETENTION_DAYS = 30
+
+
+class TrackingError(Exception):
+    """Raised when a batch of pings is rejected. The message is safe to show to the device."""
+
+
+def parse_ping(raw, now=None):
+    """Validate one ping (``lat``, ``lng``, ``ts`` and optional ``speed``/``heading``)."""
+    now = now or timezone.now()
+    try:
+        latitude = Decimal(str(raw['lat'])).quantize(Decimal('0.000001'))
+        longitude = Decimal(str(raw['lng'])).quantize(Decimal('0.000001'))
+        speed = float(raw['speed']) if raw.get('speed') is not None else None
+        heading = int(raw['heading']) % 360 if raw.get('heading') is not None else None
+        ts = raw['ts']
+        # Epoch seconds or an ISO 8601 string
+        if isinstance(ts, (int, float)):
+            recorded_at = datetime.fromtimestamp(ts, tz=dt_timezone.utc)
+        else:
+            recorded_at = parse_datetime(str(ts))
+    except (KeyError, TypeError, AttributeError, ValueError, OverflowError, OSError, InvalidOperation):
+        raise TrackingError('Each ping needs numeric lat and lng and a valid ts')
+
+    if recorded_at is None:
+        raise TrackingError('Each ping needs numeric lat and lng and a valid ts')
+    if timezone.is_naive(recorded_at):
+        recorded_at = timezone.make_aware(recorded_at, dt_timezone.utc)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise TrackingError('Coordinates out of range')
+    if not now - MAX_PING_AGE <= recorded_at <= now + MAX_CLOCK_SKEW:
+        raise TrackingError('Ping timestamp is too old or in the future')
+
+    return TripLocation(
+        latitude=latitude,
+        longitude=longitude,
+        recorded_at=recorded_at,
+        speed_kmh=speed,
+        heading=heading,
+    )
+
+
+_pending = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flusher = None
+
+
+def ingest(driver_id, trip_id, raw_pings):
+    """Store a batch of pings for a trip driven by ``driver_id``. Returns how many were stored."""
+    try:
+        trip_id = int(trip_id)
+    except (TypeError, ValueError):
+        raise TrackingError('A trip_id is required')
+    if not isinstance(raw_pings, list) or not raw_pings:
+        raise TrackingError('No pings to record')
+    if len(raw_pings) > MAX_BATCH:
+        raise TrackingError(f'At most {MAX_BATCH} pings per request')
+    now = timezone.now()
+    pings = [parse_ping(raw, now) for raw in raw_pings]
+
+    if not Trip.objects.filter(id=trip_id, driver_id=driver_id, status__in=INGEST_STATUSES).exists():
+        raise TrackingError('Trip not found or not assigned to you')
+    record(trip_id, pings)
+    return len(pings)
+
+
+def record(trip_id, pings):
+    """Append pings to the history and buffer the newest as the trip's position."""
+    for ping in pings:
+        ping.trip_id = trip_id
+    TripLocation.objects.bulk_create(pings)
+
+    latest = max(pings, key=lambda ping: ping.recorded_at)
+    nearby.trip_moved(trip_id, float(latest.latitude), float(latest.longitude), latest.recorded_at)
+    _buffer({trip_id: latest})
+    _start_flusher()
+    maybe_flush()
+
+
+def _buffer(positions):
+    with _lock:
+        for trip_id, ping in positions.items():
+            buffered = _pending.get(trip_id)
+            if buffered is None or buffered.recorded_at < ping.recorded_at:
+                _pending[trip_id] = ping
+
+
+def _interval():
+    return getattr(settings, 'MATWANA_LOCATION_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+
+
+def maybe_flush():
+    global _last_flush
+    with _lock:
+        due = time.monotonic() - _last_flush >= _interval()
+        if due:
+            _last_flush = time.monotonic()
+    if due:
+        flush()
+
+
+def _start_flusher():
+    # Flushes the buffer when no further ingest reaches this process
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_periodically, name='matwana-locations', daemon=True)
+            _flusher.start()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(_interval())
+        try:
+            maybe_flush()
+        except Exception:
+            logger.exception('Could not write buffered trip positions')
+        finally:
+            # The thread's own connection; it reconnects on the next flush
+            connection.close()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception('Could not write buffered trip positions on exit')
+
+
+def _write(batch):
+    """One UPDATE of ``(trip_id, ping)`` pairs joined against a VALUES list. Returns the rows updated."""
+    fields = [
+        Trip._meta.get_field(name)
+        for name in ('id', 'current_location_lat', 'current_location_lng', 'location_updated_at')
+    ]
+    table = connection.ops.quote_name(Trip._meta.db_table)
+    pk, lat, lng, at = (connection.ops.quote_name(field.column) for field in fields)
+    if connection.vendor == 'postgresql':
+        row = '(%s::bigint, %s::numeric, %s::numeric, %s::timestamptz)'
+    else:
+        row = '(%s, %s, %s, %s)'
+    params = []
+    for trip_id, ping in batch:
+        values = (trip_id, ping.latitude, ping.longitude, ping.recorded_at)
+        params.extend(field.get_db_prep_value(value, connection) for field, value in zip(fields, values))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            # VALUES columns are column1, column2, ... on both SQLite and Postgres
+            f'UPDATE {table} SET {lat} = v.lat, {lng} = v.lng, {at} = v.at '
+            f'FROM (SELECT column1 AS id, column2 AS lat, column3 AS lng, column4 AS at '
+            f'FROM (VALUES {", ".join([row] * len(batch))}) AS positions) AS v '
+            f'WHERE {table}.{pk} = v.id AND ({table}.{at} IS NULL OR {table}.{at} < v.at)',
+            params
+        )
+        return cursor.rowcount
+
+
+def flush():
+    """Copy the buffered positions onto their trips. Returns the rows updated."""
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return 0
+
+    positions = list(pending.items())
+    updated = 0
+    for start in range(0, len(positions), FLUSH_BATCH):
+        batch = positions[start:start + FLUSH_BATCH]
+        try:
+            updated += _write(batch)
+        except DatabaseError:
+            # Keep what was not written for the next flush
+            _buffer(dict(positions[start:]))
+            raise
+        # The UPDATE skips the Trip signals, so location events are published here
+        for trip_id, ping in batch:
+            publish(
+                f'trip:{trip_id}', 'location', trip_id=trip_id,
+                lat=float(ping.latitude), lng=float(ping.longitude), recorded_at=ping.recorded_at.isoformat()
+            )
+    return updated
+
+
+def _day_start(day):
+    return datetime(day.year, day.month, day.day, tzinfo=dt_timezone.utc)
+
+
+def partition_name(day):
+    return f'{TABLE}_p{day:%Y%m%d}'
+
+
+def ensure_partitions(days_ahead=2):
+    """Create the daily partitions from today to ``days_ahead`` (Postgres only). Returns their names."""
+    if connection.vendor != 'postgresql':
+        return []
+    today = timezone.now().astimezone(dt_timezone.utc).date()
+    created = []
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        name = partition_name(day)
+        start, end = _day_start(day), _day_start(day + timedelta(days=1))
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                )
+            created.append(name)
+        except DatabaseError:
+            # Rows for that day are already in the default partition
+            logger.warning('Could not create location partition %s', name, exc_info=True)
+    return created
+
+
+def prune(keep_days=None):
+    """Drop location history older than the retention window. Returns what was removed."""
+    if keep_days is None:
+        keep_days = getattr(settings, 'MATWANA_LOCATION_RETENTION_DAYS', DEFAULT_RETENTION_DAYS)
+    cutoff_day = timezone.now().astimezone(dt_timezone.utc).date() - timedelta(days=keep_days)
+    removed = []
+
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT c.relname FROM pg_inherits i '
+                'JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent '
+                'WHERE p.relname = %s',
+                [TABLE]
+            )
+            prefix = f'{TABLE}_p'
+            for (name,) in cursor.fetchall():
+                if not name.startswith(prefix):
+                    continue
+                day = datetime.strptime(name[len(prefix):], '%Y%m%d').date()
+                if day < cutoff_day:
+                    cursor.execute(f'DROP TABLE {name}')
+                    removed.append(name)
+
+    # The default partition (or the whole table elsewhere)
+    deleted, _ = TripLocation.objects.filter(recorded_at__lt=_day_start(cutoff_day)).delete()
+    if deleted:
+        removed.append(f'{deleted} rows')
+    return removed
@@ -18,6 +18,7 @@ urlpatterns = [
     path('routes_list/', views.routes_list, name='routes_list'),
     path('quick-book/', views.quick_book, name='quick_book'),
     path('my-trips/', views.my_trips, name='my_trips'),
+    path('notifications/', views.notification_inbox, name='notification_inbox'),
     path('top-up/', views.top_up_wallet, name='top_up_wallet'),
     path('process-payment/', views.process_payment, name='process_payment'),
 
@@ -31,8 +32,17 @@ urlpatterns = [
     path('api/dashboard-data/', views.dashboard_data_api, name='dashboard_data_api'),
     path('api/routes/search/', views.search_routes_api, name='search_routes_api'),
     path('api/routes/<int:route_id>/details/', views.route_details_api, name='route_details_api'),
+    path('api/journeys/plan/', views.plan_journey_api, name='plan_journey_api'),
     path('api/book-trip/', views.book_trip_api, name='book_trip_api'),
+    path('api/payments/mpesa/callback/<str:token>/', views.mpesa_callback, name='mpesa_callback'),
     path('api/active-bookings/', views.active_bookings_api, name='active_bookings_api'),
+    path('api/notifications/mark-read/', views.mark_notifications_read_api, name='mark_notifications_read_api'),
+    path('api/bookings/<int:booking_id>/cancel/', views.cancel_booking_api, name='cancel_booking_api'),
+    path('api/events/', views.event_stream, name='event_stream'),
+    path('api/driver/locations/', views.ingest_locations_api, name='ingest_locations_api'),
+    path('api/driver/trips/<int:trip_id>/status/', views.driver_trip_status_api, name='driver_trip_status_api'),
+    path('api/trips/nearby/', views.nearby_trips_api, name='nearby_trips_api'),
+    path('api/trips/<int:trip_id>/seats/', views.trip_seats_api, name='trip_seats_api'),
 
 # Admin Dashboard
     path('superadmin/', views.admin_dashboard, name='admin_dashboard'),
@@ -73,6 +83,10 @@ urlpatterns = [
     # Payment Management
     path('superadmin/payments/', views.admin_manage_payments, name='admin_manage_payments'),
     
+    # Data Export (?format=csv|parquet and the list page filters)
+    path('superadmin/export/<str:dataset>/', views.admin_export, name='admin_export'),
+    
     # API Endpoints
     path('superadmin/api/dashboard-stats/', views.admin_dashboard_stats, name='admin_dashboard_stats'),
+    path('superadmin/api/profiles/', views.admin_profiles_api, name='admin_profiles_api'),
 ]
\ No newline at end of file
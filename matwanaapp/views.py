@@ -1,15 +1,53 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.views.decorators.csrf import csrf_exempt
+from django.conf import settings
 from django.contrib import messages
 from django.template import loader
-from django.db.models import Q, Count, Sum, Avg
+from django.db import transaction
+from django.db.models import Q, F, Count, Sum, Avg, Func, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.functions import TruncDate, TruncMonth
 from django.contrib.auth.hashers import check_password
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from datetime import datetime, timedelta
+from asgiref.sync import sync_to_async
+import asyncio
+import hmac
 import json
+import re
 
 from .models import User, PassengerTrip, Route, Trip, Notification, Payment, Sacco, Matatu
-from .forms import LoginForm, SignupForm, ForgotPasswordForm
+from .models import PaymentDailyRollup, RegistrationDailyRollup, TripDailyRollup
+from .forms import LoginForm, SignupForm, ForgotPasswordForm, normalize_phone
+from .booking import book_trip, cancel_booking, seats_by_segment, BookingError
+from .eta import estimate, estimates, route_profile
+from .exports import FORMATS, ExportError, export
+from .fares import FareError, get_table, parse_stops, set_stops, stops_text
+from .ids import transaction_id
+from .payments import handle_callback
+from .jobs import enqueue
+from .lifecycle import transition, LifecycleError
+from .tasks import complete_topup, fan_out_notification, render_matatu_qr
+from .events import get_broker, format_sse
+from .pagination import paginate_keyset
+from .notifications import deliver, inbox, mark_read, retract
+from .principal import role_required
+from . import profiling
+from .nearby import nearby
+from .planner import plan
+from .search import search_route_ids
+from .tracking import ingest, TrackingError
+
+def count_subquery(queryset, column='pk', distinct=False):
+    """Correlated COUNT subquery; unlike Count() it doesn't multiply the outer rows through joins"""
+    template = '%(function)s(DISTINCT %(expressions)s)' if distinct else '%(function)s(%(expressions)s)'
+    counted = queryset.order_by().annotate(
+        _count=Func(F(column), function='COUNT', template=template)
+    ).values('_count')
+    return Coalesce(Subquery(counted), 0)
 
 def home(request):
     template = loader.get_template('home.html')
@@ -32,17 +70,13 @@ def login(request):
     
     form = LoginForm(request.POST or None)
     if request.method == 'POST' and form.is_valid():
-        login_input = form.cleaned_data['username']
         password = form.cleaned_data['password']
         
-        try:
-            # Search for user matching the input
-            user = User.objects.get(
-                Q(id_number=login_input) | 
-                Q(email=login_input) | 
-                Q(phone_number=login_input)
-            )
-            
+        # Search for the user by ID number, phone or email
+        user = form.get_user()
+        if user is None:
+            form.add_error('username', 'Account not found with that Email, ID or Phone')
+        else:
             # Check the hashed password
             if check_password(password, user.password):
                 # Set session variables
@@ -52,7 +86,7 @@ def login(request):
                 
                 # Update last login
                 user.last_login = timezone.now()
-                user.save()
+                user.save(update_fields=['last_login'])
                 
                 # Redirect based on user type
                 if user.user_type == 'passenger':
@@ -69,9 +103,6 @@ def login(request):
                     return redirect('dashboard')
             else:
                 form.add_error('password', 'Incorrect password')
-                
-        except User.DoesNotExist:
-            form.add_error('username', 'Account not found with that Email, ID or Phone')
 
     return render(request, 'auth/login.html', {'form': form})
 
@@ -96,68 +127,60 @@ import random
 import string
 
 # Super Admin Dashboard View
+@role_required('super_admin')
 def admin_dashboard(request):
     """Super Admin Dashboard"""
-    # Check if user is logged in and is a super admin
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Super admin only.')
-        return redirect('login')
-    
-    # Statistics
+    # Statistics: one conditional aggregate per table instead of a COUNT per figure
+    user_counts = User.objects.aggregate(
+        total_passengers=Count('id', filter=Q(user_type='passenger')),
+        total_drivers=Count('id', filter=Q(user_type='driver')),
+        total_conductors=Count('id', filter=Q(user_type='conductor')),
+        total_sacco_admins=Count('id', filter=Q(user_type='sacco_admin')),
+    )
+    payment_totals = PaymentDailyRollup.objects.aggregate(
+        total_payments=Sum('payment_count'),
+        completed_amount=Sum('total_amount', filter=Q(status='completed')),
+        total_transactions=Sum('payment_count', filter=Q(status='completed')),
+        pending_payments=Sum('payment_count', filter=Q(status='pending')),
+    )
     total_saccos = Sacco.objects.count()
-    total_passengers = User.objects.filter(user_type='passenger').count()
-    total_drivers = User.objects.filter(user_type='driver').count()
-    total_conductors = User.objects.filter(user_type='conductor').count()
-    total_sacco_admins = User.objects.filter(user_type='sacco_admin').count()
     total_matatus = Matatu.objects.count()
     total_routes = Route.objects.count()
     total_trips = Trip.objects.count()
-    total_payments = Payment.objects.count()
     
     # Recent activity
     recent_users = User.objects.all().order_by('-date_joined')[:10]
     recent_saccos = Sacco.objects.all().order_by('-date_registered')[:5]
-    recent_matatus = Matatu.objects.all().order_by('-registration_date')[:5]
-    recent_routes = Route.objects.all().order_by('-id')[:5]
-    recent_trips = Trip.objects.all().order_by('-created_at')[:5]
-    recent_payments = Payment.objects.all().order_by('-created_at')[:5]
-    
-    # Monthly stats for charts
-    import datetime
-    from django.db.models.functions import TruncMonth
+    recent_matatus = Matatu.objects.select_related('sacco').order_by('-registration_date')[:5]
+    recent_routes = Route.objects.select_related('sacco').order_by('-id')[:5]
+    recent_trips = Trip.objects.select_related('route', 'matatu').order_by('-created_at')[:5]
+    recent_payments = Payment.objects.select_related('passenger').order_by('-created_at')[:5]
     
     # User registrations by month
     users_by_month = User.objects.annotate(
         month=TruncMonth('date_joined')
     ).values('month').annotate(
-        count=models.Count('id')
+        count=Count('id')
     ).order_by('month')[:6]
     
     # Payment statistics
     payment_stats = {
-        'total_amount': Payment.objects.filter(status='completed').aggregate(Sum('amount'))['amount__sum'] or 0,
-        'total_transactions': Payment.objects.filter(status='completed').count(),
-        'pending_payments': Payment.objects.filter(status='pending').count(),
+        'total_amount': payment_totals['completed_amount'] or 0,
+        'total_transactions': payment_totals['total_transactions'] or 0,
+        'pending_payments': payment_totals['pending_payments'] or 0,
     }
     
     context = {
-        'admin': user,
+        'admin': request.principal,
         'total_saccos': total_saccos,
-        'total_passengers': total_passengers,
-        'total_drivers': total_drivers,
-        'total_conductors': total_conductors,
-        'total_sacco_admins': total_sacco_admins,
+        'total_passengers': user_counts['total_passengers'],
+        'total_drivers': user_counts['total_drivers'],
+        'total_conductors': user_counts['total_conductors'],
+        'total_sacco_admins': user_counts['total_sacco_admins'],
         'total_matatus': total_matatus,
         'total_routes': total_routes,
         'total_trips': total_trips,
-        'total_payments': total_payments,
+        'total_payments': payment_totals['total_payments'] or 0,
         'recent_users': recent_users,
         'recent_saccos': recent_saccos,
         'recent_matatus': recent_matatus,
@@ -172,18 +195,9 @@ def admin_dashboard(request):
     return render(request, 'admin/dashboard.html', context)
 
 # User Management Views
+@role_required('super_admin')
 def admin_manage_users(request):
     """Manage all users"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     user_type = request.GET.get('user_type', '')
     search = request.GET.get('search', '')
@@ -203,11 +217,12 @@ def admin_manage_users(request):
             Q(id_number__icontains=search)
         )
     
-    # Order by date joined
-    users = users.order_by('-date_joined')
+    # One keyset page, newest first
+    page = paginate_keyset(request, users, '-date_joined')
     
     context = {
-        'users': users,
+        'users': page.object_list,
+        'page': page,
         'user_types': User.USER_TYPES,
         'selected_type': user_type,
         'search_query': search,
@@ -215,18 +230,9 @@ def admin_manage_users(request):
     
     return render(request, 'admin/manage_users.html', context)
 
+@role_required('super_admin')
 def admin_add_user(request):
     """Add new user (any type)"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             # Get form data
@@ -246,6 +252,11 @@ def admin_add_user(request):
             # Validate email
             validate_email(email)
             
+            # Stored as +254..., the only form login looks up
+            phone_number = normalize_phone(phone_number)
+            if not phone_number:
+                raise ValidationError('Enter a Kenyan mobile number, e.g. 0712 345 678')
+            
             # Check if email already exists
             if User.objects.filter(email=email).exists():
                 raise ValidationError('Email already registered')
@@ -298,18 +309,10 @@ def admin_add_user(request):
     
     return render(request, 'admin/add_user.html', context)
 
+@role_required('super_admin')
 def admin_edit_user(request, user_id):
     """Edit user"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        user = get_object_or_404(User, id=user_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    user = get_object_or_404(User, id=user_id)
     
     if request.method == 'POST':
         try:
@@ -325,6 +328,11 @@ def admin_edit_user(request, user_id):
             if not all([user_type, first_name, last_name, email, phone_number]):
                 raise ValidationError('All fields are required')
             
+            # Stored as +254..., the only form login looks up
+            phone_number = normalize_phone(phone_number)
+            if not phone_number:
+                raise ValidationError('Enter a Kenyan mobile number, e.g. 0712 345 678')
+            
             # Check if email already exists (excluding current user)
             if User.objects.filter(email=email).exclude(id=user.id).exists():
                 raise ValidationError('Email already registered')
@@ -346,7 +354,10 @@ def admin_edit_user(request, user_id):
             if password:
                 user.set_password(password)
             
-            user.save()
+            # Only the edited fields: credits and the unread count may have moved since the user was read
+            user.save(update_fields=[
+                'user_type', 'first_name', 'last_name', 'email', 'phone_number', 'is_active', 'password'
+            ])
             
             # Update sacco admin if applicable
             if user_type == 'sacco_admin':
@@ -389,18 +400,10 @@ def admin_edit_user(request, user_id):
     
     return render(request, 'admin/edit_user.html', context)
 
+@role_required('super_admin')
 def admin_delete_user(request, user_id):
     """Delete user"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        user = get_object_or_404(User, id=user_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    user = get_object_or_404(User, id=user_id)
     
     if request.method == 'POST':
         try:
@@ -414,18 +417,9 @@ def admin_delete_user(request, user_id):
     return render(request, 'admin/delete_user.html', {'user': user})
 
 # Sacco Management Views
+@role_required('super_admin')
 def admin_manage_saccos(request):
     """Manage all saccos"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     search = request.GET.get('search', '')
     
@@ -440,17 +434,16 @@ def admin_manage_saccos(request):
             Q(contact_email__icontains=search)
         )
     
-    # Order by date registered
-    saccos = saccos.order_by('-date_registered')
-    
-    # Get stats for each sacco
-    for sacco in saccos:
-        sacco.matatu_count = Matatu.objects.filter(sacco=sacco).count()
-        sacco.route_count = Route.objects.filter(sacco=sacco).count()
-        sacco.driver_count = User.objects.filter(
-            user_type='driver',
-            assigned_matatu_as_driver__sacco=sacco
-        ).distinct().count()
+    # Order by date registered, with per-sacco stats computed in the same query
+    saccos = saccos.order_by('-date_registered').annotate(
+        matatu_count=count_subquery(Matatu.objects.filter(sacco=OuterRef('pk'))),
+        route_count=count_subquery(Route.objects.filter(sacco=OuterRef('pk'))),
+        driver_count=count_subquery(
+            Matatu.objects.filter(sacco=OuterRef('pk'), current_driver__user_type='driver'),
+            'current_driver',
+            distinct=True
+        ),
+    )
     
     context = {
         'saccos': saccos,
@@ -459,18 +452,9 @@ def admin_manage_saccos(request):
     
     return render(request, 'admin/manage_saccos.html', context)
 
+@role_required('super_admin')
 def admin_add_sacco(request):
     """Add new sacco"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             name = request.POST.get('name')
@@ -535,18 +519,10 @@ def admin_add_sacco(request):
     
     return render(request, 'admin/add_sacco.html', context)
 
+@role_required('super_admin')
 def admin_edit_sacco(request, sacco_id):
     """Edit sacco"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        sacco = get_object_or_404(Sacco, id=sacco_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    sacco = get_object_or_404(Sacco, id=sacco_id)
     
     if request.method == 'POST':
         try:
@@ -611,18 +587,10 @@ def admin_edit_sacco(request, sacco_id):
     
     return render(request, 'admin/edit_sacco.html', context)
 
+@role_required('super_admin')
 def admin_delete_sacco(request, sacco_id):
     """Delete sacco"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        sacco = get_object_or_404(Sacco, id=sacco_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    sacco = get_object_or_404(Sacco, id=sacco_id)
     
     if request.method == 'POST':
         try:
@@ -641,18 +609,9 @@ def admin_delete_sacco(request, sacco_id):
     return render(request, 'admin/delete_sacco.html', {'sacco': sacco})
 
 # Matatu Management Views
+@role_required('super_admin')
 def admin_manage_matatus(request):
     """Manage all matatus"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     sacco_id = request.GET.get('sacco', '')
     search = request.GET.get('search', '')
@@ -670,11 +629,12 @@ def admin_manage_matatus(request):
             Q(sacco__name__icontains=search)
         )
     
-    # Order by registration date
-    matatus = matatus.order_by('-registration_date')
+    # One keyset page, newest first
+    page = paginate_keyset(request, matatus, '-registration_date')
     
     context = {
-        'matatus': matatus,
+        'matatus': page.object_list,
+        'page': page,
         'saccos': Sacco.objects.all(),
         'selected_sacco': sacco_id,
         'search_query': search,
@@ -682,18 +642,9 @@ def admin_manage_matatus(request):
     
     return render(request, 'admin/manage_matatus.html', context)
 
+@role_required('super_admin')
 def admin_add_matatu(request):
     """Add new matatu"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             plate_number = request.POST.get('plate_number')
@@ -752,6 +703,8 @@ def admin_add_matatu(request):
                 current_conductor=conductor,
                 qr_code_data=qr_data
             )
+            # The QR image is rendered by a background job
+            enqueue(render_matatu_qr, key=f'qr:{matatu.id}', matatu_id=matatu.id)
             
             messages.success(request, f'Matatu {plate_number} added successfully')
             return redirect('admin_manage_matatus')
@@ -774,18 +727,10 @@ def admin_add_matatu(request):
     
     return render(request, 'admin/add_matatu.html', context)
 
+@role_required('super_admin')
 def admin_edit_matatu(request, matatu_id):
     """Edit matatu"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        matatu = get_object_or_404(Matatu, id=matatu_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    matatu = get_object_or_404(Matatu, id=matatu_id)
     
     if request.method == 'POST':
         try:
@@ -865,18 +810,10 @@ def admin_edit_matatu(request, matatu_id):
     
     return render(request, 'admin/edit_matatu.html', context)
 
+@role_required('super_admin')
 def admin_delete_matatu(request, matatu_id):
     """Delete matatu"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        matatu = get_object_or_404(Matatu, id=matatu_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    matatu = get_object_or_404(Matatu, id=matatu_id)
     
     if request.method == 'POST':
         try:
@@ -890,18 +827,9 @@ def admin_delete_matatu(request, matatu_id):
     return render(request, 'admin/delete_matatu.html', {'matatu': matatu})
 
 # Route Management Views
+@role_required('super_admin')
 def admin_manage_routes(request):
     """Manage all routes"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     sacco_id = request.GET.get('sacco', '')
     search = request.GET.get('search', '')
@@ -919,13 +847,11 @@ def admin_manage_routes(request):
             Q(end_point__icontains=search)
         )
     
-    # Order by name
-    routes = routes.order_by('name')
-    
-    # Get trip counts for each route
-    for route in routes:
-        route.trip_count = Trip.objects.filter(route=route).count()
-        route.active_trips = Trip.objects.filter(route=route, status='active').count()
+    # Order by name, with trip counts computed in the same query
+    routes = routes.order_by('name').annotate(
+        trip_count=Count('trips'),
+        active_trips=Count('trips', filter=Q(trips__status='active')),
+    )
     
     context = {
         'routes': routes,
@@ -936,18 +862,9 @@ def admin_manage_routes(request):
     
     return render(request, 'admin/manage_routes.html', context)
 
+@role_required('super_admin')
 def admin_add_route(request):
     """Add new route"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             name = request.POST.get('name')
@@ -972,16 +889,21 @@ def admin_add_route(request):
             if Route.objects.filter(sacco=sacco, name=name).exists():
                 raise ValidationError(f'Route "{name}" already exists for {sacco.name}')
             
-            # Create route
-            route = Route.objects.create(
-                name=name,
-                start_point=start_point,
-                end_point=end_point,
-                distance_km=float(distance_km),
-                estimated_duration_minutes=int(estimated_duration),
-                standard_fare=float(standard_fare),
-                sacco=sacco
-            )
+            # Create route with its stops
+            with transaction.atomic():
+                route = Route.objects.create(
+                    name=name,
+                    start_point=start_point,
+                    end_point=end_point,
+                    distance_km=float(distance_km),
+                    estimated_duration_minutes=int(estimated_duration),
+                    standard_fare=float(standard_fare),
+                    sacco=sacco
+                )
+                try:
+                    set_stops(route, parse_stops(request.POST.get('stops')))
+                except FareError as e:
+                    raise ValidationError(str(e))
             
             messages.success(request, f'Route {name} added successfully')
             return redirect('admin_manage_routes')
@@ -997,18 +919,10 @@ def admin_add_route(request):
     
     return render(request, 'admin/add_route.html', context)
 
+@role_required('super_admin')
 def admin_edit_route(request, route_id):
     """Edit route"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        route = get_object_or_404(Route, id=route_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    route = get_object_or_404(Route, id=route_id)
     
     if request.method == 'POST':
         try:
@@ -1035,7 +949,7 @@ def admin_edit_route(request, route_id):
             if Route.objects.filter(sacco=sacco, name=name).exclude(id=route.id).exists():
                 raise ValidationError(f'Route "{name}" already exists for {sacco.name}')
             
-            # Update route
+            # Update route and its stops
             route.name = name
             route.start_point = start_point
             route.end_point = end_point
@@ -1044,7 +958,12 @@ def admin_edit_route(request, route_id):
             route.standard_fare = float(standard_fare)
             route.sacco = sacco
             route.is_active = is_active
-            route.save()
+            with transaction.atomic():
+                route.save()
+                try:
+                    set_stops(route, parse_stops(request.POST.get('stops')))
+                except FareError as e:
+                    raise ValidationError(str(e))
             
             messages.success(request, f'Route {name} updated successfully')
             return redirect('admin_manage_routes')
@@ -1057,22 +976,15 @@ def admin_edit_route(request, route_id):
     context = {
         'route': route,
         'saccos': Sacco.objects.all(),
+        'stops_text': request.POST.get('stops', '') if request.method == 'POST' else stops_text(route),
     }
     
     return render(request, 'admin/edit_route.html', context)
 
+@role_required('super_admin')
 def admin_delete_route(request, route_id):
     """Delete route"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        route = get_object_or_404(Route, id=route_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    route = get_object_or_404(Route, id=route_id)
     
     if request.method == 'POST':
         try:
@@ -1091,39 +1003,23 @@ def admin_delete_route(request, route_id):
     return render(request, 'admin/delete_route.html', {'route': route})
 
 # Notification Management Views
+@role_required('super_admin')
 def admin_manage_notifications(request):
     """Manage all notifications"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
-    # Get notifications
-    notifications = Notification.objects.select_related('created_by').order_by('-created_at')
+    # Get notifications, one keyset page at a time
+    notifications = Notification.objects.select_related('created_by')
+    page = paginate_keyset(request, notifications, '-created_at')
     
     context = {
-        'notifications': notifications,
+        'notifications': page.object_list,
+        'page': page,
     }
     
     return render(request, 'admin/manage_notifications.html', context)
 
+@role_required('super_admin')
 def admin_add_notification(request):
     """Add new notification"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     if request.method == 'POST':
         try:
             title = request.POST.get('title')
@@ -1137,30 +1033,38 @@ def admin_add_notification(request):
             if not all([title, message, notification_type, recipient_type]):
                 raise ValidationError('All required fields must be filled')
             
+            # Broadcasts store the audience rule, not a row per user
+            if recipient_type == 'specific':
+                audience = 'specific'
+            elif recipient_type == 'saccos' or (sacco_ids and recipient_type != 'all'):
+                audience = 'saccos'
+            else:
+                audience = 'all'
+            
             # Create notification
             notification = Notification.objects.create(
                 title=title,
                 message=message,
                 notification_type=notification_type,
-                created_by=admin
+                audience=audience,
+                created_by_id=request.principal.id
             )
             
-            # Add recipients based on type
-            if recipient_type == 'all':
-                # Send to all users
-                all_users = User.objects.filter(is_active=True)
-                notification.recipients.set(all_users)
-            elif recipient_type == 'specific':
-                # Send to specific users
-                if recipient_ids:
-                    recipients = User.objects.filter(id__in=recipient_ids, is_active=True)
-                    notification.recipients.set(recipients)
+            # Only a hand-picked list is stored per user
+            if audience == 'specific' and recipient_ids:
+                recipients = User.objects.filter(id__in=recipient_ids, is_active=True)
+                notification.recipients.set(recipients)
             
             # Add saccos if specified
             if sacco_ids:
                 saccos = Sacco.objects.filter(id__in=sacco_ids)
                 notification.saccos.set(saccos)
             
+            # Targeted audiences get inbox rows and unread counts from a background job;
+            # broadcasts are delivered to each user as they read (notifications.deliver)
+            if audience != 'all':
+                enqueue(fan_out_notification, key=f'fan_out:{notification.id}', notification_id=notification.id)
+            
             messages.success(request, 'Notification created and sent successfully')
             return redirect('admin_manage_notifications')
             
@@ -1180,19 +1084,10 @@ def admin_add_notification(request):
     
     return render(request, 'admin/add_notification.html', context)
 
+@role_required('super_admin')
 def admin_edit_notification(request, notification_id):
     """Edit notification"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')  
-        
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        notification = get_object_or_404(Notification, id=notification_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    notification = get_object_or_404(Notification, id=notification_id)
     
     if request.method == 'POST':
         try:
@@ -1206,12 +1101,17 @@ def admin_edit_notification(request, notification_id):
                 raise ValidationError('All required fields must be filled')
             
             # Update notification
+            was_active = notification.is_active
             notification.title = title
             notification.message = message
             notification.notification_type = notification_type
             notification.is_active = is_active
             notification.save()
             
+            # Deactivating takes it out of everyone's unread count
+            if was_active and not is_active:
+                retract(notification)
+            
             messages.success(request, 'Notification updated successfully')
             return redirect('admin_manage_notifications')
             
@@ -1227,18 +1127,10 @@ def admin_edit_notification(request, notification_id):
     
     return render(request, 'admin/edit_notification.html', context)
 
+@role_required('super_admin')
 def admin_delete_notification(request, notification_id):
     """Delete notification"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-        notification = get_object_or_404(Notification, id=notification_id)
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
+    notification = get_object_or_404(Notification, id=notification_id)
     
     if request.method == 'POST':
         try:
@@ -1251,18 +1143,9 @@ def admin_delete_notification(request, notification_id):
     return render(request, 'admin/delete_notification.html', {'notification': notification})
 
 # Trip Management Views
+@role_required('super_admin')
 def admin_manage_trips(request):
     """Manage all trips"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     status = request.GET.get('status', '')
     sacco_id = request.GET.get('sacco', '')
@@ -1272,7 +1155,7 @@ def admin_manage_trips(request):
     # Filter trips
     trips = Trip.objects.select_related(
         'matatu', 'matatu__sacco', 'route', 'driver', 'conductor'
-    ).order_by('-scheduled_departure')
+    )
     
     if status:
         trips = trips.filter(status=status)
@@ -1286,12 +1169,12 @@ def admin_manage_trips(request):
     if date_to:
         trips = trips.filter(scheduled_departure__date__lte=date_to)
     
-    # Get passenger counts for each trip
-    for trip in trips:
-        trip.passenger_count = PassengerTrip.objects.filter(trip=trip).count()
+    # One keyset page, latest departures first
+    page = paginate_keyset(request, trips, '-scheduled_departure')
     
     context = {
-        'trips': trips,
+        'trips': page.object_list,
+        'page': page,
         'status_choices': Trip.TRIP_STATUS,
         'saccos': Sacco.objects.all(),
         'selected_status': status,
@@ -1303,18 +1186,9 @@ def admin_manage_trips(request):
     return render(request, 'admin/manage_trips.html', context)
 
 # Payment Management Views
+@role_required('super_admin')
 def admin_manage_payments(request):
     """Manage all payments"""
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login')
-        return redirect('login')
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied')
-        return redirect('login')
-    
     # Get filter parameters
     status = request.GET.get('status', '')
     payment_type = request.GET.get('payment_type', '')
@@ -1322,7 +1196,7 @@ def admin_manage_payments(request):
     date_to = request.GET.get('date_to', '')
     
     # Filter payments
-    payments = Payment.objects.select_related('passenger').order_by('-created_at')
+    payments = Payment.objects.select_related('passenger')
     
     if status:
         payments = payments.filter(status=status)
@@ -1336,12 +1210,29 @@ def admin_manage_payments(request):
     if date_to:
         payments = payments.filter(created_at__date__lte=date_to)
     
-    # Calculate totals
-    total_amount = payments.aggregate(Sum('amount'))['amount__sum'] or 0
-    completed_amount = payments.filter(status='completed').aggregate(Sum('amount'))['amount__sum'] or 0
+    # Calculate totals from the daily rollups, which share every filter above
+    rollups = PaymentDailyRollup.objects.all()
+    if status:
+        rollups = rollups.filter(status=status)
+    if payment_type:
+        rollups = rollups.filter(payment_type=payment_type)
+    if date_from:
+        rollups = rollups.filter(day__gte=date_from)
+    if date_to:
+        rollups = rollups.filter(day__lte=date_to)
+    totals = rollups.aggregate(
+        amount=Sum('total_amount'),
+        completed=Sum('total_amount', filter=Q(status='completed')),
+    )
+    total_amount = totals['amount'] or 0
+    completed_amount = totals['completed'] or 0
+    
+    # One keyset page, newest first
+    page = paginate_keyset(request, payments, '-created_at')
     
     context = {
-        'payments': payments,
+        'payments': page.object_list,
+        'page': page,
         'status_choices': Payment.STATUS_CHOICES,
         'payment_types': Payment.PAYMENT_TYPES,
         'selected_status': status,
@@ -1354,50 +1245,101 @@ def admin_manage_payments(request):
     
     return render(request, 'admin/manage_payments.html', context)
 
+# Data Export
+async def _pull(chunks):
+    """Hand a sync iterator to an ASGI response one chunk at a time (Django would read it all first)"""
+    step = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await step(chunks, None)) is not None:
+        yield chunk
+
+@role_required('super_admin')
+def admin_export(request, dataset):
+    """Stream payments, trips or users as CSV or Parquet, filtered like the list pages"""
+    fmt = request.GET.get('format', 'csv')
+    try:
+        chunks = export(dataset, request.GET, fmt)
+    except ExportError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    
+    if isinstance(request, ASGIRequest):
+        chunks = _pull(chunks)
+    response = StreamingHttpResponse(chunks, content_type=FORMATS[fmt])
+    stamp = timezone.localtime().strftime('%Y%m%d-%H%M')
+    response['Content-Disposition'] = f'attachment; filename="matwana-{dataset}-{stamp}.{fmt}"'
+    response['Cache-Control'] = 'no-store'
+    return response
+
+# Request Profiles API
+@role_required('super_admin', api=True)
+def admin_profiles_api(request):
+    """The latest sampled request profiles in this process, and a summary per view"""
+    try:
+        limit = min(max(int(request.GET.get('limit', 100)), 1), settings.MATWANA_PROFILE_BUFFER_SIZE)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'limit must be a number'}, status=400)
+    
+    profiles = profiling.recent()
+    if request.GET.get('view'):
+        profiles = [profile for profile in profiles if profile['view'] == request.GET['view']]
+    
+    return JsonResponse({
+        'success': True,
+        'sample_rate': settings.MATWANA_PROFILE_SAMPLE_RATE,
+        'summary': profiling.summary(profiles),
+        'profiles': profiles[:limit],
+    })
+
 # Dashboard Statistics API
+@role_required('super_admin', api=True)
 def admin_dashboard_stats(request):
     """API endpoint for dashboard statistics"""
-    if 'user_id' not in request.session:
-        return JsonResponse({'success': False, 'message': 'Not authenticated'})
-    
-    try:
-        admin = User.objects.get(id=request.session['user_id'], user_type='super_admin')
-    except User.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'Access denied'})
-    
     # Get stats for the last 7 days
-    from datetime import datetime, timedelta
-    
     today = timezone.now().date()
     last_week = today - timedelta(days=7)
+    days = [last_week + timedelta(days=i) for i in range(7)]
     
     # User registrations by day
-    user_registrations = []
-    for i in range(7):
-        date = last_week + timedelta(days=i)
-        count = User.objects.filter(date_joined__date=date).count()
-        user_registrations.append({
-            'date': date.strftime('%Y-%m-%d'),
-            'count': count
-        })
+    registrations = dict(
+        RegistrationDailyRollup.objects.filter(
+            day__gte=last_week,
+            day__lt=today
+        ).values('day').annotate(
+            count=Sum('user_count')
+        ).values_list('day', 'count')
+    )
+    user_registrations = [
+        {'date': date.strftime('%Y-%m-%d'), 'count': registrations.get(date, 0)}
+        for date in days
+    ]
     
     # Payment statistics by day
+    daily_payments = {
+        row['day']: row
+        for row in PaymentDailyRollup.objects.filter(
+            status='completed',
+            day__gte=last_week,
+            day__lt=today
+        ).values('day').annotate(
+            total=Sum('total_amount'),
+            count=Sum('payment_count')
+        )
+    }
     payment_stats = []
-    for i in range(7):
-        date = last_week + timedelta(days=i)
-        daily_payments = Payment.objects.filter(created_at__date=date, status='completed')
-        total = daily_payments.aggregate(Sum('amount'))['amount__sum'] or 0
-        count = daily_payments.count()
+    for date in days:
+        row = daily_payments.get(date, {})
         payment_stats.append({
             'date': date.strftime('%Y-%m-%d'),
-            'total': float(total),
-            'count': count
+            'total': float(row.get('total') or 0),
+            'count': row.get('count') or 0
         })
     
-    # Active trips by status
-    active_trips = Trip.objects.filter(status='active').count()
-    scheduled_trips = Trip.objects.filter(status='scheduled').count()
-    completed_trips = Trip.objects.filter(status='completed').count()
+    # Trips by status
+    trip_counts = TripDailyRollup.objects.aggregate(
+        active=Sum('trip_count', filter=Q(status='active')),
+        scheduled=Sum('trip_count', filter=Q(status='scheduled')),
+        completed=Sum('trip_count', filter=Q(status='completed')),
+    )
+    trip_counts = {status: count or 0 for status, count in trip_counts.items()}
     
     # Recent activities
     recent_activities = []
@@ -1414,7 +1356,9 @@ def admin_dashboard_stats(request):
         })
     
     # Add new payments
-    new_payments = Payment.objects.filter(created_at__date=today, status='completed')[:5]
+    new_payments = Payment.objects.filter(
+        created_at__date=today, status='completed'
+    ).select_related('passenger')[:5]
     for payment in new_payments:
         recent_activities.append({
             'type': 'payment',
@@ -1425,7 +1369,7 @@ def admin_dashboard_stats(request):
         })
     
     # Add new trips
-    new_trips = Trip.objects.filter(created_at__date=today)[:5]
+    new_trips = Trip.objects.filter(created_at__date=today).select_related('route', 'matatu')[:5]
     for trip in new_trips:
         recent_activities.append({
             'type': 'trip',
@@ -1442,11 +1386,7 @@ def admin_dashboard_stats(request):
         'success': True,
         'user_registrations': user_registrations,
         'payment_stats': payment_stats,
-        'trip_stats': {
-            'active': active_trips,
-            'scheduled': scheduled_trips,
-            'completed': completed_trips
-        },
+        'trip_stats': trip_counts,
         'recent_activities': recent_activities[:10]
     })
 
@@ -1469,18 +1409,10 @@ def logout(request):
     return redirect('login')
 
 # Dashboard view
+@role_required('passenger')
 def dashboard(request):
-    # Check if user is logged in via session
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        messages.error(request, 'Passenger not found')
-        return redirect('login')
+    # Balance and last login are shown, so load the full row
+    user = request.principal.user
     
     # Calculate greeting based on time
     current_hour = timezone.now().hour
@@ -1522,25 +1454,12 @@ def dashboard(request):
         passenger=user
     ).select_related('trip', 'trip__route').order_by('-alighted_at')[:10]
     
-    # Get notifications
-    unread_notifications = []
-    recent_notifications = []
+    # Pull anything new into the inbox; the badge is then the user's counter
+    if deliver(user):
+        user.refresh_from_db(fields=['unread_notifications'])
     
-    try:
-        # Get unread notifications
-        unread_notifications = Notification.objects.filter(
-            recipients=user,
-            created_at__gte=user.last_login or timezone.now() - timedelta(days=7)
-        ).exclude(
-            id__in=request.session.get('read_notifications', [])
-        )
-        
-        # Get recent notifications for dropdown
-        recent_notifications = Notification.objects.filter(
-            Q(recipients=user) | Q(recipients__isnull=True)
-        ).order_by('-created_at')[:10]
-    except:
-        pass  # If notifications model doesn't exist yet
+    # Get recent notifications for dropdown
+    recent_notifications = inbox(user)[:10]
     
     context = {
         'passenger': user,
@@ -1551,7 +1470,7 @@ def dashboard(request):
         'total_spent': total_spent,
         'popular_routes': popular_routes,
         'recent_trips': recent_trips,
-        'unread_notifications': unread_notifications,
+        'unread_count': user.unread_notifications,
         'recent_notifications': recent_notifications,
         'average_rating': 4.8,  # Default value
     }
@@ -1559,19 +1478,10 @@ def dashboard(request):
     return render(request, 'passenger/dashboard.html', context)
 
 # Other dashboard views
+@role_required('sacco_admin')
 def sacco_dashboard(request):
     """Sacco Admin Dashboard"""
-    # Check if user is logged in and is a sacco admin
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='sacco_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Sacco admin only.')
-        return redirect('login')
+    user = request.principal.user
     
     # Get sacco associated with this admin
     try:
@@ -1602,52 +1512,10 @@ def sacco_dashboard(request):
     
     return render(request, 'sacco/dashboard.html', context)
 
-def admin_dashboard(request):
-    """Super Admin Dashboard"""
-    # Check if user is logged in and is a super admin
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='super_admin')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Super admin only.')
-        return redirect('login')
-    
-    # Admin statistics
-    total_saccos = Sacco.objects.count()
-    total_passengers = User.objects.filter(user_type='passenger').count()
-    total_drivers = User.objects.filter(user_type='driver').count()
-    total_conductors = User.objects.filter(user_type='conductor').count()
-    
-    # Recent registrations
-    recent_users = User.objects.all().order_by('-date_joined')[:10]
-    
-    context = {
-        'total_saccos': total_saccos,
-        'total_passengers': total_passengers,
-        'total_drivers': total_drivers,
-        'total_conductors': total_conductors,
-        'recent_users': recent_users,
-    }
-    
-    return render(request, 'admin/dashboard.html', context)
-
+@role_required('driver')
 def driver_dashboard(request):
     """Driver Dashboard"""
-    # Check if user is logged in and is a driver
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='driver')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Driver only.')
-        return redirect('login')
+    user = request.principal.user
     
     # Get assigned matatu
     try:
@@ -1674,19 +1542,10 @@ def driver_dashboard(request):
     
     return render(request, 'driver/dashboard.html', context)
 
+@role_required('conductor')
 def conductor_dashboard(request):
     """Conductor Dashboard"""
-    # Check if user is logged in and is a conductor
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access dashboard')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        user = User.objects.get(id=user_id, user_type='conductor')
-    except User.DoesNotExist:
-        messages.error(request, 'Access denied. Conductor only.')
-        return redirect('login')
+    user = request.principal.user
     
     # Get assigned matatu
     try:
@@ -1720,24 +1579,19 @@ def conductor_dashboard(request):
     return render(request, 'conductor/dashboard.html', context)
 
 # API Views
+@role_required('passenger', api=True)
 def dashboard_data_api(request):
     """API endpoint for dashboard data updates"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        return JsonResponse({'success': False, 'message': 'Not authenticated'})
-    
-    user_id = request.session['user_id']
-    try:
-        passenger = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'User not found'})
+    passenger_id = request.principal.id
     
-    # Get updated stats
+    # Get updated stats; only the balance and badge need a fresh read of the user row
+    credits, unread = User.objects.filter(id=passenger_id).values_list('credits', 'unread_notifications')[0]
     stats = {
-        'total_trips': PassengerTrip.objects.filter(passenger=passenger).count(),
-        'wallet_balance': float(passenger.credits),
+        'total_trips': PassengerTrip.objects.filter(passenger_id=passenger_id).count(),
+        'wallet_balance': float(credits),
+        'unread_notifications': unread,
         'active_bookings': PassengerTrip.objects.filter(
-            passenger=passenger,
+            passenger_id=passenger_id,
             trip__status__in=['scheduled', 'active'],
             trip__scheduled_departure__gte=timezone.now()
         ).count(),
@@ -1753,13 +1607,13 @@ def search_routes_api(request):
     """API endpoint for route search"""
     query = request.GET.get('q', '')
     
-    routes = Route.objects.filter(
-        Q(name__icontains=query) |
-        Q(start_point__icontains=query) |
-        Q(end_point__icontains=query) |
-        Q(sacco__name__icontains=query),
-        is_active=True
-    ).select_related('sacco')[:10]
+    if query.strip():
+        # Best ten matches from the route search index, in rank order
+        route_ids = search_route_ids(query, limit=10)
+        found = Route.objects.select_related('sacco').in_bulk(route_ids)
+        routes = [found[route_id] for route_id in route_ids if route_id in found]
+    else:
+        routes = Route.objects.filter(is_active=True).select_related('sacco')[:10]
     
     route_list = []
     for route in routes:
@@ -1783,21 +1637,26 @@ def route_details_api(request, route_id):
     route = get_object_or_404(Route, id=route_id)
     
     # Get upcoming trips for this route
-    upcoming_trips = Trip.objects.filter(
+    upcoming_trips = list(Trip.objects.filter(
         route=route,
         scheduled_departure__gte=timezone.now(),
         status='scheduled'
-    ).select_related('matatu')[:5]
+    ).select_related('matatu', 'driver', 'route')[:5])
     
     trips_list = []
-    for trip in upcoming_trips:
+    for trip, trip_eta in zip(upcoming_trips, estimates(upcoming_trips)):
         trips_list.append({
             'id': trip.id,
             'time': trip.scheduled_departure.strftime('%I:%M %p'),
             'matatu': trip.matatu.plate_number if trip.matatu else 'Not assigned',
-            'driver': trip.driver.get_full_name() if trip.driver else 'Not assigned'
+            'driver': trip.driver.get_full_name() if trip.driver else 'Not assigned',
+            'estimated_arrival': timezone.localtime(trip_eta['arrival']).strftime('%I:%M %p')
         })
     
+    # Learned from completed trips (eta.py), falling back to the route's estimate
+    route_eta = estimate(route, timezone.now())
+    fare_table = get_table(route)
+    
     return JsonResponse({
         'success': True,
         'route': {
@@ -1807,11 +1666,61 @@ def route_details_api(request, route_id):
             'fare': float(route.standard_fare),
             'distance': float(route.distance_km) if route.distance_km else 0,
             'duration': route.estimated_duration_minutes,
-            'description': f"{route.start_point} to {route.end_point}"
+            'description': f"{route.start_point} to {route.end_point}",
+            'stops': [
+                {'id': stop['id'], 'name': stop['name'], 'distance_km': float(stop['distance_km'])}
+                for stop in fare_table.stops
+            ] if fare_table.has_stops else []
+        },
+        'eta': {
+            'minutes': route_eta['minutes'],
+            'p90_minutes': route_eta['p90_minutes'],
+            'source': route_eta['source'],
+            'minutes_by_hour': route_profile(route)
         },
         'upcoming_trips': trips_list
     })
 
+def plan_journey_api(request):
+    """Earliest journey between two stops, changing matatus where needed (?from=&to=&depart=ISO time)"""
+    origin = request.GET.get('from', '')
+    destination = request.GET.get('to', '')
+    depart = timezone.now()
+    if request.GET.get('depart'):
+        depart = parse_datetime(request.GET['depart'])
+        if depart is None:
+            return JsonResponse({'success': False, 'message': 'depart must be an ISO 8601 date and time'})
+        if timezone.is_naive(depart):
+            depart = timezone.make_aware(depart)
+    if not origin.strip() or not destination.strip():
+        return JsonResponse({'success': False, 'message': 'from and to are required'})
+    
+    legs = plan(origin, destination, depart)
+    if legs is None:
+        return JsonResponse({'success': False, 'message': 'No scheduled trips connect these stops'})
+    
+    routes = Route.objects.in_bulk({leg['route_id'] for leg in legs})
+    journey = []
+    for leg in legs:
+        try:
+            fare = float(get_table(routes[leg['route_id']]).fare(leg['from'], leg['to']))
+        except (KeyError, FareError):
+            fare = None  # the route changed since the graph was built
+        journey.append({
+            **leg,
+            'depart': timezone.localtime(leg['depart']).isoformat(),
+            'arrive': timezone.localtime(leg['arrive']).isoformat(),
+            'fare': fare,
+        })
+    
+    return JsonResponse({
+        'success': True,
+        'legs': journey,
+        'transfers': len(journey) - 1,
+        'arrive': journey[-1]['arrive'],
+    })
+
+@role_required('passenger', api=True)
 def book_trip_api(request):
     """API endpoint to book a trip"""
     if request.method == 'POST':
@@ -1820,71 +1729,22 @@ def book_trip_api(request):
             route_id = data.get('route_id')
             trip_id = data.get('trip_id')
             
-            # Get user from session
-            if 'user_id' not in request.session:
-                return JsonResponse({
-                    'success': False,
-                    'message': 'Not authenticated'
-                })
-            
-            user_id = request.session['user_id']
-            passenger = get_object_or_404(User, id=user_id, user_type='passenger')
-            
-            # Get trip
-            trip = get_object_or_404(Trip, id=trip_id, route_id=route_id)
-            
-            # Check if already booked
-            existing_booking = PassengerTrip.objects.filter(
-                passenger=passenger,
-                trip=trip
-            ).exists()
-            
-            if existing_booking:
-                return JsonResponse({
-                    'success': False,
-                    'message': 'You have already booked this trip'
-                })
-            
-            # Check wallet balance
-            if passenger.credits < trip.route.standard_fare:
+            # Seat, wallet debit, booking and payment are written atomically
+            try:
+                booking = book_trip(
+                    request.principal, trip_id, route_id=route_id,
+                    boarding=data.get('boarding_stop'), alighting=data.get('alighting_stop')
+                )
+            except BookingError as e:
                 return JsonResponse({
                     'success': False,
-                    'message': 'Insufficient wallet balance'
+                    'message': str(e)
                 })
             
-            # Create booking
-            booking = PassengerTrip.objects.create(
-                passenger=passenger,
-                trip=trip,
-                boarding_stop=trip.route.start_point,
-                alighting_stop=trip.route.end_point,
-                fare_paid=trip.route.standard_fare,
-                payment_method='credits',
-                is_paid=True
-            )
-            
-            # Deduct from wallet
-            passenger.credits -= booking.fare_paid
-            passenger.save()
-            
-            # Create payment record
-            try:
-                payment = Payment.objects.create(
-                    passenger=passenger,
-                    payment_type='trip',
-                    amount=booking.fare_paid,
-                    transaction_id=f"TRIP{booking.id:06d}",
-                    payment_method='credits',
-                    status='completed',
-                    description=f'Trip booking for {trip.route.name}',
-                    completed_at=timezone.now()
-                )
-            except:
-                pass  # If Payment model doesn't exist yet
-            
             return JsonResponse({
                 'success': True,
                 'booking_id': booking.id,
+                'fare': float(booking.fare_paid),
                 'message': 'Booking successful'
             })
             
@@ -1896,26 +1756,65 @@ def book_trip_api(request):
     
     return JsonResponse({'success': False, 'message': 'Invalid request method'})
 
-def active_bookings_api(request):
-    """API endpoint for active bookings"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        return JsonResponse({'success': False, 'message': 'Not authenticated'})
+def trip_seats_api(request, trip_id):
+    """Fare and free seats between two stops of a trip (?from=&to=, stop ids or names), and per segment"""
+    trip = get_object_or_404(Trip.objects.select_related('route', 'matatu'), id=trip_id)
+    table = get_table(trip.route)
+    try:
+        first, last, fare = table.journey(request.GET.get('from'), request.GET.get('to'))
+    except FareError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    
+    free = seats_by_segment(trip, table)
+    return JsonResponse({
+        'success': True,
+        'trip_id': trip.id,
+        'from': table.stops[first]['name'],
+        'to': table.stops[last]['name'],
+        'fare': float(fare),
+        'seats_available': min(free[first:last]),
+        'segments': [
+            {'from': table.stops[i]['name'], 'to': table.stops[i + 1]['name'], 'seats_available': seats}
+            for i, seats in enumerate(free)
+        ]
+    })
+
+@role_required('passenger', api=True)
+def cancel_booking_api(request, booking_id):
+    """API endpoint to cancel a booking and refund the fare"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    booking = get_object_or_404(
+        PassengerTrip.objects.select_related('trip', 'trip__route'),
+        id=booking_id,
+        passenger_id=request.principal.id
+    )
     
-    user_id = request.session['user_id']
     try:
-        passenger = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        return JsonResponse({'success': False, 'message': 'User not found'})
+        cancel_booking(booking)
+    except BookingError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
     
+    return JsonResponse({
+        'success': True,
+        'message': 'Booking cancelled and fare refunded'
+    })
+
+@role_required('passenger', api=True)
+def active_bookings_api(request):
+    """API endpoint for active bookings"""
     active_bookings = PassengerTrip.objects.filter(
-        passenger=passenger,
+        passenger_id=request.principal.id,
         trip__scheduled_departure__gte=timezone.now() - timedelta(hours=1),
         trip__status__in=['scheduled', 'active']
     ).select_related('trip', 'trip__route', 'trip__matatu', 'trip__driver')
+    active_bookings = list(active_bookings)
+    trip_etas = estimates(booking.trip for booking in active_bookings)
+    now = timezone.now()
     
     bookings_list = []
-    for booking in active_bookings:
+    for booking, trip_eta in zip(active_bookings, trip_etas):
         bookings_list.append({
             'trip_id': booking.trip.id,
             'route_name': booking.trip.route.name,
@@ -1923,7 +1822,9 @@ def active_bookings_api(request):
             'driver': booking.trip.driver.get_full_name() if booking.trip.driver else 'Unknown',
             'status': booking.trip.status,
             'time': booking.trip.scheduled_departure.strftime('%I:%M %p'),
-            'seats_available': booking.trip.matatu.capacity - booking.trip.passengers.count() if booking.trip.matatu else 0
+            'seats_available': booking.trip.seats_available,
+            'estimated_arrival': timezone.localtime(trip_eta['arrival']).strftime('%I:%M %p'),
+            'minutes_to_arrival': max(round((trip_eta['arrival'] - now).total_seconds() / 60), 0)
         })
     
     return JsonResponse({
@@ -1931,14 +1832,155 @@ def active_bookings_api(request):
         'bookings': bookings_list
     })
 
+@role_required()
+def notification_inbox(request):
+    """The logged-in user's notifications, one keyset page at a time"""
+    deliver(request.principal)
+    page = paginate_keyset(request, inbox(request.principal), '-created_at', per_page=20)
+    
+    context = {
+        'notifications': page.object_list,
+        'page': page,
+        'unread_count': User.objects.filter(id=request.principal.id).values_list('unread_notifications', flat=True)[0],
+    }
+    return render(request, 'passenger/notifications.html', context)
+
+@role_required('driver', api=True)
+def ingest_locations_api(request):
+    """Batched GPS pings from a driver's device: {"trip_id": ..., "pings": [{"lat", "lng", "ts"}, ...]}"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    try:
+        data = json.loads(request.body)
+        accepted = ingest(request.principal.id, data.get('trip_id'), data.get('pings'))
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'message': 'Invalid JSON body'})
+    except TrackingError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    
+    return JsonResponse({'success': True, 'accepted': accepted})
+
+DRIVER_TRIP_STATUSES = ('active', 'completed')
+
+@role_required('driver', api=True)
+def driver_trip_status_api(request, trip_id):
+    """A driver starting or finishing their trip: {"status": "active" | "completed"}"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    try:
+        status = json.loads(request.body).get('status')
+    except (ValueError, AttributeError):
+        return JsonResponse({'success': False, 'message': 'Invalid JSON body'})
+    if status not in DRIVER_TRIP_STATUSES:
+        return JsonResponse({'success': False, 'message': 'status must be active or completed'})
+    
+    try:
+        trip = transition(trip_id, status, driver_id=request.principal.id)
+    except LifecycleError as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+    
+    return JsonResponse({
+        'success': True,
+        'status': trip.status,
+        'actual_departure': trip.actual_departure.isoformat() if trip.actual_departure else None,
+        'actual_arrival': trip.actual_arrival.isoformat() if trip.actual_arrival else None,
+    })
+
+NEARBY_MAX_RESULTS = 50
+
+@role_required(api=True)
+def nearby_trips_api(request):
+    """Active matatus near a point, from the in-memory grid (no database queries)"""
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        radius = float(request.GET['radius']) if request.GET.get('radius') else None
+        k = min(int(request.GET['k']), NEARBY_MAX_RESULTS) if request.GET.get('k') else None
+        route_id = int(request.GET['route_id']) if request.GET.get('route_id') else None
+        min_seats = int(request.GET.get('min_seats', 1))
+    except (KeyError, ValueError):
+        return JsonResponse({'success': False, 'message': 'lat and lng are required; radius, k, route_id and min_seats must be numbers'})
+    
+    if radius is None and k is None:
+        k = 10
+    trips = nearby(lat, lng, radius_km=radius, k=k, route_id=route_id, min_seats=min_seats)
+    return JsonResponse({'success': True, 'trips': trips[:NEARBY_MAX_RESULTS]})
+
+@role_required(api=True)
+def mark_notifications_read_api(request):
+    """API endpoint to mark notifications read; no ids marks them all"""
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method'})
+    
+    try:
+        data = json.loads(request.body or '{}')
+        notification_ids = data.get('notification_ids')
+        if notification_ids is not None:
+            notification_ids = [int(i) for i in notification_ids]
+    except (ValueError, TypeError):
+        return JsonResponse({'success': False, 'message': 'Invalid notification ids'})
+    
+    marked = mark_read(request.principal, notification_ids)
+    unread = User.objects.filter(id=request.principal.id).values_list('unread_notifications', flat=True)[0]
+    return JsonResponse({'success': True, 'marked': marked, 'unread_notifications': unread})
+
+EVENT_STREAM_HEARTBEAT_SECONDS = 15
+EVENT_STREAM_MAX_SECONDS = 300  # EventSource reconnects on its own
+
+async def event_stream(request):
+    """Server-sent events for live dashboard updates (ASGI only)"""
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be pinned for the life of the stream
+        return JsonResponse({'success': False, 'message': 'Event stream requires the ASGI server'}, status=400)
+    
+    user_id = await request.session.aget('user_id')
+    user_type = await request.session.aget('user_type')
+    if not user_id:
+        return JsonResponse({'success': False, 'message': 'Not authenticated'}, status=401)
+    
+    # Subscribe to this session's channels
+    if user_type == 'super_admin':
+        channels = ['admin', 'broadcast']
+    else:
+        channels = [f'user:{user_id}', 'broadcast']
+        if user_type == 'passenger':
+            trip_ids = PassengerTrip.objects.filter(
+                passenger_id=user_id,
+                trip__status__in=['scheduled', 'active']
+            ).values_list('trip_id', flat=True)
+            channels += [f'trip:{trip_id}' async for trip_id in trip_ids]
+    
+    subscription = get_broker().subscribe(channels)
+    
+    async def stream():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + EVENT_STREAM_MAX_SECONDS
+        try:
+            yield 'retry: 5000\n\n'
+            while loop.time() < deadline:
+                try:
+                    event = await subscription.get(timeout=EVENT_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                # Follow status changes of newly booked trips
+                if event['type'] == 'booking' and event.get('trip_id'):
+                    subscription.add_channel(f"trip:{event['trip_id']}")
+                yield format_sse(event)
+        finally:
+            subscription.close()
+    
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 # Route pages - SINGLE OPTIMIZED VIEW
+@role_required()
 def routes_list(request):
     """Display all available routes with filtering and pagination"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        messages.info(request, 'Please login to view all routes')
-        return redirect('login')
-    
     # Get all active routes
     routes = Route.objects.filter(is_active=True).select_related('sacco').order_by('name')
     
@@ -1951,9 +1993,9 @@ def routes_list(request):
     
     # Apply filters
     if start_point:
-        routes = routes.filter(start_point__icontains=start_point)
+        routes = routes.filter(id__in=search_route_ids(start_point, fields=['start_point']))
     if end_point:
-        routes = routes.filter(end_point__icontains=end_point)
+        routes = routes.filter(id__in=search_route_ids(end_point, fields=['end_point']))
     if sacco_id:
         routes = routes.filter(sacco_id=sacco_id)
     if min_fare:
@@ -1969,11 +2011,8 @@ def routes_list(request):
     
     # Get passenger info for booking
     passenger = None
-    if 'user_id' in request.session:
-        try:
-            passenger = User.objects.get(id=request.session['user_id'], user_type='passenger')
-        except User.DoesNotExist:
-            pass
+    if request.principal.user_type == 'passenger':
+        passenger = request.principal.user
     
     # Get all saccos for filter dropdown
     saccos = Sacco.objects.filter(is_active=True).order_by('name')
@@ -1982,13 +2021,13 @@ def routes_list(request):
     start_points = Route.objects.filter(is_active=True).values_list('start_point', flat=True).distinct().order_by('start_point')[:20]
     end_points = Route.objects.filter(is_active=True).values_list('end_point', flat=True).distinct().order_by('end_point')[:20]
     
-    # Get upcoming trips count for each route
-    for route in routes:
-        route.upcoming_trips_count = Trip.objects.filter(
-            route=route,
-            scheduled_departure__gte=timezone.now(),
-            status='scheduled'
-        ).count()
+    # Get upcoming trips count for each route in the same query
+    routes = list(routes.annotate(
+        upcoming_trips_count=Count('trips', filter=Q(
+            trips__scheduled_departure__gte=timezone.now(),
+            trips__status='scheduled'
+        ))
+    ))
     
     context = {
         'routes': routes,
@@ -2001,27 +2040,16 @@ def routes_list(request):
         'min_fare': min_fare,
         'max_fare': max_fare,
         'passenger': passenger,
-        'total_routes': routes.count(),
+        'total_routes': len(routes),
     }
     
     return render(request, 'passenger/routes_list.html', context)
 
+@role_required('passenger')
 def my_trips(request):
     """Display passenger's trip history"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access this page')
-        return redirect('login')
-    
-    user_id = request.session['user_id']
-    try:
-        passenger = User.objects.get(id=user_id, user_type='passenger')
-    except User.DoesNotExist:
-        messages.error(request, 'Passenger not found')
-        return redirect('login')
-    
     trips = PassengerTrip.objects.filter(
-        passenger=passenger
+        passenger_id=request.principal.id
     ).select_related('trip', 'trip__route', 'trip__matatu').order_by('-transaction_time')
     
     # Filter by date if provided
@@ -2045,13 +2073,9 @@ def my_trips(request):
     }
     return render(request, 'trips/my_trips.html', context)
 
+@role_required('passenger')
 def top_up_wallet(request):
     """Display wallet top-up page"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access this page')
-        return redirect('login')
-    
     if request.method == 'POST':
         amount = request.POST.get('amount')
         payment_method = request.POST.get('payment_method')
@@ -2062,60 +2086,46 @@ def top_up_wallet(request):
             if amount < 100:
                 messages.error(request, 'Minimum top-up amount is KES 100')
                 return redirect('top_up_wallet')
+            if payment_method == 'mpesa' and not amount.is_integer():
+                messages.error(request, 'M-Pesa top-ups must be whole shillings')
+                return redirect('top_up_wallet')
         except ValueError:
             messages.error(request, 'Invalid amount')
             return redirect('top_up_wallet')
         
-        user_id = request.session['user_id']
-        try:
-            passenger = User.objects.get(id=user_id, user_type='passenger')
-        except User.DoesNotExist:
-            messages.error(request, 'User not found')
-            return redirect('login')
-        
-        # Update wallet balance
-        passenger.credits += amount
-        passenger.save()
-        
-        # Create payment record
-        try:
+        # The payment is recorded as pending and credited by a background job
+        with transaction.atomic():
             payment = Payment.objects.create(
-                passenger=passenger,
+                passenger_id=request.principal.id,
                 payment_type='credit_topup',
                 amount=amount,
-                transaction_id=f"TOPUP{int(timezone.now().timestamp())}",
+                transaction_id=transaction_id('TOPUP'),
                 payment_method=payment_method,
-                status='completed',
-                description=f'Wallet top-up of KES {amount}',
-                completed_at=timezone.now()
+                status='pending',
+                description=f'Wallet top-up of KES {amount}'
             )
-        except:
-            pass  # If Payment model doesn't exist yet
+            enqueue(complete_topup, key=f'topup:{payment.id}', payment_id=payment.id)
         
-        messages.success(request, f'Successfully topped up KES {amount}')
+        messages.success(request, f'Top-up of KES {amount} received. Your balance will update shortly')
         return redirect('dashboard')
     
     return render(request, 'payments/top_up.html')
 
 # Quick action view
+@role_required()
 def quick_book(request):
     """Handle quick booking requests"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        messages.error(request, 'Please login to access this page')
-        return redirect('login')
-    
     if request.method == 'POST':
         start_point = request.POST.get('start_point')
         end_point = request.POST.get('end_point')
         travel_date = request.POST.get('travel_date')
         
         # Find matching routes
-        routes = Route.objects.filter(
-            start_point__icontains=start_point,
-            end_point__icontains=end_point,
-            is_active=True
-        ).select_related('sacco')
+        routes = Route.objects.filter(is_active=True).select_related('sacco')
+        if start_point:
+            routes = routes.filter(id__in=search_route_ids(start_point, fields=['start_point']))
+        if end_point:
+            routes = routes.filter(id__in=search_route_ids(end_point, fields=['end_point']))
         
         # Find trips for the selected date
         trips = Trip.objects.filter(
@@ -2124,9 +2134,17 @@ def quick_book(request):
             status='scheduled'
         ).select_related('route', 'matatu', 'driver')
         
+        # Journeys with changes, for when no single route goes all the way
+        depart = timezone.now()
+        travel_day = parse_date(travel_date or '')
+        if travel_day and travel_day > timezone.localdate():
+            depart = timezone.make_aware(datetime.combine(travel_day, datetime.min.time()))
+        journey = plan(start_point, end_point, depart) if start_point and end_point else None
+        
         context = {
             'routes': routes,
             'trips': trips,
+            'journey': journey,
             'start_point': start_point,
             'end_point': end_point,
             'travel_date': travel_date,
@@ -2137,12 +2155,26 @@ def quick_book(request):
 
 
 
+@csrf_exempt
+def mpesa_callback(request, token):
+    """STK push results posted by M-Pesa; the secret in the URL is all the authentication Daraja offers"""
+    expected = settings.MATWANA_MPESA.get('CALLBACK_TOKEN')
+    if not expected or not hmac.compare_digest(token, expected):
+        raise Http404
+    if request.method != 'POST':
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid request method'}, status=405)
+    
+    try:
+        handle_callback(json.loads(request.body))
+    except ValueError:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid callback'}, status=400)
+    
+    # Duplicates and unknown requests are acknowledged too, or M-Pesa keeps sending them
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+@role_required('passenger', api=True)
 def process_payment(request):
     """Process payment for wallet top-up"""
-    # Check if user is logged in
-    if 'user_id' not in request.session:
-        return JsonResponse({'success': False, 'message': 'Not authenticated'})
-    
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
@@ -2156,39 +2188,39 @@ def process_payment(request):
                     'message': 'Minimum top-up amount is KES 100'
                 })
             
-            user_id = request.session['user_id']
-            try:
-                passenger = User.objects.get(id=user_id, user_type='passenger')
-            except User.DoesNotExist:
-                return JsonResponse({'success': False, 'message': 'User not found'})
-            
-            # Simulate payment processing
-            # In a real app, you would integrate with M-Pesa, Stripe, etc.
             amount_float = float(amount)
+            if payment_method == 'mpesa' and not amount_float.is_integer():
+                return JsonResponse({
+                    'success': False,
+                    'message': 'M-Pesa top-ups must be whole shillings'
+                })
+            phone = data.get('phone_number') or None
+            if phone and not re.fullmatch(r'\+?254\d{9}', phone):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Phone must be in the format +254XXXXXXXXX'
+                })
             
-            # Update wallet balance
-            passenger.credits += amount_float
-            passenger.save()
-            
-            # Create payment record
-            try:
+            # Recorded as pending; a background job takes it to the payment provider
+            with transaction.atomic():
                 payment = Payment.objects.create(
-                    passenger=passenger,
+                    passenger_id=request.principal.id,
                     payment_type='credit_topup',
                     amount=amount_float,
-                    transaction_id=f"PAY{int(timezone.now().timestamp())}",
+                    transaction_id=transaction_id('PAY'),
                     payment_method=payment_method,
-                    status='completed',
-                    description=f'Wallet top-up of KES {amount_float}',
-                    completed_at=timezone.now()
+                    status='pending',
+                    description=f'Wallet top-up of KES {amount_float}'
                 )
-            except:
-                pass  # If Payment model doesn't exist yet
+                # M-Pesa prompts this phone, the passenger's own unless another is given
+                enqueue(complete_topup, key=f'topup:{payment.id}', payment_id=payment.id, phone=phone)
             
             return JsonResponse({
                 'success': True,
-                'message': f'Successfully topped up KES {amount_float}',
-                'new_balance': float(passenger.credits)
+                'message': f'Top-up of KES {amount_float} is being processed',
+                'payment_id': payment.id,
+                'transaction_id': payment.transaction_id,
+                'status': payment.status
             })
             
         except Exception as e:
@@ -0,0 +1,95 @@
+# wallet.py
+"""
+The passenger wallet.
+
+Every change to a balance is a CreditEntry row, and rows are never updated
+or deleted, so a wallet can always be explained entry by entry.
+``User.credits`` is kept as the running balance so reading it stays a single
+row lookup. ``post`` changes both in one transaction: the balance with a
+conditional ``UPDATE ... SET credits = credits + amount`` (debits only go
+through while ``credits >= -amount``), then the entry, with the balance it
+left behind.
+
+Posts carry an idempotency key built from whatever caused them
+(``topup:<payment id>``, ``trip:<booking id>``, ...). Posting a key again
+returns the first entry and leaves the balance alone, so a retried job or a
+replayed request cannot credit or debit twice. Two concurrent posts with the
+same key both update the balance, but only one entry insert survives the
+unique index; the other is rolled back with its savepoint.
+
+``reconcile`` compares the running balances with the ledger totals and, with
+``fix=True``, resets drifted ones (after a raw UPDATE, say) to what the
+ledger says. The admin shows balances read-only and posts manual changes as
+``adjustment`` entries. ``manage.py reconcile_wallets`` runs it.
+"""
+from decimal import Decimal
+
+from django.db import transaction, IntegrityError
+from django.db.models import DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import User, CreditEntry
+
+
+class WalletError(Exception):
+    """Raised when a wallet cannot be debited. The message is safe to show to the passenger."""
+
+
+def post(user_id, amount, kind, key=None, payment=None):
+    """
+    Add ``amount`` (negative for a debit) to a wallet and record it.
+    Returns (entry, created); created is False when ``key`` was posted before.
+    """
+    amount = Decimal(amount)
+    if key is not None:
+        existing = CreditEntry.objects.filter(idempotency_key=key).first()
+        if existing is not None:
+            return existing, False
+
+    try:
+        with transaction.atomic():
+            users = User.objects.filter(id=user_id)
+            if amount < 0:
+                users = users.filter(credits__gte=-amount)
+            # Takes the row lock: posts to one wallet queue up here until commit
+            if not users.update(credits=F('credits') + amount):
+                raise WalletError('Insufficient wallet balance' if amount < 0 else 'Wallet not found')
+            balance = User.objects.filter(id=user_id).values_list('credits', flat=True)[0]
+            entry = CreditEntry.objects.create(
+                user_id=user_id,
+                kind=kind,
+                amount=amount,
+                balance_after=balance,
+                payment=payment,
+                idempotency_key=key,
+            )
+    except IntegrityError:
+        if key is None:
+            raise
+        # A concurrent post with the same key won
+        return CreditEntry.objects.get(idempotency_key=key), False
+    return entry, True
+
+
+def balance(user_id):
+    return User.objects.filter(id=user_id).values_list('credits', flat=True)[0]
+
+
+def drifted(user_ids=None):
+    """(user id, running balance, ledger total) for wallets that disagree with their ledger."""
+    users = User.objects.all()
+    if user_ids is not None:
+        users = users.filter(id__in=user_ids)
+    return users.annotate(
+        ledger=Coalesce(Sum('credit_entries__amount'), Value(Decimal('0')), output_field=DecimalField())
+    ).exclude(ledger=F('credits')).values_list('id', 'credits', 'ledger')
+
+
+def reconcile(user_ids=None, fix=False):
+    """Find (and with ``fix``, correct) drifted running balances. Returns the drifted rows."""
+    rows = list(drifted(user_ids))
+    if fix:
+        for user_id, credits, ledger in rows:
+            # Only overwrite if nothing was posted since we added up
+            User.objects.filter(id=user_id, credits=credits).update(credits=ledger)
+    return rows